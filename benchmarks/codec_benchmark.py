@@ -0,0 +1,60 @@
+#!/usr/bin/env python
+"""Compare the JSON codecs of matrix_client.codec on scaled up /sync responses.
+
+The sync response from test/response_examples.py is replicated into many joined
+rooms with longer timelines, then encoded and decoded with every available codec.
+
+Usage::
+
+    PYTHONPATH=. python benchmarks/codec_benchmark.py [--rooms 2000] [--events 50]
+"""
+import argparse
+import copy
+import timeit
+
+from matrix_client.codec import available_codecs, get_codec
+from test.response_examples import example_sync
+
+
+def scaled_sync(rooms, events):
+    template_room = example_sync["rooms"]["join"]["!726s6s6q:example.com"]
+    template_events = template_room["timeline"]["events"]
+    response = copy.deepcopy(example_sync)
+    joined = response["rooms"]["join"] = {}
+    for i in range(rooms):
+        room = copy.deepcopy(template_room)
+        timeline = []
+        for j in range(events):
+            event = copy.deepcopy(template_events[j % len(template_events)])
+            event["event_id"] = "$%d_%d:example.com" % (i, j)
+            timeline.append(event)
+        room["timeline"]["events"] = timeline
+        joined["!room%d:example.com" % i] = room
+    return response
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--rooms", type=int, default=2000)
+    parser.add_argument("--events", type=int, default=50)
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    response = scaled_sync(args.rooms, args.events)
+    reference = get_codec("json").dumps(response).encode("utf-8")
+    print("Payload: %d rooms, %d events each, %.1f MB" % (
+        args.rooms, args.events, len(reference) / 1e6))
+    print("%-10s %12s %12s" % ("codec", "loads (ms)", "dumps (ms)"))
+
+    for name in available_codecs():
+        codec = get_codec(name)
+        assert codec.loads(reference) == response
+        loads = min(timeit.repeat(lambda: codec.loads(reference),
+                                  number=1, repeat=args.repeat))
+        dumps = min(timeit.repeat(lambda: codec.dumps(response),
+                                  number=1, repeat=args.repeat))
+        print("%-10s %12.1f %12.1f" % (name, loads * 1000, dumps * 1000))
+
+
+if __name__ == "__main__":
+    main()
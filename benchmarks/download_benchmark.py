@@ -0,0 +1,124 @@
+#!/usr/bin/env python
+"""Compare sequential and parallel ranged downloads of large media.
+
+A local stand-in for the media repository serves random content, honouring Range
+headers. Every response is delayed by ``--latency`` and sent at most at ``--rate``
+per connection, as a single TCP stream is over a high-latency link. The content is
+downloaded with ``MatrixClient.download`` into a file, with growing values of
+``max_parallel``, and checked against the original.
+
+Usage::
+
+    PYTHONPATH=. python benchmarks/download_benchmark.py [--size 64] [--rate 16]
+        [--latency 50] [--parallel 1 2 4 8] [--no-ranges]
+"""
+import argparse
+import hashlib
+import os
+import tempfile
+import threading
+import time
+
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+except ImportError:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+
+from matrix_client.client import MatrixClient
+
+BLOCK = 1 << 16
+
+
+class MediaHandler(BaseHTTPRequestHandler):
+    """Serves ``server.content`` at any download URL."""
+
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        content = self.server.content
+        start, stop = 0, len(content)
+        range_header = self.headers.get("Range")
+        partial = self.server.ranges and range_header is not None
+        if partial:
+            first, last = range_header[len("bytes="):].split("-")
+            start = int(first)
+            if last:
+                stop = min(int(last) + 1, stop)
+        time.sleep(self.server.latency)
+        self.send_response(206 if partial else 200)
+        self.send_header("Content-Type", "application/octet-stream")
+        self.send_header("Content-Length", str(stop - start))
+        if partial:
+            self.send_header("Content-Range",
+                             "bytes %d-%d/%d" % (start, stop - 1, len(content)))
+        self.end_headers()
+        view = memoryview(content)
+        try:
+            for offset in range(start, stop, BLOCK):
+                block = view[offset:min(offset + BLOCK, stop)]
+                self.wfile.write(block)
+                time.sleep(len(block) / self.server.rate)
+        except (IOError, OSError):
+            pass
+
+    def log_message(self, *args):
+        pass
+
+
+class MediaServer(ThreadingMixIn, HTTPServer):
+    # Keep-alive connections must not block the shutdown
+    daemon_threads = True
+
+    def __init__(self, content, latency, rate, ranges):
+        HTTPServer.__init__(self, ("127.0.0.1", 0), MediaHandler)
+        self.content = content
+        self.latency = latency
+        self.rate = rate
+        self.ranges = ranges
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--size", type=int, default=64, help="content size, in MB")
+    parser.add_argument("--rate", type=float, default=16,
+                        help="bandwidth of a connection, in MB/s")
+    parser.add_argument("--latency", type=float, default=50,
+                        help="delay before every response, in ms")
+    parser.add_argument("--parallel", type=int, nargs="+", default=[1, 2, 4, 8],
+                        help="values of max_parallel to compare")
+    parser.add_argument("--no-ranges", action="store_true",
+                        help="ignore Range headers, as some servers do")
+    args = parser.parse_args()
+
+    content = os.urandom(args.size << 20)
+    expected = hashlib.sha256(content).hexdigest()
+    server = MediaServer(content, args.latency / 1000, args.rate * (1 << 20),
+                         not args.no_ranges)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    client = MatrixClient("http://127.0.0.1:%d" % server.server_port)
+
+    fd, path = tempfile.mkstemp()
+    os.close(fd)
+    print("%12s %10s %12s" % ("max_parallel", "time (s)", "MB/s"))
+    try:
+        for max_parallel in args.parallel:
+            with open(path, "w+b") as f:
+                start = time.time()
+                client.download("mxc://localhost/benchmark", f,
+                                max_parallel=max_parallel)
+                elapsed = time.time() - start
+                f.seek(0)
+                assert hashlib.sha256(f.read()).hexdigest() == expected
+            print("%12d %10.2f %12.1f" % (max_parallel, elapsed, args.size / elapsed))
+    finally:
+        os.remove(path)
+        client.api.shutdown()
+        server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,122 @@
+#!/usr/bin/env python
+"""Compare the memory used to upload files as bytes and streamed from disk.
+
+Files of growing sizes are uploaded to a local HTTP server which discards them,
+once read in memory and passed to ``MatrixClient.upload``, and once with
+``MatrixClient.upload_file``. The peak of memory allocated by Python during each
+upload is reported: it grows with the file size for bytes, and stays flat when
+streaming.
+
+Usage::
+
+    PYTHONPATH=. python benchmarks/upload_benchmark.py [--sizes 16 64 256]
+"""
+import argparse
+import json
+import os
+import tempfile
+import threading
+import time
+import tracemalloc
+
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+except ImportError:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+
+from matrix_client.client import MatrixClient
+
+BLOCK = 1 << 20
+
+
+class DiscardHandler(BaseHTTPRequestHandler):
+    """Reads and drops upload bodies, sent with a Content-Length or chunked."""
+
+    protocol_version = "HTTP/1.1"
+
+    def do_POST(self):
+        if self.headers.get("Transfer-Encoding") == "chunked":
+            while True:
+                size = int(self.rfile.readline().strip(), 16)
+                self._discard(size + 2)
+                if not size:
+                    break
+        else:
+            self._discard(int(self.headers["Content-Length"]))
+        body = json.dumps({"content_uri": "mxc://localhost/benchmark"}).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _discard(self, size):
+        while size:
+            size -= len(self.rfile.read(min(size, BLOCK)))
+
+    def log_message(self, *args):
+        pass
+
+
+class Server(ThreadingMixIn, HTTPServer):
+    # Keep-alive connections must not block the shutdown
+    daemon_threads = True
+
+
+def make_file(directory, size_mb):
+    path = os.path.join(directory, "%d.bin" % size_mb)
+    block = os.urandom(BLOCK)
+    with open(path, "wb") as f:
+        for _ in range(size_mb):
+            f.write(block)
+    return path
+
+
+def measure(upload):
+    tracemalloc.start()
+    start = time.time()
+    upload()
+    elapsed = time.time() - start
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return peak, elapsed
+
+
+def upload_bytes(client, path):
+    with open(path, "rb") as f:
+        client.upload(f.read(), "application/octet-stream")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--sizes", type=int, nargs="+", default=[16, 64, 256],
+                        help="file sizes, in MB")
+    args = parser.parse_args()
+
+    server = Server(("127.0.0.1", 0), DiscardHandler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    client = MatrixClient("http://127.0.0.1:%d" % server.server_port)
+
+    directory = tempfile.mkdtemp()
+    print("%8s %16s %16s %12s %12s" % ("size", "bytes peak (MB)", "stream peak (MB)",
+                                       "bytes (s)", "stream (s)"))
+    try:
+        for size_mb in args.sizes:
+            path = make_file(directory, size_mb)
+            bytes_peak, bytes_time = measure(lambda: upload_bytes(client, path))
+            stream_peak, stream_time = measure(
+                lambda: client.upload_file(path, "application/octet-stream"))
+            os.remove(path)
+            print("%6dMB %16.1f %16.1f %12.2f %12.2f" % (
+                size_mb, bytes_peak / 1e6, stream_peak / 1e6, bytes_time, stream_time))
+    finally:
+        os.rmdir(directory)
+        server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -14,10 +14,19 @@
 # limitations under the License.
 
 import json
+import logging
+import re
 import warnings
+from concurrent.futures import ThreadPoolExecutor, wait
 from requests import Session, RequestException
+from threading import Event, Lock, local
 from time import time, sleep
-from .errors import MatrixError, MatrixRequestError, MatrixHttpLibError
+from .codec import get_codec
+from .errors import (MatrixError, MatrixRequestError, MatrixHttpLibError,
+                     MatrixUnexpectedResponse)
+from .ratelimit import RateLimiter
+from .sync_stream import iter_sync_response
+from .upload import upload_body
 
 try:
     from urllib import quote
@@ -26,6 +35,8 @@ except ImportError:
 
 MATRIX_V2_API_PATH = "/_matrix/client/r0"
 
+logger = logging.getLogger(__name__)
+
 
 class MatrixHttpApi(object):
     """Contains all raw Matrix HTTP Client-Server API calls.
@@ -39,6 +50,13 @@ class MatrixHttpApi(object):
         default_429_wait_ms (int): Optional. Time in millseconds to wait before retrying
                                              a request when server returns a HTTP 429
                                              response without a 'retry_after_ms' key.
+        rate_limiter (RateLimiter): Optional. Client-side rate limiter, which may be
+            shared between several instances acting for the same user. By default
+            each instance gets its own, learning from HTTP 429 responses.
+        json_codec (str|JsonCodec): Optional. Codec used to encode request bodies
+            and decode responses, e.g. "orjson". See :mod:`matrix_client.codec`.
+        max_workers (int): Optional. Number of threads running the calls made
+            through ``submit`` and ``map``.
 
     Examples:
         Create a client and send a message::
@@ -46,16 +64,97 @@ class MatrixHttpApi(object):
             matrix = MatrixHttpApi("https://matrix.org", token="foobar")
             response = matrix.sync()
             response = matrix.send_message("!roomid:matrix.org", "Hello!")
+
+        Fetch the state of many rooms concurrently::
+
+            states = list(matrix.map("get_room_state", room_ids))
     """
 
-    def __init__(self, base_url, token=None, identity=None, default_429_wait_ms=5000):
+    def __init__(self, base_url, token=None, identity=None, default_429_wait_ms=5000,
+                 rate_limiter=None, json_codec=None, max_workers=8):
         self.base_url = base_url
         self.token = token
         self.identity = identity
         self.txn_id = 0
+        self._txn_lock = Lock()
         self.validate_cert = True
         self.session = Session()
         self.default_429_wait_ms = default_429_wait_ms
+        self.rate_limiter = rate_limiter or RateLimiter()
+        self.json_codec = get_codec(json_codec)
+        self.max_workers = max_workers
+        self._executor = None
+        self._executor_lock = Lock()
+        # Sessions of the executor threads, as a Session is not thread-safe
+        self._local = local()
+        self._worker_sessions = []
+
+    def submit(self, method, *args, **kwargs):
+        """Call an API method on a thread pool.
+
+        Calls share the rate limiter of this instance, so a HTTP 429 response
+        slows down every pending call instead of each of them retrying at once.
+
+        Args:
+            method (str|func): The name of a method of this instance, e.g.
+                "invite_user", or any callable.
+            *args: Arguments of the method.
+            **kwargs: Keyword arguments of the method.
+
+        Returns:
+            concurrent.futures.Future: The result of the call.
+        """
+        if not callable(method):
+            method = getattr(self, method)
+        return self._get_executor().submit(self._run, method, args, kwargs)
+
+    def map(self, method, *iterables):
+        """Call an API method once per set of arguments, concurrently.
+
+        Every call is submitted right away.
+
+        Args:
+            method (str|func): As for ``submit``.
+            *iterables: Iterables of the positional arguments, as for the
+                builtin ``map``.
+
+        Returns:
+            iterator: The results, in the order of the arguments. Reaching the
+            result of a failed call raises its exception.
+        """
+        futures = [self.submit(method, *args) for args in zip(*iterables)]
+
+        def results():
+            for future in futures:
+                yield future.result()
+        return results()
+
+    def shutdown(self, wait=True):
+        """Stop the threads started by ``submit``. Calls may still be submitted
+        afterwards, on new threads."""
+        with self._executor_lock:
+            executor, self._executor = self._executor, None
+            sessions, self._worker_sessions = self._worker_sessions, []
+        if executor is not None:
+            executor.shutdown(wait)
+        for session in sessions:
+            session.close()
+
+    def _get_executor(self):
+        with self._executor_lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(self.max_workers)
+            return self._executor
+
+    def _run(self, method, args, kwargs):
+        if getattr(self._local, "session", None) is None:
+            self._local.session = Session()
+            with self._executor_lock:
+                self._worker_sessions.append(self._local.session)
+        return method(*args, **kwargs)
+
+    def _get_session(self):
+        return getattr(self._local, "session", None) or self.session
 
     def initial_sync(self, limit=1):
         """
@@ -83,7 +182,36 @@ class MatrixHttpApi(object):
                 Defaults to false.
             set_presence (str): Should the client be marked as "online" or" offline"
         """
+        request = self._sync_query(since, timeout_ms, filter, full_state, set_presence)
+        return self._send("GET", "/sync", query_params=request,
+                          api_path=MATRIX_V2_API_PATH)
+
+    def sync_stream(self, since=None, timeout_ms=30000, filter=None,
+                    full_state=None, set_presence=None, chunk_size=65536):
+        """ Perform a sync request, parsing the response as it is received.
 
+        Takes the same arguments as ``sync``. Joined, invited and left rooms are
+        decoded one at a time, so memory use is bounded by the largest room rather
+        than by the whole response.
+
+        Args:
+            chunk_size (int): Optional. Number of bytes to read at a time.
+
+        Returns:
+            generator: Yields ``(path, value)`` tuples, see
+            :func:`~matrix_client.sync_stream.iter_sync_response`.
+        """
+        request = self._sync_query(since, timeout_ms, filter, full_state, set_presence)
+        response = self._send("GET", "/sync", query_params=request,
+                              api_path=MATRIX_V2_API_PATH, stream=True)
+        try:
+            for item in iter_sync_response(response.iter_content(chunk_size),
+                                           self.json_codec):
+                yield item
+        finally:
+            response.close()
+
+    def _sync_query(self, since, timeout_ms, filter, full_state, set_presence):
         request = {
             # non-integer timeouts appear to cause issues
             "timeout": int(timeout_ms)
@@ -101,8 +229,7 @@ class MatrixHttpApi(object):
         if set_presence:
             request["set_presence"] = set_presence
 
-        return self._send("GET", "/sync", query_params=request,
-                          api_path=MATRIX_V2_API_PATH)
+        return request
 
     def validate_certificate(self, valid):
         self.validate_cert = valid
@@ -516,7 +643,7 @@ class MatrixHttpApi(object):
     def kick_user(self, room_id, user_id, reason=""):
         """Calls set_membership with membership="leave" for the user_id provided
         """
-        self.set_membership(room_id, user_id, "leave", reason)
+        return self.set_membership(room_id, user_id, "leave", reason)
 
     def get_membership(self, room_id, user_id):
         """Perform GET /rooms/$room_id/state/m.room.member/$user_id
@@ -650,7 +777,7 @@ class MatrixHttpApi(object):
                           filter_params)
 
     def _send(self, method, path, content=None, query_params=None, headers=None,
-              api_path=MATRIX_V2_API_PATH):
+              api_path=MATRIX_V2_API_PATH, stream=False):
         if query_params is None:
             query_params = {}
         if headers is None:
@@ -669,32 +796,37 @@ class MatrixHttpApi(object):
         endpoint = self.base_url + api_path + path
 
         if headers["Content-Type"] == "application/json" and content is not None:
-            content = json.dumps(content)
+            content = self.json_codec.dumps(content)
 
+        endpoint_class = self.rate_limiter.classify(method, path, api_path)
         while True:
+            waittime = self.rate_limiter.reserve(endpoint_class)
+            if waittime > 0:
+                sleep(waittime)
             try:
-                response = self.session.request(
+                response = self._get_session().request(
                     method, endpoint,
                     params=query_params,
                     data=content,
                     headers=headers,
-                    verify=self.validate_cert
+                    verify=self.validate_cert,
+                    stream=stream
                 )
             except RequestException as e:
                 raise MatrixHttpLibError(e, method, endpoint)
 
             if response.status_code == 429:
-                waittime = self.default_429_wait_ms / 1000
-                try:
-                    waittime = response.json()['retry_after_ms'] / 1000
-                except KeyError:
-                    try:
-                        errordata = json.loads(response.json()['error'])
-                        waittime = errordata['retry_after_ms'] / 1000
-                    except KeyError:
-                        pass
-                sleep(waittime)
+                self.rate_limiter.rate_limited(endpoint_class,
+                                               self._get_retry_after(response.text))
+                # Streamed bodies have to be read again from the start
+                if hasattr(content, "rewind") and not content.rewind():
+                    logger.warning("Rate limited while streaming the body of %s %s, "
+                                   "which cannot be read again to retry.",
+                                   method, endpoint)
+                    raise MatrixRequestError(code=response.status_code,
+                                             content=response.text)
             else:
+                self.rate_limiter.success(endpoint_class)
                 break
 
         if response.status_code < 200 or response.status_code >= 300:
@@ -702,12 +834,42 @@ class MatrixHttpApi(object):
                 code=response.status_code, content=response.text
             )
 
-        return response.json()
+        if stream:
+            return response
+        return self.json_codec.loads(response.content)
+
+    def _get_retry_after(self, body):
+        """Return the time in seconds a HTTP 429 response asks us to wait."""
+        waittime = self.default_429_wait_ms / 1000
+        try:
+            data = json.loads(body)
+            waittime = data['retry_after_ms'] / 1000
+        except (ValueError, TypeError):
+            pass
+        except KeyError:
+            try:
+                errordata = json.loads(data['error'])
+                waittime = errordata['retry_after_ms'] / 1000
+            except (KeyError, ValueError, TypeError):
+                pass
+        return waittime
+
+    def media_upload(self, content, content_type, progress=None):
+        """Perform POST /_matrix/media/r0/upload.
 
-    def media_upload(self, content, content_type):
+        Args:
+            content (bytes|str|file|iterable): The data, a file object opened in
+                binary mode, or an iterable yielding bytes. Text is sent as UTF-8.
+                File objects are streamed from their current position with a
+                Content-Length, and iterables with chunked transfer encoding,
+                which some homeservers reject.
+            content_type (str): The mimetype of the content.
+            progress (func(sent, total)): Optional. Called as the content is sent,
+                with the number of bytes sent and the total, or None if unknown.
+        """
         return self._send(
             "POST", "",
-            content=content,
+            content=upload_body(content, progress),
             headers={"Content-Type": content_type},
             api_path="/_matrix/media/r0/upload"
         )
@@ -734,6 +896,243 @@ class MatrixHttpApi(object):
         else:
             raise ValueError("MXC URL did not begin with 'mxc://'")
 
+    def media_download(self, mxcurl, offset=0, chunk_size=65536, max_retries=3):
+        """Perform GET /_matrix/media/r0/download/{serverName}/{mediaId}, streaming
+        the content.
+
+        A transfer interrupted by a connection error is resumed where it stopped,
+        with a Range request.
+
+        Args:
+            mxcurl (str): The mxc:// URL of the content.
+            offset (int): Optional. Number of bytes to skip, e.g. those received by
+                an earlier attempt.
+            chunk_size (int): Optional. Number of bytes to read at a time.
+            max_retries (int): Optional. Number of times in a row a transfer is
+                resumed before giving up.
+
+        Returns:
+            generator: Yields the content, in chunks. The request is sent right
+            away, so that errors such as unknown content are raised by this call.
+        """
+        return self._media_stream("/_matrix/media/r0/download", self._mxc_path(mxcurl),
+                                  {}, offset, chunk_size, max_retries)
+
+    def media_thumbnail(self, mxcurl, width, height, method="scale", offset=0,
+                        chunk_size=65536, max_retries=3):
+        """Perform GET /_matrix/media/r0/thumbnail/{serverName}/{mediaId}, streaming
+        the content.
+
+        Args:
+            mxcurl (str): The mxc:// URL of the content.
+            width (int): The desired width of the thumbnail.
+            height (int): The desired height of the thumbnail. The homeserver may
+                return a larger thumbnail than requested.
+            method (str): Optional. "crop" or "scale".
+            offset, chunk_size, max_retries: As for ``media_download``.
+
+        Returns:
+            generator: Yields the thumbnail, in chunks.
+        """
+        query_params = {"width": int(width), "height": int(height), "method": method}
+        return self._media_stream("/_matrix/media/r0/thumbnail",
+                                  self._mxc_path(mxcurl), query_params, offset,
+                                  chunk_size, max_retries)
+
+    @staticmethod
+    def _mxc_path(mxcurl):
+        if not mxcurl.startswith("mxc://"):
+            raise ValueError("MXC URL did not begin with 'mxc://'")
+        return "/" + mxcurl[6:]
+
+    def media_download_file(self, mxcurl, fileobj, part_size=8 << 20, max_parallel=4,
+                            chunk_size=65536, max_retries=3):
+        """Download content into a file, fetching the parts of large content in
+        parallel.
+
+        The first request asks for the first ``part_size`` bytes. If the homeserver
+        answers with a partial response, the file is extended to the size of the
+        content and the other parts are requested concurrently through ``submit``,
+        each written at its offset. Otherwise the content is written as it comes.
+
+        Args:
+            mxcurl (str): The mxc:// URL of the content.
+            fileobj (file): A seekable file object opened in binary mode for
+                writing. The content is written from its current position.
+            part_size (int): Optional. Number of bytes requested at a time.
+            max_parallel (int): Optional. Maximum number of parts downloaded at
+                once.
+            chunk_size, max_retries: As for ``media_download``.
+
+        Returns:
+            int: The size of the content.
+
+        Raises:
+            MatrixUnexpectedResponse: If a part does not have the expected size.
+        """
+        api_path, path = "/_matrix/media/r0/download", self._mxc_path(mxcurl)
+        base = fileobj.tell()
+        lock = Lock()
+        try:
+            response = self._media_request(api_path, path, {}, 0, part_size)
+        except MatrixRequestError as e:
+            # Range Not Satisfiable: the content is empty
+            if e.code != 416:
+                raise
+            response = self._media_request(api_path, path, {}, 0)
+        start, total = self._content_range(response)
+        if start is None or total is None:
+            if start is not None:
+                # A part of unknown size, the whole content is needed instead
+                response.close()
+                response = self._media_request(api_path, path, {}, 0)
+            chunks = self._iter_media(response, api_path, path, {}, 0, chunk_size,
+                                      max_retries)
+            size = self._write_part(fileobj, lock, base, chunks)
+            fileobj.truncate(base + size)
+            return size
+
+        fileobj.truncate(base + total)
+        parts = iter([(offset, min(offset + part_size, total))
+                      for offset in range(part_size, total, part_size)])
+        failed = Event()
+        args = (fileobj, lock, base, parts, failed, api_path, path, chunk_size,
+                max_retries)
+        workers = min(max_parallel, (total + part_size - 1) // part_size) - 1
+        futures = [self.submit(self._download_parts, *args) for _ in range(workers)]
+        try:
+            stop = min(part_size, total)
+            chunks = self._iter_media(response, api_path, path, {}, 0, chunk_size,
+                                      max_retries, stop)
+            self._check_part(0, stop, self._write_part(fileobj, lock, base, chunks))
+            self._download_parts(*args)
+        except BaseException:
+            failed.set()
+            raise
+        finally:
+            # Parts left are downloaded by this thread if the pool is busy
+            for future in futures:
+                future.cancel()
+            wait(futures)
+        for future in futures:
+            if not future.cancelled():
+                future.result()
+        return total
+
+    def _download_parts(self, fileobj, lock, base, parts, failed, api_path, path,
+                        chunk_size, max_retries):
+        while not failed.is_set():
+            with lock:
+                part = next(parts, None)
+            if part is None:
+                return
+            start, stop = part
+            try:
+                response = self._media_request(api_path, path, {}, start, stop)
+                chunks = self._iter_media(response, api_path, path, {}, start,
+                                          chunk_size, max_retries, stop)
+                self._check_part(start, stop,
+                                 self._write_part(fileobj, lock, base + start, chunks))
+            except BaseException:
+                failed.set()
+                raise
+
+    @staticmethod
+    def _write_part(fileobj, lock, offset, chunks):
+        written = 0
+        for chunk in chunks:
+            with lock:
+                fileobj.seek(offset + written)
+                fileobj.write(chunk)
+            written += len(chunk)
+        return written
+
+    @staticmethod
+    def _check_part(start, stop, written):
+        if written != stop - start:
+            raise MatrixUnexpectedResponse(
+                "Received %d bytes instead of %d for bytes %d-%d." %
+                (written, stop - start, start, stop - 1)
+            )
+
+    @staticmethod
+    def _content_range(response):
+        """Return the first byte and the total size of a partial response. Either is
+        None if unknown."""
+        if response is None or response.status_code != 206:
+            return None, None
+        match = re.match(r"bytes (\d+)-\d+/(\d+|\*)",
+                         response.headers.get("Content-Range", ""))
+        if match is None:
+            return None, None
+        total = match.group(2)
+        return int(match.group(1)), None if total == "*" else int(total)
+
+    def _media_stream(self, api_path, path, query_params, offset, chunk_size,
+                      max_retries):
+        response = self._media_request(api_path, path, query_params, offset)
+        return self._iter_media(response, api_path, path, query_params, offset,
+                                chunk_size, max_retries)
+
+    def _media_request(self, api_path, path, query_params, offset, stop=None):
+        headers = {}
+        if offset or stop is not None:
+            headers["Range"] = "bytes=%d-%s" % (offset, "" if stop is None else stop - 1)
+        try:
+            return self._send("GET", path, query_params=dict(query_params),
+                              headers=headers, api_path=api_path, stream=True)
+        except MatrixRequestError as e:
+            # Range Not Satisfiable: there is nothing past the offset
+            if e.code == 416 and offset:
+                return None
+            raise
+
+    def _iter_media(self, response, api_path, path, query_params, offset, chunk_size,
+                    max_retries, stop=None):
+        retries = max_retries
+        position = offset
+        while response is not None and position != stop:
+            start = self._content_range(response)[0]
+            if start is not None and start != position:
+                response.close()
+                raise MatrixUnexpectedResponse(
+                    "Partial content starting at byte %d instead of %d." %
+                    (start, position)
+                )
+            # A server ignoring the Range header sends the content from the start
+            skip = position if response.status_code == 200 else 0
+            received = 0
+            try:
+                for chunk in response.iter_content(chunk_size):
+                    received += len(chunk)
+                    if skip:
+                        if len(chunk) <= skip:
+                            skip -= len(chunk)
+                            continue
+                        chunk, skip = chunk[skip:], 0
+                    if stop is not None:
+                        chunk = chunk[:stop - position]
+                    position += len(chunk)
+                    retries = max_retries
+                    if chunk:
+                        yield chunk
+                    if position == stop:
+                        return
+                length = response.headers.get("Content-Length")
+                if (length is not None and received < int(length) and
+                        "Content-Encoding" not in response.headers):
+                    raise RequestException("Connection closed after %d of %s bytes" %
+                                           (received, length))
+                return
+            except RequestException as e:
+                if not retries:
+                    raise MatrixHttpLibError(e, "GET", self.base_url + api_path + path)
+                retries -= 1
+            finally:
+                response.close()
+            response = self._media_request(api_path, path, query_params, position,
+                                           stop)
+
     def get_room_id(self, room_alias):
         """Get room id from its alias
 
@@ -950,6 +1349,7 @@ class MatrixHttpApi(object):
         )
 
     def _make_txn_id(self):
-        txn_id = str(self.txn_id) + str(int(time() * 1000))
-        self.txn_id += 1
+        with self._txn_lock:
+            txn_id = str(self.txn_id) + str(int(time() * 1000))
+            self.txn_id += 1
         return txn_id
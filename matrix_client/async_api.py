@@ -0,0 +1,258 @@
+# -*- coding: utf-8 -*-
+# Copyright 2015 OpenMarket Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import asyncio
+import io
+
+import aiohttp
+
+from .api import MatrixHttpApi, MATRIX_V2_API_PATH
+from .errors import MatrixError, MatrixRequestError, MatrixHttpLibError
+
+try:
+    from urllib import quote
+except ImportError:
+    from urllib.parse import quote
+
+
+class _unsupported(object):
+    """Hides a method inherited from the blocking API, so that accessing it raises
+    AttributeError as if it was not defined."""
+
+    def __init__(self, feature):
+        self.feature = feature
+
+    def __get__(self, instance, owner=None):
+        raise AttributeError("%s is not supported by the asyncio API." %
+                             self.feature.capitalize())
+
+
+class AsyncMatrixHttpApi(MatrixHttpApi):
+    """Contains all raw Matrix HTTP Client-Server API calls, as coroutines.
+
+    Every method of :class:`~matrix_client.api.MatrixHttpApi` is available and
+    returns an awaitable instead of the decoded response, except those streaming
+    responses: ``sync_stream`` and the ``media_download`` family.
+
+    Args:
+        base_url (str): The home server URL e.g. 'http://localhost:8008'
+        token (str): Optional. The client's access token.
+        identity (str): Optional. The mxid to act as (For application services only).
+        default_429_wait_ms (int): Optional. Time in millseconds to wait before retrying
+                                             a request when server returns a HTTP 429
+                                             response without a 'retry_after_ms' key.
+        rate_limiter (RateLimiter): Optional. Client-side rate limiter.
+        json_codec (str|JsonCodec): Optional. Codec for request and response bodies.
+        session (aiohttp.ClientSession): Optional. A session to send requests with.
+            Sharing one session between many instances lets them share a connection
+            pool. If omitted, one is created on first use and closed by ``close``.
+
+    Examples:
+        Create a client and send a message::
+
+            matrix = AsyncMatrixHttpApi("https://matrix.org", token="foobar")
+            response = await matrix.sync()
+            response = await matrix.send_message("!roomid:matrix.org", "Hello!")
+            await matrix.close()
+    """
+
+    def __init__(self, base_url, token=None, identity=None, default_429_wait_ms=5000,
+                 rate_limiter=None, json_codec=None, session=None):
+        super(AsyncMatrixHttpApi, self).__init__(base_url, token, identity,
+                                                 default_429_wait_ms, rate_limiter,
+                                                 json_codec)
+        self.session = session
+        self._owns_session = session is None
+
+    async def close(self):
+        """Close the underlying session, if it was created by this instance."""
+        if self._owns_session and self.session is not None:
+            await self.session.close()
+            self.session = None
+
+    def submit(self, method, *args, **kwargs):
+        """Schedule an API call on the event loop, instead of a thread pool.
+
+        Args:
+            method (str|func): The name of a method of this instance, e.g.
+                "invite_user", or any coroutine function.
+            *args: Arguments of the method.
+            **kwargs: Keyword arguments of the method.
+
+        Returns:
+            asyncio.Future: The result of the call.
+        """
+        if not callable(method):
+            method = getattr(self, method)
+        return asyncio.ensure_future(method(*args, **kwargs))
+
+    async def map(self, method, *iterables):
+        """Call an API method once per set of arguments, concurrently.
+
+        Args:
+            method (str|func): As for ``submit``.
+            *iterables: Iterables of the positional arguments, as for the
+                builtin ``map``.
+
+        Returns:
+            list: The results, in the order of the arguments.
+
+        Raises:
+            The exception of the first call which failed.
+        """
+        return await asyncio.gather(*[self.submit(method, *args)
+                                      for args in zip(*iterables)])
+
+    # Streamed responses have no asyncio counterpart yet
+    sync_stream = _unsupported("streaming sync")
+    media_download = _unsupported("streaming downloads")
+    media_thumbnail = _unsupported("streaming downloads")
+    media_download_file = _unsupported("streaming downloads")
+
+    async def media_upload(self, content, content_type):
+        """Perform POST /_matrix/media/r0/upload.
+
+        aiohttp streams file objects and async iterables given as ``content``.
+        """
+        return await self._send(
+            "POST", "",
+            content=content,
+            headers={"Content-Type": content_type},
+            api_path="/_matrix/media/r0/upload"
+        )
+
+    async def kick_user(self, room_id, user_id, reason=""):
+        """Calls set_membership with membership="leave" for the user_id provided
+        """
+        return await self.set_membership(room_id, user_id, "leave", reason)
+
+    async def get_display_name(self, user_id):
+        content = await self._send("GET", "/profile/%s/displayname" % user_id)
+        return content.get('displayname', None)
+
+    async def get_avatar_url(self, user_id):
+        content = await self._send("GET", "/profile/%s/avatar_url" % user_id)
+        return content.get('avatar_url', None)
+
+    async def get_room_id(self, room_alias):
+        """Get room id from its alias
+
+        Args:
+            room_alias (str): The room alias name.
+
+        Returns:
+            Wanted room's id.
+        """
+        content = await self._send("GET", "/directory/room/{}".format(quote(room_alias)))
+        return content.get("room_id", None)
+
+    async def _send(self, method, path, content=None, query_params=None, headers=None,
+                    api_path=MATRIX_V2_API_PATH):
+        if query_params is None:
+            query_params = {}
+        if headers is None:
+            headers = {}
+        method = method.upper()
+        if method not in ["GET", "PUT", "DELETE", "POST"]:
+            raise MatrixError("Unsupported HTTP method: %s" % method)
+
+        if "Content-Type" not in headers:
+            headers["Content-Type"] = "application/json"
+
+        query_params["access_token"] = self.token
+        if self.identity:
+            query_params["user_id"] = self.identity
+        # aiohttp refuses None values, requests silently drops them
+        query_params = {k: v for k, v in query_params.items() if v is not None}
+
+        endpoint = self.base_url + api_path + path
+
+        if headers["Content-Type"] == "application/json" and content is not None:
+            content = self.json_codec.dumps(content)
+
+        if self.session is None:
+            self.session = aiohttp.ClientSession()
+
+        data = content
+        start = None
+        if hasattr(content, "read"):
+            try:
+                start = content.tell()
+            except (AttributeError, IOError, OSError):
+                # e.g. a pipe, which cannot be sent again after a 429
+                pass
+            else:
+                data = _KeepOpen(content)
+
+        endpoint_class = self.rate_limiter.classify(method, path, api_path)
+        while True:
+            waittime = self.rate_limiter.reserve(endpoint_class)
+            if waittime > 0:
+                await asyncio.sleep(waittime)
+            try:
+                async with self.session.request(
+                    method, endpoint,
+                    params=query_params,
+                    data=data,
+                    headers=headers,
+                    ssl=None if self.validate_cert else False
+                ) as response:
+                    status = response.status
+                    body = await response.read()
+            except aiohttp.ClientError as e:
+                raise MatrixHttpLibError(e, method, endpoint)
+
+            if status == 429:
+                self.rate_limiter.rate_limited(endpoint_class,
+                                               self._get_retry_after(body.decode()))
+                if hasattr(content, "read"):
+                    if start is None:
+                        # Consumed: the 429 is raised below
+                        break
+                    content.seek(start)
+            else:
+                self.rate_limiter.success(endpoint_class)
+                break
+
+        if status < 200 or status >= 300:
+            raise MatrixRequestError(code=status,
+                                     content=body.decode("utf-8", "replace"))
+
+        return self.json_codec.loads(body)
+
+
+class _KeepOpen(io.IOBase):
+    """Wraps a file body, which aiohttp closes once sent, so that it can be sent
+    again after a 429."""
+
+    def __init__(self, fileobj):
+        self._file = fileobj
+
+    def readable(self):
+        return True
+
+    def read(self, size=-1):
+        return self._file.read(size)
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        return self._file.seek(offset, whence)
+
+    def tell(self):
+        return self._file.tell()
+
+    def fileno(self):
+        return self._file.fileno()
+
+    def close(self):
+        pass
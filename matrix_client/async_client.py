@@ -0,0 +1,758 @@
+# -*- coding: utf-8 -*-
+# Copyright 2015 OpenMarket Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import asyncio
+import logging
+from collections import OrderedDict
+
+from .async_api import AsyncMatrixHttpApi, _unsupported
+from .checks import check_user_id
+from .client import MatrixClient, CACHE
+from .errors import MatrixError, MatrixRequestError, MatrixUnexpectedResponse
+from .filter import filter_to_dict
+from .room import Room
+from .upload_cache import content_hash
+from .user import User, _MISSING
+
+logger = logging.getLogger(__name__)
+
+
+class AsyncUser(User):
+    """ A User whose API calls are coroutines.
+    """
+
+    async def get_display_name(self):
+        """ Get this users display name.
+            See also get_friendly_name()
+
+        Returns:
+            str: Display Name
+        """
+        if not self.displayname:
+            self.displayname = await self._fetch_display_name()
+        return self.displayname
+
+    async def _fetch_display_name(self):
+        display_name = self._cached("displayname")
+        if display_name is _MISSING:
+            display_name = await self.api.get_display_name(self.user_id)
+            self._cache("displayname", display_name)
+        return display_name
+
+    async def get_friendly_name(self):
+        display_name = await self._fetch_display_name()
+        return display_name if display_name is not None else self.user_id
+
+    async def set_display_name(self, display_name):
+        """ Set this users display name.
+
+        Args:
+            display_name (str): Display Name
+        """
+        self.displayname = display_name
+        response = await self.api.set_display_name(self.user_id, display_name)
+        self._cache("displayname", display_name)
+        return response
+
+    async def get_avatar_url(self):
+        mxcurl = self._cached("avatar_url")
+        if mxcurl is _MISSING:
+            mxcurl = await self.api.get_avatar_url(self.user_id)
+            self._cache("avatar_url", mxcurl)
+        url = None
+        if mxcurl is not None:
+            url = self.api.get_download_url(mxcurl)
+        return url
+
+    async def set_avatar_url(self, avatar_url):
+        """ Set this users avatar.
+
+        Args:
+            avatar_url (str): mxc url from previously uploaded
+        """
+        response = await self.api.set_avatar_url(self.user_id, avatar_url)
+        self._cache("avatar_url", avatar_url)
+        return response
+
+
+class AsyncRoom(Room):
+    """A Room whose API calls are coroutines.
+
+    Methods which only forward to the API (``send_text``, ``send_state_event``...)
+    are inherited and return awaitables. Methods which interpret the response are
+    overridden here.
+    """
+
+    _user_class = AsyncUser
+
+    # Sending does not block: run send coroutines concurrently instead
+    queue_event = _unsupported("send queues")
+    queue_text = _unsupported("send queues")
+    queue_html = _unsupported("send queues")
+
+    @property
+    def display_name(self):
+        """Calculates the display name for a room from cached state only."""
+        if self.name:
+            return self.name
+        elif self.canonical_alias:
+            return self.canonical_alias
+        if self._members_name is None:
+            self._members_name = self._calculate_members_name(lambda: self._members)
+        return self._members_name
+
+    async def set_user_profile(self,
+                               displayname=None,
+                               avatar_url=None,
+                               reason="Changing room profile information"):
+        """Set user profile within a room.
+
+        This sets displayname and avatar_url for the logged in user only in a
+        specific room. It does not change the user's global user profile.
+        """
+        member = await self.client.api.get_membership(self.room_id,
+                                                      self.client.user_id)
+        if member["membership"] != "join":
+            raise Exception("Can't set profile if you have not joined the room.")
+        if displayname is None:
+            displayname = member["displayname"]
+        if avatar_url is None:
+            avatar_url = member["avatar_url"]
+        await self.client.api.set_membership(
+            self.room_id,
+            self.client.user_id,
+            'join',
+            reason, {
+                "displayname": displayname,
+                "avatar_url": avatar_url
+            }
+        )
+
+    async def _try(self, coro):
+        try:
+            await coro
+            return True
+        except MatrixRequestError:
+            return False
+
+    async def _bulk(self, method, user_ids, args=(), max_concurrency=None):
+        semaphore = asyncio.Semaphore(max(1, max_concurrency or
+                                          self.client.api.max_workers))
+
+        async def call(user_id):
+            async with semaphore:
+                try:
+                    return await method(self.room_id, user_id, *args)
+                except MatrixError as e:
+                    return e
+
+        user_ids = list(OrderedDict.fromkeys(user_ids))
+        results = await asyncio.gather(*[call(user_id) for user_id in user_ids])
+        return OrderedDict(zip(user_ids, results))
+
+    async def invite_user(self, user_id):
+        """Invite a user to this room.
+
+        Returns:
+            boolean: Whether invitation was sent.
+        """
+        return await self._try(self.client.api.invite_user(self.room_id, user_id))
+
+    async def kick_user(self, user_id, reason=""):
+        """Kick a user from this room.
+
+        Returns:
+            boolean: Whether user was kicked.
+        """
+        return await self._try(self.client.api.kick_user(self.room_id, user_id))
+
+    async def ban_user(self, user_id, reason):
+        """Ban a user from this room
+
+        Returns:
+            boolean: The user was banned.
+        """
+        return await self._try(self.client.api.ban_user(self.room_id, user_id, reason))
+
+    async def unban_user(self, user_id):
+        """Unban a user from this room
+
+        Returns:
+            boolean: The user was unbanned.
+        """
+        return await self._try(self.client.api.unban_user(self.room_id, user_id))
+
+    async def leave(self):
+        """Leave the room.
+
+        Returns:
+            boolean: Leaving the room was successful.
+        """
+        if await self._try(self.client.api.leave_room(self.room_id)):
+            self.client._forget_room(self.room_id)
+            return True
+        return False
+
+    async def update_room_name(self):
+        """Updates self.name and returns True if room name has changed."""
+        try:
+            response = await self.client.api.get_room_name(self.room_id)
+        except MatrixRequestError:
+            return False
+        if "name" in response and response["name"] != self.name:
+            self.name = response["name"]
+            return True
+        return False
+
+    async def set_room_name(self, name):
+        """Return True if room name successfully changed."""
+        if await self._try(self.client.api.set_room_name(self.room_id, name)):
+            self.name = name
+            return True
+        return False
+
+    async def update_room_topic(self):
+        """Updates self.topic and returns True if room topic has changed."""
+        try:
+            response = await self.client.api.get_room_topic(self.room_id)
+        except MatrixRequestError:
+            return False
+        if "topic" in response and response["topic"] != self.topic:
+            self.topic = response["topic"]
+            return True
+        return False
+
+    async def set_room_topic(self, topic):
+        """Set room topic.
+
+        Returns:
+            boolean: True if the topic changed, False if not
+        """
+        if await self._try(self.client.api.set_room_topic(self.room_id, topic)):
+            self.topic = topic
+            return True
+        return False
+
+    async def update_aliases(self):
+        """Get aliases information from room state.
+
+        Returns:
+            boolean: True if the aliases changed, False if not
+        """
+        try:
+            response = await self.client.api.get_room_state(self.room_id)
+        except MatrixRequestError:
+            return False
+        for chunk in response:
+            if "content" in chunk and "aliases" in chunk["content"]:
+                if chunk["content"]["aliases"] != self.aliases:
+                    self.aliases = chunk["content"]["aliases"]
+                    return True
+                else:
+                    return False
+
+    async def add_room_alias(self, room_alias):
+        """Add an alias to the room and return True if successful."""
+        return await self._try(self.client.api.set_room_alias(self.room_id, room_alias))
+
+    async def get_joined_members(self):
+        """Returns list of joined members (User objects)."""
+        if self.members:
+            return self._members
+        response = await self.client.api.get_room_members(self.room_id)
+        for event in response["chunk"]:
+            if event["content"]["membership"] == "join":
+                self._mkmembers(
+                    self._mkuser(event["state_key"], event["content"].get("displayname"))
+                )
+        return self._members
+
+    async def get_events(self):
+        """Get the most recent events for this room.
+
+        If they were evicted by the client's ``event_cache``, they are fetched
+        from the homeserver again.
+        """
+        if self.events.evicted and self.client.sync_token:
+            self._restore_events(await self.client.api.get_room_messages(
+                self.room_id, self.client.sync_token, direction="b",
+                limit=self.event_history_limit))
+        return list(self.events)
+
+    async def backfill_previous_messages(self, reverse=False, limit=10):
+        """Backfill handling of previous messages.
+
+        Args:
+            reverse (bool): When false messages will be backfilled in their original
+                order (old to new), otherwise the order will be reversed (new to old).
+            limit (int): Number of messages to go back.
+        """
+        res = await self.client.api.get_room_messages(self.room_id, self.prev_batch,
+                                                      direction="b", limit=limit)
+        events = res["chunk"]
+        if not reverse:
+            events = reversed(events)
+        for event in events:
+            self._put_event(event)
+
+    async def modify_user_power_levels(self, users=None, users_default=None):
+        """Modify the power level for a subset of users
+
+        See :meth:`Room.modify_user_power_levels`.
+
+        Returns:
+            True if successful, False if not
+        """
+        try:
+            content = await self.client.api.get_power_levels(self.room_id)
+        except MatrixRequestError:
+            return False
+        if users_default:
+            content["users_default"] = users_default
+
+        if users:
+            if "users" in content:
+                content["users"].update(users)
+            else:
+                content["users"] = users
+
+            # Remove any keys with value None
+            for user, power_level in list(content["users"].items()):
+                if power_level is None:
+                    del content["users"][user]
+        return await self._try(self.client.api.set_power_levels(self.room_id, content))
+
+    async def modify_required_power_levels(self, events=None, **kwargs):
+        """Modifies room power level requirements.
+
+        See :meth:`Room.modify_required_power_levels`.
+
+        Returns:
+            True if successful, False if not
+        """
+        try:
+            content = await self.client.api.get_power_levels(self.room_id)
+        except MatrixRequestError:
+            return False
+        content.update(kwargs)
+        for key, value in list(content.items()):
+            if value is None:
+                del content[key]
+
+        if events:
+            if "events" in content:
+                content["events"].update(events)
+            else:
+                content["events"] = events
+
+            # Remove any keys with value None
+            for event, power_level in list(content["events"].items()):
+                if power_level is None:
+                    del content["events"][event]
+
+        return await self._try(self.client.api.set_power_levels(self.room_id, content))
+
+    async def set_invite_only(self, invite_only):
+        """Set how the room can be joined.
+
+        Returns:
+            True if successful, False if not
+        """
+        join_rule = "invite" if invite_only else "public"
+        if await self._try(self.client.api.set_join_rule(self.room_id, join_rule)):
+            self.invite_only = invite_only
+            return True
+        return False
+
+    async def set_guest_access(self, allow_guests):
+        """Set whether guests can join the room and return True if successful."""
+        guest_access = "can_join" if allow_guests else "forbidden"
+        if await self._try(self.client.api.set_guest_access(self.room_id,
+                                                            guest_access)):
+            self.guest_access = allow_guests
+            return True
+        return False
+
+    async def enable_encryption(self):
+        """Enables encryption in the room.
+
+        NOTE: Once enabled, encryption cannot be disabled.
+
+        Returns:
+        True if successful, False if not
+        """
+        if await self._try(self.send_state_event("m.room.encryption",
+                                                 {"algorithm": "m.megolm.v1.aes-sha2"})):
+            self.encrypted = True
+            return True
+        return False
+
+
+class AsyncMatrixClient(MatrixClient):
+    """
+    The asyncio client API for Matrix. For the raw HTTP calls, see AsyncMatrixHttpApi.
+
+    /sync processing and listener dispatch run on the event loop, so many clients
+    can share a single thread (and, through ``session``, a single connection pool).
+    Listener callbacks are plain callables invoked from the event loop and must not
+    block.
+
+    Unlike :class:`MatrixClient`, supplying a token does not sync from the
+    constructor; await :meth:`listen_for_events` or start a listener task instead.
+
+    ``download``, ``thumbnail`` and the ``media_cache`` are not available, as they
+    stream media with blocking I/O.
+
+    Args:
+        base_url (str): The url of the HS preceding /_matrix.
+            e.g. (ex: https://localhost:8008 )
+        token (Optional[str]): If you have an access token
+            supply it here.
+        user_id (Optional[str]): You must supply the user_id
+            (as obtained when initially logging in to obtain
+            the token) if supplying a token; otherwise, ignored.
+        valid_cert_check (bool): Check the homeservers
+            certificate on connections?
+        cache_level (CACHE): One of CACHE.NONE, CACHE.SOME, or
+            CACHE.ALL (defined in module namespace).
+        upload_filter (bool): Optional. Only send the ID of the uploaded sync filter.
+        filter_cache_path (str): Optional. File remembering uploaded filter IDs.
+        auto_filter (bool): Optional. Restrict the sync filter to what listeners need.
+        event_cache (EventCache): Optional. Budget shared by the room timelines.
+        store (StateStore): Optional. Where to persist the client state.
+        checkpoint (bool): Optional. Only advance the sync token once a batch has
+            been dispatched, without dispatching events twice.
+        profile_cache (ProfileCache): Optional. Cache of user profiles.
+        session (aiohttp.ClientSession): Optional. Session shared with other clients.
+        upload_cache (UploadCache): Optional. Deduplicates ``upload`` by hash.
+
+    Raises:
+        `ValueError`
+
+    Examples:
+
+        Listen for messages with a logged in user::
+
+            client = AsyncMatrixClient("https://matrix.org", token="foobar",
+                user_id="@foobar:matrix.org")
+            client.add_listener(func)
+            await client.listen_forever()
+    """
+
+    _room_class = AsyncRoom
+    _user_class = AsyncUser
+
+    # Downloads are streamed by the blocking API only, see AsyncMatrixHttpApi
+    download = _unsupported("downloads")
+    thumbnail = _unsupported("thumbnails")
+    # Replaced by start_listener_task and stop_listener_task
+    start_listener_thread = _unsupported("listener threads")
+    stop_listener_thread = _unsupported("listener threads")
+    # Sending does not block: run send coroutines concurrently instead
+    send_queue = _unsupported("send queues")
+
+    def __init__(self, base_url, token=None, user_id=None,
+                 valid_cert_check=True, sync_filter_limit=20,
+                 cache_level=CACHE.ALL, upload_filter=True, filter_cache_path=None,
+                 auto_filter=False, event_cache=None, store=None, checkpoint=False,
+                 profile_cache=None, session=None, upload_cache=None):
+        if token is not None and user_id is None:
+            raise ValueError("must supply user_id along with token")
+        super(AsyncMatrixClient, self).__init__(
+            base_url, valid_cert_check=valid_cert_check,
+            sync_filter_limit=sync_filter_limit, cache_level=cache_level,
+            upload_filter=upload_filter, filter_cache_path=filter_cache_path,
+            auto_filter=auto_filter, event_cache=event_cache, store=store,
+            checkpoint=checkpoint, profile_cache=profile_cache,
+            upload_cache=upload_cache
+        )
+        self.api = AsyncMatrixHttpApi(base_url, token, session=session)
+        self.api.validate_certificate(valid_cert_check)
+        self.sync_task = None
+        if token:
+            check_user_id(user_id)
+            self.user_id = user_id
+
+    async def close(self):
+        """Stop listening and release the HTTP session."""
+        await self.stop_listener_task()
+        await self.api.close()
+
+    async def register_as_guest(self):
+        """ Register a guest account on this HS.
+        Note: HS must have guest registration enabled.
+        Returns:
+            str: Access Token
+        Raises:
+            MatrixRequestError
+        """
+        response = await self.api.register(kind='guest')
+        return await self._post_registration(response)
+
+    async def register_with_password(self, username, password):
+        """ Register for a new account on this HS.
+
+        Args:
+            username (str): Account username
+            password (str): Account password
+
+        Returns:
+            str: Access Token
+
+        Raises:
+            MatrixRequestError
+        """
+        response = await self.api.register(
+            {
+                "auth": {"type": "m.login.dummy"},
+                "username": username,
+                "password": password
+            }
+        )
+        return await self._post_registration(response)
+
+    async def _post_registration(self, response):
+        self.user_id = response["user_id"]
+        self.token = response["access_token"]
+        self.hs = response["home_server"]
+        self.api.token = self.token
+        await self._sync(timeout_ms=0)
+        return self.token
+
+    async def login(self, username, password, limit=10, sync=True, device_id=None):
+        """Login to the homeserver.
+
+        Args:
+            username (str): Account username
+            password (str): Account password
+            limit (int): Deprecated. How many messages to return when syncing.
+            sync (bool): Optional. Whether to initiate a /sync request after logging in.
+            device_id (str): Optional. ID of the client device. The server will
+                auto-generate a device_id if this is not specified.
+
+        Returns:
+            str: Access token
+
+        Raises:
+            MatrixRequestError
+        """
+        response = await self.api.login(
+            "m.login.password", user=username, password=password, device_id=device_id
+        )
+        self.user_id = response["user_id"]
+        self.token = response["access_token"]
+        self.hs = response["home_server"]
+        self.api.token = self.token
+        self.device_id = response["device_id"]
+
+        if sync:
+            self.sync_filter = '{ "room": { "timeline" : { "limit" : %i } } }' % limit
+            await self._sync(timeout_ms=0)
+        return self.token
+
+    async def logout(self):
+        """ Logout from the homeserver.
+        """
+        await self.stop_listener_task()
+        await self.api.logout()
+
+    async def create_room(self, alias=None, is_public=False, invitees=None):
+        """ Create a new room on the homeserver.
+
+        Returns:
+            AsyncRoom
+
+        Raises:
+            MatrixRequestError
+        """
+        response = await self.api.create_room(alias, is_public, invitees)
+        return self._mkroom(response["room_id"])
+
+    async def join_room(self, room_id_or_alias):
+        """ Join a room.
+
+        Returns:
+            AsyncRoom
+
+        Raises:
+            MatrixRequestError
+        """
+        response = await self.api.join_room(room_id_or_alias)
+        room_id = (
+            response["room_id"] if "room_id" in response else room_id_or_alias
+        )
+        return self._mkroom(room_id)
+
+    async def listen_for_events(self, timeout_ms=30000):
+        """Perform a single /sync and dispatch its events.
+
+        Args:
+            timeout_ms (int): How long to poll the Home Server for before
+               retrying.
+        """
+        await self._sync(timeout_ms)
+
+    async def listen_forever(self, timeout_ms=30000, exception_handler=None,
+                             bad_sync_timeout=5):
+        """ Keep listening for events forever.
+
+        Args:
+            timeout_ms (int): How long to poll the Home Server for before
+               retrying.
+            exception_handler (func(exception)): Optional exception handler
+               function which can be used to handle exceptions in the caller
+               task.
+            bad_sync_timeout (int): Base time to wait after an error before
+                retrying. Will be increased according to exponential backoff.
+        """
+        _bad_sync_timeout = bad_sync_timeout
+        self.should_listen = True
+        while (self.should_listen):
+            try:
+                await self._sync(timeout_ms)
+                _bad_sync_timeout = bad_sync_timeout
+            except asyncio.CancelledError:
+                raise
+            except MatrixRequestError as e:
+                logger.warning("A MatrixRequestError occured during sync.")
+                if e.code >= 500:
+                    logger.warning("Problem occured serverside. Waiting %i seconds",
+                                   _bad_sync_timeout)
+                    await asyncio.sleep(_bad_sync_timeout)
+                    _bad_sync_timeout = min(_bad_sync_timeout * 2,
+                                            self.bad_sync_timeout_limit)
+                elif exception_handler is not None:
+                    exception_handler(e)
+                else:
+                    raise
+            except Exception as e:
+                logger.exception("Exception thrown during sync")
+                if exception_handler is not None:
+                    exception_handler(e)
+                else:
+                    raise
+
+    def start_listener_task(self, timeout_ms=30000, exception_handler=None):
+        """ Start a task on the running event loop to listen for events.
+
+        Args:
+            timeout_ms (int): How long to poll the Home Server for before
+               retrying.
+            exception_handler (func(exception)): Optional exception handler
+               function which can be used to handle exceptions in the task.
+
+        Returns:
+            asyncio.Task: The listener task.
+        """
+        self.should_listen = True
+        self.sync_task = asyncio.ensure_future(
+            self.listen_forever(timeout_ms, exception_handler))
+        return self.sync_task
+
+    async def stop_listener_task(self):
+        """ Stop the listener task, cancelling any /sync in flight.
+        """
+        if self.sync_task:
+            self.should_listen = False
+            self.sync_task.cancel()
+            try:
+                await self.sync_task
+            except asyncio.CancelledError:
+                pass
+            self.sync_task = None
+
+    async def upload(self, content, content_type):
+        """ Upload content to the home server and recieve a MXC url.
+
+        Args:
+            content (bytes): The data of the content.
+            content_type (str): The mimetype of the content.
+
+        Bytes and seekable files are deduplicated through the ``upload_cache``.
+
+        Raises:
+            MatrixUnexpectedResponse: If the homeserver gave a strange response
+            MatrixRequestError: If the upload failed for some reason.
+        """
+        sha256 = None
+        if self.upload_cache is not None:
+            sha256 = content_hash(content)
+            if sha256 is not None:
+                content_uri = self.upload_cache.get(sha256, content_type)
+                if content_uri is not None:
+                    return content_uri
+        try:
+            response = await self.api.media_upload(content, content_type)
+        except MatrixRequestError as e:
+            raise MatrixRequestError(
+                code=e.code,
+                content="Upload failed: %s" % e
+            )
+        if "content_uri" in response:
+            if sha256 is not None:
+                self.upload_cache.set(sha256, content_type, response["content_uri"])
+            return response["content_uri"]
+        raise MatrixUnexpectedResponse(
+            "The upload was successful, but content_uri wasn't found."
+        )
+
+    async def upload_file(self, path, content_type):
+        """ Upload a file to the home server and recieve a MXC url.
+
+        Args:
+            path (str): The file, streamed by aiohttp.
+            content_type (str): The mimetype of the content.
+        """
+        with open(path, "rb") as f:
+            return await self.upload(f, content_type)
+
+    async def _sync(self, timeout_ms=30000):
+        self._load_store()
+        sync_filter = await self._get_sync_filter()
+        try:
+            response = await self.api.sync(self.sync_token, timeout_ms,
+                                           filter=sync_filter)
+        except MatrixRequestError as e:
+            if not self._filter_rejected(e, sync_filter):
+                raise
+            response = await self.api.sync(self.sync_token, timeout_ms,
+                                           filter=await self._get_sync_filter())
+        self._handle_sync(response)
+
+    async def _get_sync_filter(self):
+        definition = self._effective_sync_filter()
+        sync_filter, sync_filter_hash = self._cached_sync_filter(definition)
+        if sync_filter_hash is None:
+            return sync_filter
+        try:
+            response = await self.api.create_filter(
+                self.user_id, filter_to_dict(definition))
+        except MatrixRequestError as e:
+            return self._filter_upload_failed(e, sync_filter)
+        return self._filter_uploaded(sync_filter_hash, response)
+
+    async def remove_room_alias(self, room_alias):
+        """Remove mapping of an alias
+
+        Args:
+            room_alias(str): The alias to be removed.
+
+        Returns:
+            bool: True if the alias is removed, False otherwise.
+        """
+        try:
+            await self.api.remove_room_alias(room_alias)
+            return True
+        except MatrixRequestError:
+            return False
@@ -14,18 +14,33 @@
 # limitations under the License.
 from .api import MatrixHttpApi
 from .checks import check_user_id
+from .dedup import DedupIndex
 from .errors import MatrixRequestError, MatrixUnexpectedResponse
-from .room import Room
+from .executor import ShardedExecutor
+from .filter import (FilterCache, canonical_filter, filter_for_listeners, filter_hash,
+                     filter_includes, filter_to_dict, is_filter_id)
+from .listeners import ListenerRegistry
+from .media_cache import iter_file
+from .profiles import ProfileCache
+from .room import Room, TRACKED_STATE_EVENTS
+from .send_queue import SendQueue
+from .sync_pipeline import SyncPipeline
+from .upload import MappedFile
+from .upload_cache import content_hash, iter_hashed
 from .user import User
 try:
     from .crypto.olm_device import OlmDevice
     ENCRYPTION_SUPPORT = True
 except ImportError:
     ENCRYPTION_SUPPORT = False
-from threading import Thread
+from functools import partial
+from threading import Lock, Thread
 from time import sleep
 from uuid import uuid4
 from warnings import warn
+from weakref import WeakValueDictionary
+import hashlib
+import json
 import logging
 import sys
 
@@ -66,6 +81,67 @@ class MatrixClient(object):
         encryption_conf (dict): Optional. Configuration parameters for encryption.
             Refer to :func:`~matrix_client.crypto.olm_device.OlmDevice` for supported
             options, since it will be passed to this class.
+        streaming_sync (bool): Optional. Parse /sync responses incrementally and
+            process every room as soon as it is decoded. This bounds memory use by
+            the largest room and delivers the first events sooner on large syncs.
+        upload_filter (bool): Optional. Register ``sync_filter`` with the homeserver
+            and only send its ID with each /sync. Defaults to True.
+        filter_cache_path (str): Optional. File in which to remember the IDs of
+            uploaded filters across restarts.
+        auto_filter (bool): Optional. Restrict ``sync_filter`` to the event types
+            listeners are registered for, plus the state cached on rooms. The filter
+            is rebuilt whenever listeners change. Note that ``Room.events`` will then
+            only hold events of those types.
+        listener_workers (int): Optional. Run listener callbacks on this many worker
+            threads instead of the sync thread. Callbacks for events of the same room
+            still run one at a time, in order. Defaults to 0, running them inline.
+        listener_queue_size (int): Optional. Maximum number of pending callbacks per
+            worker. Syncing blocks while a worker's queue is full.
+        event_cache (EventCache): Optional. A budget shared by the timelines of all
+            rooms. Once exceeded, the timelines of the least recently active rooms
+            are dropped, and fetched again by ``Room.get_events``.
+        store (StateStore): Optional. Where to persist the sync token and room state
+            after every sync. They are loaded back before the first sync, which
+            is then incremental. See :class:`~matrix_client.store.SQLiteStore`.
+        checkpoint (bool): Optional. Only advance ``sync_token``, and save it to the
+            ``store``, once every listener of a batch has returned. The events
+            dispatched are recorded for each kind of listener, in the store if it
+            supports it, so no listener gets an event of a replayed batch twice.
+            A listener which raises makes the batch be replayed. With
+            ``listener_workers``, the events of the other rooms are still recorded,
+            while the later events of the failed room are held back for the replay.
+        dedup_size (int): Optional. Number of dispatched events remembered in
+            checkpoint mode, counting an event once per kind of listener.
+        profile_cache (ProfileCache): Optional. Cache of the global display names
+            and avatars of users, fed by /profile responses and shared by all User
+            objects. Defaults to ``ProfileCache()``.
+        send_workers (int): Optional. Number of rooms the ``send_queue`` sends
+            events to in parallel.
+        local_echo (bool): Optional. Add the message events sent through a Room
+            (``send_text``, ``queue_event``...) to ``Room.events`` right away, and
+            call the listeners added with ``local_echo=True`` with them. These local
+            echoes have no event_id, and are listed in ``Room.pending_events``.
+            When the event comes back in sync, the local echo is updated in place
+            with it, matched by ``unsigned.transaction_id``, and the listeners are
+            called with the local echo itself: those added with ``local_echo`` get
+            the same dict again, now with an event_id. If sending fails, the local
+            echo stays in the timeline, marked with ``unsigned.failed``, and the
+            ``local_echo`` listeners are called with it again.
+        pipelined_sync (bool): Optional. In ``listen_forever``, send the next /sync
+            request on a dedicated connection while the previous response is being
+            processed. Takes precedence over ``streaming_sync``.
+        media_cache (MediaCache): Optional. Where ``download`` and ``thumbnail``
+            cache the media they fetch. See
+            :class:`~matrix_client.media_cache.MediaCache`.
+        upload_cache (UploadCache): Optional. Remembers the mxc:// URL of the
+            content uploaded with ``upload``, by hash, so that uploading the same
+            content again returns it without a request. See
+            :class:`~matrix_client.upload_cache.UploadCache`.
+
+    Attributes:
+        sync_filter (str|dict|SyncFilter): The filter definition used for /sync, or
+            the ID of a filter registered with the homeserver. See
+            :class:`~matrix_client.filter.SyncFilter` to build one.
 
     Returns:
         `MatrixClient`
@@ -105,9 +181,17 @@ class MatrixClient(object):
                 pass
     """
 
+    _room_class = Room
+    _user_class = User
+
     def __init__(self, base_url, token=None, user_id=None,
                  valid_cert_check=True, sync_filter_limit=20,
-                 cache_level=CACHE.ALL, encryption=False, encryption_conf=None):
+                 cache_level=CACHE.ALL, encryption=False, encryption_conf=None,
+                 streaming_sync=False, upload_filter=True, filter_cache_path=None,
+                 auto_filter=False, listener_workers=0, listener_queue_size=1000,
+                 pipelined_sync=False, event_cache=None, store=None, checkpoint=False,
+                 dedup_size=10000, profile_cache=None, send_workers=4,
+                 local_echo=False, media_cache=None, upload_cache=None):
         if token is not None and user_id is None:
             raise ValueError("must supply user_id along with token")
         if encryption and not ENCRYPTION_SUPPORT:
@@ -116,11 +200,13 @@ class MatrixClient(object):
 
         self.api = MatrixHttpApi(base_url, token)
         self.api.validate_certificate(valid_cert_check)
-        self.listeners = []
+        self.listeners = ListenerRegistry()
         self.presence_listeners = {}
         self.invite_listeners = []
         self.left_listeners = []
-        self.ephemeral_listeners = []
+        self.ephemeral_listeners = ListenerRegistry()
+        # Bumped whenever a listener is added or removed, to rebuild the auto filter
+        self._listeners_version = 0
         self.device_id = None
         self._encryption = encryption
         self.encryption_conf = encryption_conf or {}
@@ -133,11 +219,47 @@ class MatrixClient(object):
                 "cache_level must be one of CACHE.NONE, CACHE.SOME, CACHE.ALL"
             )
 
+        self.event_cache = event_cache
+        self.profile_cache = profile_cache if profile_cache is not None \
+            else ProfileCache()
+        # Users returned by get_user, shared while they are referenced
+        self._users = WeakValueDictionary()
+        self.store = store
+        self._store_loaded = False
+        # Rooms to save to, and remove from, the store after the current sync
+        self._dirty_rooms = set()
+        self._removed_rooms = set()
+        self.checkpoint = checkpoint
+        self.processed_events = DedupIndex(dedup_size)
+        # Dispatch keys (room IDs) whose listeners failed during the current batch
+        self._failed_keys = set()
         self.sync_token = None
+        self.streaming_sync = streaming_sync
+        self.pipelined_sync = pipelined_sync
+        self._sync_pipeline = None
         self.sync_filter = '{ "room": { "timeline" : { "limit" : %i } } }' \
             % sync_filter_limit
+        self.upload_filter = upload_filter
+        self.filter_cache = FilterCache(filter_cache_path)
+        self.auto_filter = auto_filter
+        self._auto_filter_key = None
+        self._auto_filter = None
+        # The filter is also computed on the thread of the sync pipeline
+        self._auto_filter_lock = Lock()
         self.sync_thread = None
         self.should_listen = False
+        self.listener_workers = listener_workers
+        self.listener_queue_size = listener_queue_size
+        self._listener_executor = None
+        # Local echoes are dispatched from the threads sending events
+        self._listener_executor_lock = Lock()
+        self._listener_exception_handler = None
+        self.send_workers = send_workers
+        self.local_echo = local_echo
+        self.media_cache = media_cache
+        self.upload_cache = upload_cache
+        self._send_queue = None
+        self._send_queue_lock = Lock()
 
         """ Time to wait before attempting a /sync request after failing."""
         self.bad_sync_timeout_limit = 60 * 60
@@ -147,7 +269,7 @@ class MatrixClient(object):
         if token:
             check_user_id(user_id)
             self.user_id = user_id
-            self._sync()
+            self._sync(timeout_ms=0)
 
     def get_sync_token(self):
         warn("get_sync_token is deprecated. Directly access MatrixClient.sync_token.",
@@ -203,7 +325,7 @@ class MatrixClient(object):
         self.token = response["access_token"]
         self.hs = response["home_server"]
         self.api.token = self.token
-        self._sync()
+        self._sync(timeout_ms=0)
         return self.token
 
     def login_with_password_no_sync(self, username, password):
@@ -282,13 +404,19 @@ class MatrixClient(object):
         if sync:
             """ Limit Filter """
             self.sync_filter = '{ "room": { "timeline" : { "limit" : %i } } }' % limit
-            self._sync()
+            self._sync(timeout_ms=0)
         return self.token
 
     def logout(self):
         """ Logout from the homeserver.
+
+        The events queued with ``send_queue`` are sent first.
         """
         self.stop_listener_thread()
+        with self._send_queue_lock:
+            send_queue, self._send_queue = self._send_queue, None
+        if send_queue is not None:
+            send_queue.shutdown(wait=True)
         self.api.logout()
 
     # TODO: move room creation/joining to User class for future application service usage
@@ -340,28 +468,21 @@ class MatrixClient(object):
 
     # TODO: create Listener class and push as much of this logic there as possible
     # NOTE: listeners related to things in rooms should be attached to Room objects
-    def add_listener(self, callback, event_type=None):
+    def add_listener(self, callback, event_type=None, local_echo=False):
         """ Add a listener that will send a callback when the client recieves
         an event.
 
         Args:
             callback (func(roomchunk)): Callback called when an event arrives.
             event_type (str): The event_type to filter for.
+            local_echo (bool): Optional. Also call it with the local echoes of the
+                events sent, see the ``local_echo`` argument of MatrixClient.
 
         Returns:
             uuid.UUID: Unique id of the listener, can be used to identify the listener.
         """
-        listener_uid = uuid4()
-        # TODO: listeners should be stored in dict and accessed/deleted directly. Add
-        # convenience method such that MatrixClient.listeners.new(Listener(...)) performs
-        # MatrixClient.listeners[uuid4()] = Listener(...)
-        self.listeners.append(
-            {
-                'uid': listener_uid,
-                'callback': callback,
-                'event_type': event_type
-            }
-        )
+        listener_uid = self.listeners.add(callback, event_type, local_echo)
+        self._listeners_changed()
         return listener_uid
 
     def remove_listener(self, uid):
@@ -370,8 +491,8 @@ class MatrixClient(object):
         Args:
             uuid.UUID: Unique id of the listener to remove.
         """
-        self.listeners[:] = (listener for listener in self.listeners
-                             if listener['uid'] != uid)
+        self.listeners.remove(uid)
+        self._listeners_changed()
 
     def add_presence_listener(self, callback):
         """ Add a presence listener that will send a callback when the client receives
@@ -385,6 +506,7 @@ class MatrixClient(object):
         """
         listener_uid = uuid4()
         self.presence_listeners[listener_uid] = callback
+        self._listeners_changed()
         return listener_uid
 
     def remove_presence_listener(self, uid):
@@ -394,6 +516,7 @@ class MatrixClient(object):
             uuid.UUID: Unique id of the listener to remove
         """
         self.presence_listeners.pop(uid)
+        self._listeners_changed()
 
     def add_ephemeral_listener(self, callback, event_type=None):
         """ Add an ephemeral listener that will send a callback when the client recieves
@@ -406,14 +529,8 @@ class MatrixClient(object):
         Returns:
             uuid.UUID: Unique id of the listener, can be used to identify the listener.
         """
-        listener_id = uuid4()
-        self.ephemeral_listeners.append(
-            {
-                'uid': listener_id,
-                'callback': callback,
-                'event_type': event_type
-            }
-        )
+        listener_id = self.ephemeral_listeners.add(callback, event_type)
+        self._listeners_changed()
         return listener_id
 
     def remove_ephemeral_listener(self, uid):
@@ -422,8 +539,8 @@ class MatrixClient(object):
         Args:
             uuid.UUID: Unique id of the listener to remove.
         """
-        self.ephemeral_listeners[:] = (listener for listener in self.ephemeral_listeners
-                                       if listener['uid'] != uid)
+        self.ephemeral_listeners.remove(uid)
+        self._listeners_changed()
 
     def add_invite_listener(self, callback):
         """ Add a listener that will send a callback when the client receives
@@ -467,35 +584,44 @@ class MatrixClient(object):
                retrying.
             exception_handler (func(exception)): Optional exception handler
                function which can be used to handle exceptions in the caller
-               thread.
+               thread. With ``listener_workers``, it is also called from the
+               worker threads with the exceptions raised by listeners.
             bad_sync_timeout (int): Base time to wait after an error before
                 retrying. Will be increased according to exponential backoff.
         """
         _bad_sync_timeout = bad_sync_timeout
+        self._listener_exception_handler = exception_handler
         self.should_listen = True
-        while (self.should_listen):
-            try:
-                self._sync(timeout_ms)
-                _bad_sync_timeout = bad_sync_timeout
-            # TODO: we should also handle MatrixHttpLibError for retry in case no response
-            except MatrixRequestError as e:
-                logger.warning("A MatrixRequestError occured during sync.")
-                if e.code >= 500:
-                    logger.warning("Problem occured serverside. Waiting %i seconds",
-                                   bad_sync_timeout)
-                    sleep(bad_sync_timeout)
-                    _bad_sync_timeout = min(_bad_sync_timeout * 2,
-                                            self.bad_sync_timeout_limit)
-                elif exception_handler is not None:
-                    exception_handler(e)
-                else:
-                    raise
-            except Exception as e:
-                logger.exception("Exception thrown during sync")
-                if exception_handler is not None:
-                    exception_handler(e)
-                else:
-                    raise
+        try:
+            while (self.should_listen):
+                try:
+                    if self.pipelined_sync:
+                        self._pipelined_sync(timeout_ms)
+                    else:
+                        self._sync(timeout_ms)
+                    _bad_sync_timeout = bad_sync_timeout
+                # TODO: we should also handle MatrixHttpLibError for retry in case no
+                # response
+                except MatrixRequestError as e:
+                    logger.warning("A MatrixRequestError occured during sync.")
+                    if e.code >= 500:
+                        logger.warning("Problem occured serverside. Waiting %i seconds",
+                                       bad_sync_timeout)
+                        sleep(bad_sync_timeout)
+                        _bad_sync_timeout = min(_bad_sync_timeout * 2,
+                                                self.bad_sync_timeout_limit)
+                    elif exception_handler is not None:
+                        exception_handler(e)
+                    else:
+                        raise
+                except Exception as e:
+                    logger.exception("Exception thrown during sync")
+                    if exception_handler is not None:
+                        exception_handler(e)
+                    else:
+                        raise
+        finally:
+            self._stop_sync_pipeline()
 
     def start_listener_thread(self, timeout_ms=30000, exception_handler=None):
         """ Start a listener thread to listen for events in the background.
@@ -520,27 +646,104 @@ class MatrixClient(object):
 
     def stop_listener_thread(self):
         """ Stop listener thread running in the background
+
+        With ``listener_workers``, also waits for the pending callbacks to run.
         """
         if self.sync_thread:
             self.should_listen = False
             self.sync_thread.join()
             self.sync_thread = None
+        with self._listener_executor_lock:
+            executor, self._listener_executor = self._listener_executor, None
+        if executor is not None:
+            executor.shutdown(wait=True)
+
+    @property
+    def send_queue(self):
+        """The :class:`~matrix_client.send_queue.SendQueue` used by
+        ``Room.queue_event``, created on first use."""
+        with self._send_queue_lock:
+            if self._send_queue is None:
+                self._send_queue = SendQueue(self.api, self.send_workers)
+            return self._send_queue
+
+    def _dispatch(self, key, callback, *args):
+        """Call a listener callback, or schedule it if ``listener_workers`` is set.
+
+        Args:
+            key (str): Callbacks with the same key run in the order of dispatch,
+                e.g. a room ID.
+        """
+        if not self.listener_workers:
+            callback(*args)
+            return
+        with self._listener_executor_lock:
+            if self._listener_executor is None:
+                self._listener_executor = ShardedExecutor(
+                    self.listener_workers, self.listener_queue_size,
+                    exception_handler=self._listener_failed, name="matrix-listener"
+                )
+            executor = self._listener_executor
+        if self.checkpoint:
+            executor.submit(key, self._run_listener, key, callback, args)
+        else:
+            executor.submit(key, callback, *args)
+
+    def _run_listener(self, key, callback, args):
+        # Once a listener of a key failed, the following events of the key are not
+        # dispatched nor recorded, so that the replay delivers them in order
+        if key in self._failed_keys:
+            return
+        try:
+            callback(*args)
+        except Exception:
+            self._failed_keys.add(key)
+            raise
+
+    def _listener_failed(self, exception):
+        if self._listener_exception_handler is not None:
+            self._listener_exception_handler(exception)
+        else:
+            logger.exception("Exception thrown by listener")
 
     # TODO: move to User class. Consider creating lightweight Media class.
-    def upload(self, content, content_type):
+    def upload(self, content, content_type, progress=None):
         """ Upload content to the home server and recieve a MXC url.
 
         Args:
-            content (bytes): The data of the content.
+            content (bytes|str|file|iterable): The data of the content, a file
+                object opened in binary mode, or an iterable yielding bytes. Text
+                is sent as UTF-8. Files and iterables are streamed rather than
+                loaded in memory.
             content_type (str): The mimetype of the content.
+            progress (func(sent, total)): Optional. Called as the content is sent,
+                with the number of bytes sent and the total, or None if unknown.
+
+        If the client has an ``upload_cache``, bytes and seekable files are hashed
+        first, and not uploaded if the same content was. Iterables are hashed as
+        they are sent, so that later uploads of their content are deduplicated.
 
         Raises:
             MatrixUnexpectedResponse: If the homeserver gave a strange response
             MatrixRequestError: If the upload failed for some reason.
         """
+        sha256 = digest = None
+        if self.upload_cache is not None:
+            sha256 = content_hash(content)
+            if sha256 is not None:
+                content_uri = self.upload_cache.get(sha256, content_type)
+                if content_uri is not None:
+                    return content_uri
+            elif not hasattr(content, "read"):
+                digest = hashlib.sha256()
+                content = iter_hashed(content, digest)
         try:
-            response = self.api.media_upload(content, content_type)
+            response = self.api.media_upload(content, content_type, progress)
             if "content_uri" in response:
+                if digest is not None:
+                    sha256 = digest.hexdigest()
+                if sha256 is not None:
+                    self.upload_cache.set(sha256, content_type, response["content_uri"])
                 return response["content_uri"]
             else:
                 raise MatrixUnexpectedResponse(
@@ -552,78 +755,529 @@ class MatrixClient(object):
                 content="Upload failed: %s" % e
             )
 
-    def _mkroom(self, room_id):
-        room = Room(self, room_id)
-        if self._encryption:
-            try:
-                event = self.api.get_state_event(room_id, "m.room.encryption")
-                if event["algorithm"] == "m.megolm.v1.aes-sha2":
-                    room.encrypted = True
-            except MatrixRequestError as e:
-                if e.code != 404:
-                    raise
+    def upload_file(self, path, content_type, progress=None):
+        """ Upload a file to the home server and recieve a MXC url.
+
+        The file is mapped in memory and streamed, so uploading a large file does
+        not need as much memory.
+
+        Args:
+            path (str): The file.
+            content_type (str): The mimetype of the content.
+            progress (func(sent, total)): Optional. Called as the file is sent.
+
+        Raises:
+            MatrixUnexpectedResponse: If the homeserver gave a strange response
+            MatrixRequestError: If the upload failed for some reason.
+        """
+        with MappedFile(path) as mapped:
+            return self.upload(mapped.fileobj(), content_type, progress)
+
+    def download(self, mxc_url, fileobj=None, chunk_size=65536, max_parallel=4):
+        """ Download content from the home server.
+
+        The content is streamed, and fetched from the ``media_cache`` if the client
+        has one. Interrupted transfers are resumed with Range requests.
+
+        Args:
+            mxc_url (str): The mxc:// URL of the content.
+            fileobj (file): Optional. A file object opened in binary mode to write
+                the content to.
+            chunk_size (int): Optional. Number of bytes to read at a time.
+            max_parallel (int): Optional. Maximum number of parts of large content
+                downloaded at once, when writing to a seekable ``fileobj`` or to
+                the ``media_cache``. See ``MatrixHttpApi.media_download_file``.
+
+        Returns:
+            The number of bytes written to ``fileobj`` if given, or else a
+            generator yielding the content in chunks.
+
+        Raises:
+            MatrixRequestError: If the download failed, e.g. the content is unknown.
+        """
+        download_file = None
+        if max_parallel > 1:
+            download_file = partial(self.api.media_download_file, mxc_url,
+                                    max_parallel=max_parallel, chunk_size=chunk_size)
+        return self._download(
+            mxc_url, lambda offset: self.api.media_download(mxc_url, offset, chunk_size),
+            fileobj, chunk_size, download_file
+        )
+
+    def thumbnail(self, mxc_url, width, height, method="scale", fileobj=None,
+                  chunk_size=65536):
+        """ Download a thumbnail of content from the home server.
+
+        Args:
+            mxc_url (str): The mxc:// URL of the content.
+            width (int): The desired width of the thumbnail.
+            height (int): The desired height of the thumbnail.
+            method (str): Optional. "crop" or "scale".
+            fileobj, chunk_size: As for ``download``.
+
+        Returns:
+            As for ``download``.
+        """
+        key = "%s?width=%d&height=%d&method=%s" % (mxc_url, width, height, method)
+        return self._download(
+            key,
+            lambda offset: self.api.media_thumbnail(mxc_url, width, height, method,
+                                                    offset, chunk_size),
+            fileobj, chunk_size
+        )
+
+    def _download(self, key, download, fileobj, chunk_size, download_file=None):
+        if self.media_cache is not None:
+            chunks = iter_file(self.media_cache.fetch(key, download, download_file),
+                               chunk_size)
+        elif (fileobj is not None and download_file is not None and
+                getattr(fileobj, "seekable", lambda: False)()):
+            return download_file(fileobj)
+        else:
+            chunks = download(0)
+        if fileobj is None:
+            return chunks
+        written = 0
+        for chunk in chunks:
+            fileobj.write(chunk)
+            written += len(chunk)
+        return written
+
+    def _mkroom(self, room_id, lookup_encryption=True):
+        """Create a room.
+
+        Args:
+            room_id (str): The room.
+            lookup_encryption (bool): Whether to request the encryption state of the
+                room if encryption is enabled. Otherwise it is left unknown, to be
+                set from sync or looked up lazily.
+        """
+        room = self._room_class(self, room_id)
         self.rooms[room_id] = room
-        return self.rooms[room_id]
+        if self._encryption:
+            room.encrypted = None
+            if lookup_encryption:
+                self.resolve_encryption_state([room_id])
+        return room
+
+    def resolve_encryption_state(self, room_ids=None):
+        """Look up the encryption state of rooms for which it is unknown.
+
+        Sync reports the encryption state of new rooms unless the sync filter
+        excludes it. Otherwise, the lookup is deferred until ``Room.encrypted`` is
+        read, or until this is called, e.g. from another thread. The rooms are
+        looked up concurrently, with ``MatrixHttpApi.map``.
+
+        Args:
+            room_ids (list): Optional. The rooms to look up. Defaults to every room
+                whose encryption state is unknown.
+        """
+        if room_ids is None:
+            room_ids = list(self.rooms)
+        rooms = [self.rooms.get(room_id) for room_id in room_ids]
+        rooms = [room for room in rooms if room is not None and room._encrypted is None]
+        if len(rooms) == 1:
+            # Not worth a round trip through the thread pool
+            rooms[0].encrypted = self._get_encryption_state(rooms[0].room_id)
+        elif rooms:
+            states = self.api.map(self._get_encryption_state,
+                                  [room.room_id for room in rooms])
+            for room, encrypted in zip(rooms, states):
+                room.encrypted = encrypted
+
+    def _get_encryption_state(self, room_id):
+        try:
+            event = self.api.get_state_event(room_id, "m.room.encryption")
+        except MatrixRequestError as e:
+            if e.code != 404:
+                raise
+            return False
+        return event["algorithm"] == "m.megolm.v1.aes-sha2"
 
-    # TODO better handling of the blocking I/O caused by update_one_time_key_counts
     def _sync(self, timeout_ms=30000):
-        response = self.api.sync(self.sync_token, timeout_ms, filter=self.sync_filter)
-        self.sync_token = response["next_batch"]
+        self._load_store()
+        sync_filter = self._get_sync_filter()
+        try:
+            self._sync_with_filter(timeout_ms, sync_filter)
+        except MatrixRequestError as e:
+            if not self._filter_rejected(e, sync_filter):
+                raise
+            # The filter is uploaded again
+            self._sync_with_filter(timeout_ms, self._get_sync_filter())
+
+    def _sync_with_filter(self, timeout_ms, sync_filter):
+        if self.streaming_sync:
+            stream = self.api.sync_stream(self.sync_token, timeout_ms,
+                                          filter=sync_filter)
+            self._handle_sync_stream(stream)
+            return
+        response = self.api.sync(self.sync_token, timeout_ms, filter=sync_filter)
+        self._handle_sync(response)
+
+    def _pipelined_sync(self, timeout_ms=30000):
+        """Process the next response of the sync pipeline, starting it if needed."""
+        self._load_store()
+        pipeline = self._sync_pipeline
+        if pipeline is None or not pipeline.running or pipeline.timeout_ms != timeout_ms:
+            self._stop_sync_pipeline()
+            pipeline = self._sync_pipeline = SyncPipeline(self, timeout_ms)
+        try:
+            since, response = pipeline.get()
+        except Exception as e:
+            self._sync_pipeline = None
+            if (isinstance(e, MatrixRequestError) and
+                    self._filter_rejected(e, pipeline.sync_filter)):
+                # Restarted with the filter uploaded again
+                return
+            raise
+        if since != self.sync_token:
+            # The token was changed meanwhile, e.g. with set_sync_token. Restart from
+            # the new one, so no batch is skipped or processed twice.
+            self._stop_sync_pipeline()
+            return
+        self._handle_sync(response)
+
+    def _stop_sync_pipeline(self):
+        if self._sync_pipeline is not None:
+            self._sync_pipeline.stop()
+            self._sync_pipeline = None
+
+    def _get_sync_filter(self, api=None):
+        """Return the filter to send with /sync.
+
+        This is the ID of ``sync_filter`` once uploaded, registering it with the
+        homeserver the first time it is used. Falls back to the inline definition.
 
-        for presence_update in response['presence']['events']:
-            for callback in self.presence_listeners.values():
-                callback(presence_update)
+        Args:
+            api (MatrixHttpApi): Optional. Uploads the filter instead of ``api``,
+                e.g. with the session of the sync pipeline's thread.
+        """
+        definition = self._effective_sync_filter()
+        sync_filter, sync_filter_hash = self._cached_sync_filter(definition)
+        if sync_filter_hash is None:
+            return sync_filter
+        try:
+            response = (api or self.api).create_filter(self.user_id,
+                                                       filter_to_dict(definition))
+        except MatrixRequestError as e:
+            return self._filter_upload_failed(e, sync_filter)
+        return self._filter_uploaded(sync_filter_hash, response)
+
+    def _cached_sync_filter(self, sync_filter):
+        """Return a tuple (filter, hash) for the definition of a filter. hash is
+        only set if the filter should be uploaded, otherwise filter is either an ID
+        or an inline definition."""
+        if sync_filter is None:
+            return None, None
+        if is_filter_id(sync_filter):
+            return sync_filter, None
+        inline_filter = canonical_filter(sync_filter)
+        if not self.upload_filter or not getattr(self, "user_id", None):
+            return inline_filter, None
+        sync_filter_hash = filter_hash(sync_filter)
+        filter_id = self.filter_cache.get(self.user_id, sync_filter_hash)
+        if filter_id is not None:
+            return filter_id, None
+        return inline_filter, sync_filter_hash
+
+    def _effective_sync_filter(self):
+        """Return ``sync_filter``, restricted to what listeners need if
+        ``auto_filter`` is set."""
+        if (not self.auto_filter or self.sync_filter is None or
+                is_filter_id(self.sync_filter)):
+            return self.sync_filter
+        key = (self._listeners_version, canonical_filter(self.sync_filter))
+        with self._auto_filter_lock:
+            if key != self._auto_filter_key:
+                self._auto_filter = self._listeners_filter()
+                self._auto_filter_key = key
+            return self._auto_filter
+
+    def _listeners_filter(self):
+        state_types = set()
+        if self._cache_level >= CACHE.SOME:
+            state_types.update(TRACKED_STATE_EVENTS)
+        if self._cache_level == CACHE.ALL:
+            state_types.add("m.room.member")
+        timeline_types = self.listeners.event_types()
+        ephemeral_types = self.ephemeral_listeners.event_types()
+        for room in list(self.rooms.values()):
+            state_types.update(room.state_listeners.event_types())
+            timeline_types.update(room.listeners.event_types())
+            ephemeral_types.update(room.ephemeral_listeners.event_types())
+        # State events in the timeline update the room state too
+        timeline_types.update(state_types)
+
+        # Listeners without an event type want every event
+        if None in state_types or self._encryption:
+            state_types = None
+        if None in timeline_types or self._encryption:
+            timeline_types = None
+        if None in ephemeral_types:
+            ephemeral_types = None
+        return filter_for_listeners(self.sync_filter, timeline_types, state_types,
+                                    ephemeral_types,
+                                    presence=bool(self.presence_listeners))
+
+    def _listeners_changed(self):
+        self._listeners_version += 1
+
+    def _filter_uploaded(self, sync_filter_hash, response):
+        filter_id = response["filter_id"]
+        self.filter_cache.set(self.user_id, sync_filter_hash, filter_id)
+        return filter_id
+
+    def _filter_rejected(self, error, sync_filter):
+        """Forget the ID of an uploaded filter if a /sync error is due to it, e.g.
+        the homeserver lost it.
+
+        Returns:
+            bool: Whether it was forgotten, so the filter will be uploaded again.
+        """
+        user_id = getattr(self, "user_id", None)
+        if not user_id or not 400 <= error.code < 500 or error.code == 429:
+            return False
+        if not self.filter_cache.invalidate(user_id, sync_filter):
+            return False
+        logger.warning("Sync filter %s was rejected, uploading it again: %s",
+                       sync_filter, error)
+        return True
+
+    def _filter_upload_failed(self, error, inline_filter):
+        """Send the filter inline. Uploading it is only given up if the homeserver
+        does not support filters, and otherwise tried again on the next sync."""
+        if error.code in (400, 404) and _errcode(error) == "M_UNRECOGNIZED":
+            logger.warning("Sync filters are not supported, sending it inline: %s",
+                           error)
+            self.upload_filter = False
+        else:
+            logger.warning("Could not upload sync filter, sending it inline for "
+                           "this sync: %s", error)
+        return inline_filter
+
+    # TODO better handling of the blocking I/O caused by update_one_time_key_counts
+    def _handle_sync(self, response):
+        if not self.checkpoint:
+            self.sync_token = response["next_batch"]
+
+        self._handle_presence(response['presence'])
 
         for room_id, invite_room in response['rooms']['invite'].items():
-            for listener in self.invite_listeners:
-                listener(room_id, invite_room['invite_state'])
+            self._handle_invited_room(room_id, invite_room)
 
         for room_id, left_room in response['rooms']['leave'].items():
-            for listener in self.left_listeners:
-                listener(room_id, left_room)
-            if room_id in self.rooms:
-                del self.rooms[room_id]
+            self._handle_left_room(room_id, left_room)
 
-        if self._encryption and 'device_one_time_keys_count' in response:
-            self.olm_device.update_one_time_key_counts(
-                response['device_one_time_keys_count'])
+        if 'device_one_time_keys_count' in response:
+            self._handle_one_time_keys_count(response['device_one_time_keys_count'])
 
         for room_id, sync_room in response['rooms']['join'].items():
-            if room_id not in self.rooms:
-                self._mkroom(room_id)
-            room = self.rooms[room_id]
-            # TODO: the rest of this for loop should be in room object method
-            room.prev_batch = sync_room["timeline"]["prev_batch"]
-
-            for event in sync_room["state"]["events"]:
-                event['room_id'] = room_id
-                room._process_state_event(event)
-
-            for event in sync_room["timeline"]["events"]:
-                event['room_id'] = room_id
-                room._put_event(event)
-
-                # TODO: global listeners can still exist but work by each
-                # room.listeners[uuid] having reference to global listener
-
-                # Dispatch for client (global) listeners
-                for listener in self.listeners:
-                    if (
-                        listener['event_type'] is None or
-                        listener['event_type'] == event['type']
-                    ):
-                        listener['callback'](event)
-
-            for event in sync_room['ephemeral']['events']:
-                event['room_id'] = room_id
-                room._put_ephemeral_event(event)
-
-                for listener in self.ephemeral_listeners:
-                    if (
-                        listener['event_type'] is None or
-                        listener['event_type'] == event['type']
-                    ):
-                        listener['callback'](event)
+            self._handle_joined_room(room_id, sync_room)
+
+        self._end_batch(response["next_batch"])
+
+    def _handle_sync_stream(self, stream):
+        """Process a /sync response from ``MatrixHttpApi.sync_stream``.
+
+        Every room is processed as soon as it has been decoded, so sections are
+        handled in the order the homeserver sent them. The sync token is only
+        advanced once the whole response has been processed.
+        """
+        next_batch = None
+        for path, value in stream:
+            if path == ("next_batch",):
+                next_batch = value
+            elif path == ("presence",):
+                self._handle_presence(value)
+            elif path == ("device_one_time_keys_count",):
+                self._handle_one_time_keys_count(value)
+            elif len(path) == 3 and path[0] == "rooms":
+                if path[1] == "join":
+                    self._handle_joined_room(path[2], value)
+                elif path[1] == "invite":
+                    self._handle_invited_room(path[2], value)
+                elif path[1] == "leave":
+                    self._handle_left_room(path[2], value)
+        if next_batch is None:
+            raise MatrixUnexpectedResponse("/sync response without next_batch.")
+        if not self.checkpoint:
+            self.sync_token = next_batch
+        self._end_batch(next_batch)
+
+    def _end_batch(self, next_batch):
+        """Checkpoint the sync token once a batch has been processed.
+
+        The events marked processed during the batch are committed to the store
+        with the token, in one transaction."""
+        if self.checkpoint:
+            executor = self._listener_executor
+            if executor is not None:
+                executor.drain()
+            if self._failed_keys:
+                logger.warning("Listeners failed for %s, the sync batch will be "
+                               "replayed.",
+                               ", ".join(sorted(map(str, self._failed_keys))))
+                self._failed_keys.clear()
+            else:
+                self.sync_token = next_batch
+        self._save_store()
+
+    def _load_store(self):
+        """Restore the sync token and rooms from the store, once."""
+        user_id = getattr(self, "user_id", None)
+        if self.store is None or self._store_loaded or user_id is None:
+            return
+        self._store_loaded = True
+        if self.store.get_meta("user_id") != user_id:
+            # Empty, or saved by another account
+            self.store.clear()
+            self.store.set_meta("user_id", user_id)
+            self.store.commit()
+            return
+        self.sync_token = self.store.get_meta("sync_token")
+        self.processed_events.update(self.store.get_processed_events())
+        for room_id, prev_batch, state, members in self.store.get_rooms():
+            room = self._room_class(self, room_id)
+            room._restore(prev_batch, state, members)
+            self.rooms[room_id] = room
+
+    def _save_store(self):
+        """Save the sync token and the rooms changed by the last sync."""
+        if self.store is None or not self._store_loaded:
+            return
+        removed, self._removed_rooms = self._removed_rooms, set()
+        dirty, self._dirty_rooms = self._dirty_rooms, set()
+        for room_id in removed:
+            self.store.remove_room(room_id)
+        for room_id in dirty:
+            room = self.rooms.get(room_id)
+            if room is not None:
+                self.store.save_room(room_id, room.prev_batch, room._state_snapshot(),
+                                     room.members.pop_changes())
+        self.store.set_meta("sync_token", self.sync_token)
+        self.store.commit()
+
+    def _forget_room(self, room_id):
+        room = self.rooms.pop(room_id, None)
+        if room is not None:
+            room.events.detach()
+            self._listeners_changed()
+        if self.store is not None:
+            self._dirty_rooms.discard(room_id)
+            self._removed_rooms.add(room_id)
+
+    def _handle_presence(self, presence):
+        for presence_update in presence['events']:
+            self._dispatch_event(presence_update.get("sender"), "presence",
+                                 presence_update, self._dispatch_presence,
+                                 presence_update)
+
+    def _dispatch_presence(self, presence_update):
+        for callback in list(self.presence_listeners.values()):
+            callback(presence_update)
+
+    def _handle_invited_room(self, room_id, invite_room):
+        self._dispatch_event(room_id, "invite", {"room_id": room_id,
+                                                 "invite": invite_room},
+                             self._dispatch_invite, room_id,
+                             invite_room['invite_state'])
+
+    def _dispatch_invite(self, room_id, invite_state):
+        for listener in list(self.invite_listeners):
+            listener(room_id, invite_state)
+
+    def _handle_left_room(self, room_id, left_room):
+        self._dispatch_event(room_id, "leave", {"room_id": room_id, "leave": left_room},
+                             self._dispatch_leave, room_id, left_room)
+        self._forget_room(room_id)
+
+    def _dispatch_leave(self, room_id, left_room):
+        for listener in list(self.left_listeners):
+            listener(room_id, left_room)
+
+    def _handle_one_time_keys_count(self, counts):
+        if self._encryption:
+            self.olm_device.update_one_time_key_counts(counts)
+
+    def _handle_joined_room(self, room_id, sync_room):
+        new_room = room_id not in self.rooms
+        if new_room:
+            self._mkroom(room_id, lookup_encryption=False)
+        room = self.rooms[room_id]
+        if self.store is not None:
+            self._dirty_rooms.add(room_id)
+        # TODO: the rest of this method should be in room object method
+        room.prev_batch = sync_room["timeline"]["prev_batch"]
+        room._set_summary(sync_room.get("summary"))
+
+        for event in sync_room["state"]["events"]:
+            event['room_id'] = room_id
+            room._process_state_event(event)
+
+        for event in sync_room["timeline"]["events"]:
+            event['room_id'] = room_id
+            # The local echo of the event, if any, is dispatched in its place
+            event = room._put_event(event)
+
+            # TODO: global listeners can still exist but work by each
+            # room.listeners[uuid] having reference to global listener
+
+            # Dispatch for client (global) listeners
+            self._dispatch_event(room_id, "timeline", event, self.listeners.dispatch,
+                                 event)
+
+        # The first sync of a room has its full state, so a missing encryption
+        # event means it is not encrypted, unless the filter excluded it. Later
+        # syncs only have state changes: the other unknown rooms are left to
+        # resolve_encryption_state.
+        if (new_room and room._encrypted is None and
+                filter_includes(self._effective_sync_filter(), "m.room.encryption")):
+            room.encrypted = False
+
+        for event in sync_room['ephemeral']['events']:
+            event['room_id'] = room_id
+            room._put_ephemeral_event(event)
+            self._dispatch_event(room_id, "ephemeral", event,
+                                 self.ephemeral_listeners.dispatch, event)
+
+    def _dispatch_event(self, key, stage, event, callback, *args):
+        """Dispatch an event to the listeners of a stage, e.g. the room listeners
+        or the client listeners.
+
+        In checkpoint mode, every stage gets an event once: the stages which
+        already returned for it are skipped when its batch is replayed.
+
+        Args:
+            key (str): See ``_dispatch``.
+            stage (str): Identifies the listeners called by ``callback``.
+            event (dict): The event, or for invited and left rooms a dict
+                identifying them.
+        """
+        if not self.checkpoint:
+            self._dispatch(key, callback, *args)
+            return
+        processed_id = self._processed_id(stage, event)
+        if processed_id in self.processed_events:
+            return
+        self._dispatch(key, callback, *args)
+        # Recorded once the listeners have returned
+        self._dispatch(key, self._mark_processed, processed_id)
+
+    def _processed_id(self, stage, event):
+        event_id = event.get("event_id")
+        if event_id:
+            return "%s %s" % (stage, event_id)
+        # Events without ID, e.g. typing notifications, are told apart by their
+        # content within a batch. A replay requests it with the same token.
+        digest = hashlib.sha256(json.dumps(event, sort_keys=True).encode("utf-8"))
+        return "%s %s %s" % (stage, self.sync_token, digest.hexdigest())
+
+    def _mark_processed(self, processed_id):
+        self.processed_events.add(processed_id)
+        # Committed by _save_store at the end of the batch
+        if self.store is not None and self._store_loaded:
+            self.store.add_processed_event(processed_id,
+                                           self.processed_events.max_size)
 
     def get_user(self, user_id):
         """ Return a User by their id.
@@ -631,10 +1285,17 @@ class MatrixClient(object):
         NOTE: This function only returns a user object, it does not verify
             the user with the Home Server.
 
+        The same object is returned for a user as long as it is referenced. Its
+        profile is read from ``profile_cache`` when possible.
+
         Args:
             user_id (str): The matrix user id of a user.
         """
-        return User(self.api, user_id)
+        user = self._users.get(user_id)
+        if user is None:
+            user = self._user_class(self.api, user_id, profiles=self.profile_cache)
+            self._users[user_id] = user
+        return user
 
     # TODO: move to Room class
     def remove_room_alias(self, room_alias):
@@ -651,3 +1312,11 @@ class MatrixClient(object):
             return True
         except MatrixRequestError:
             return False
+
+
+def _errcode(error):
+    """Return the Matrix error code of a MatrixRequestError, or None."""
+    try:
+        return json.loads(error.content).get("errcode")
+    except (AttributeError, TypeError, ValueError):
+        return None
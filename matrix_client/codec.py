@@ -0,0 +1,132 @@
+# -*- coding: utf-8 -*-
+# Copyright 2015 OpenMarket Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""JSON codecs used to encode request bodies and decode responses.
+
+The fastest installed library is picked by default, in the order of ``PREFERENCE``.
+Set ``matrix_client.codec.default_codec`` to a codec name or instance to change the
+default for every new MatrixHttpApi, or pass ``json_codec`` to a single one.
+"""
+import json
+
+
+class JsonCodec(object):
+    """Codec based on the standard library json module."""
+
+    name = "json"
+
+    def dumps(self, obj):
+        """Encode obj, returning str or bytes."""
+        return json.dumps(obj)
+
+    def loads(self, data):
+        """Decode a str or bytes JSON document."""
+        if isinstance(data, bytes) and not isinstance(data, str):
+            data = data.decode("utf-8")
+        return json.loads(data)
+
+
+class OrjsonCodec(JsonCodec):
+    """Codec based on orjson."""
+
+    name = "orjson"
+
+    def __init__(self):
+        import orjson
+        self._orjson = orjson
+
+    def dumps(self, obj):
+        return self._orjson.dumps(obj)
+
+    def loads(self, data):
+        return self._orjson.loads(data)
+
+
+class UjsonCodec(JsonCodec):
+    """Codec based on ujson."""
+
+    name = "ujson"
+
+    def __init__(self):
+        import ujson
+        self._ujson = ujson
+
+    def dumps(self, obj):
+        return self._ujson.dumps(obj, ensure_ascii=False, escape_forward_slashes=False)
+
+    def loads(self, data):
+        return self._ujson.loads(data)
+
+
+class SimdjsonCodec(JsonCodec):
+    """Codec based on pysimdjson. Encoding falls back to the json module."""
+
+    name = "simdjson"
+
+    def __init__(self):
+        import simdjson
+        self._simdjson = simdjson
+
+    def loads(self, data):
+        return self._simdjson.loads(data)
+
+
+CODECS = {
+    codec.name: codec for codec in (JsonCodec, OrjsonCodec, UjsonCodec, SimdjsonCodec)
+}
+
+PREFERENCE = ("orjson", "simdjson", "ujson", "json")
+
+# Name or instance of the codec used when none is given. None picks the fastest
+# installed one.
+default_codec = None
+
+
+def available_codecs():
+    """Return the names of the codecs which can be used in this environment."""
+    names = []
+    for name in PREFERENCE:
+        try:
+            CODECS[name]()
+        except ImportError:
+            continue
+        names.append(name)
+    return names
+
+
+def get_codec(codec=None):
+    """Return a codec instance.
+
+    Args:
+        codec (str|JsonCodec): Optional. A codec instance, or the name of one of
+            ``CODECS``. Defaults to ``default_codec``.
+
+    Raises:
+        ValueError: If the codec is unknown.
+        ImportError: If the library backing the requested codec is missing.
+    """
+    if codec is None:
+        codec = default_codec
+    if codec is None:
+        for name in PREFERENCE:
+            try:
+                return CODECS[name]()
+            except ImportError:
+                pass
+    if isinstance(codec, JsonCodec):
+        return codec
+    try:
+        return CODECS[codec]()
+    except KeyError:
+        raise ValueError("Unknown JSON codec: %s" % codec)
@@ -0,0 +1,62 @@
+# -*- coding: utf-8 -*-
+# Copyright 2015 OpenMarket Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+from collections import OrderedDict
+from threading import Lock
+
+
+class DedupIndex(object):
+    """A bounded set of the most recently processed event IDs.
+
+    Once ``max_size`` is reached, adding an ID forgets the oldest one. Only the
+    events of the last few batches need to be remembered, as replays start from the
+    last checkpointed sync token.
+
+    Args:
+        max_size (int): Maximum number of event IDs remembered.
+    """
+
+    def __init__(self, max_size=10000):
+        self.max_size = max_size
+        self._lock = Lock()
+        self._ids = OrderedDict()
+
+    def add(self, event_id):
+        """Remember an event ID.
+
+        Returns:
+            bool: False if it was already known.
+        """
+        with self._lock:
+            if event_id in self._ids:
+                return False
+            self._ids[event_id] = None
+            while len(self._ids) > self.max_size:
+                self._ids.popitem(last=False)
+            return True
+
+    def update(self, event_ids):
+        for event_id in event_ids:
+            self.add(event_id)
+
+    def __contains__(self, event_id):
+        return event_id in self._ids
+
+    def __len__(self):
+        return len(self._ids)
+
+    def __iter__(self):
+        """Iterate over the event IDs, oldest first."""
+        with self._lock:
+            return iter(list(self._ids))
@@ -0,0 +1,116 @@
+# -*- coding: utf-8 -*-
+# Copyright 2015 OpenMarket Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import logging
+from threading import Lock, Thread
+
+try:
+    from queue import Queue
+except ImportError:
+    from Queue import Queue
+
+logger = logging.getLogger(__name__)
+
+# Put on a worker's queue to make it exit
+_STOP = object()
+
+
+class ShardedExecutor(object):
+    """A thread pool running the tasks of one key in order.
+
+    Every key is assigned to one worker thread, so tasks submitted with the same key
+    (e.g. a room ID) run sequentially in submission order, while tasks of different
+    keys run in parallel. Each worker has a bounded queue: ``submit`` blocks while
+    the queue of the key is full, slowing producers down to the pace of the workers.
+
+    Args:
+        workers (int): Number of worker threads.
+        max_pending (int): Maximum number of queued tasks per worker. 0 means
+            unbounded.
+        exception_handler (func(exception)): Optional. Called from the worker
+            thread when a task raises. By default, the exception is logged.
+        name (str): Optional. Prefix of the names of the worker threads.
+    """
+
+    def __init__(self, workers, max_pending=1000, exception_handler=None,
+                 name="matrix-worker"):
+        if workers < 1:
+            raise ValueError("workers must be at least 1")
+        self.exception_handler = exception_handler
+        self._lock = Lock()
+        self._shutdown = False
+        self._queues = [Queue(max_pending) for _ in range(workers)]
+        self._threads = []
+        for i, queue in enumerate(self._queues):
+            thread = Thread(target=self._work, args=(queue,),
+                            name="%s-%d" % (name, i))
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+
+    def _work(self, queue):
+        while True:
+            task = queue.get()
+            try:
+                if task is _STOP:
+                    return
+                fn, args, kwargs = task
+                fn(*args, **kwargs)
+            except Exception as e:
+                if self.exception_handler is not None:
+                    self.exception_handler(e)
+                else:
+                    logger.exception("Exception raised by %r", task[0])
+            finally:
+                queue.task_done()
+
+    def _queue_for(self, key):
+        return self._queues[hash(key) % len(self._queues)]
+
+    def submit(self, key, fn, *args, **kwargs):
+        """Schedule ``fn(*args, **kwargs)`` after the other tasks of ``key``.
+
+        Blocks while the queue of ``key`` is full.
+
+        Raises:
+            RuntimeError: If the executor was shut down.
+        """
+        if self._shutdown:
+            raise RuntimeError("Cannot submit tasks after shutdown.")
+        self._queue_for(key).put((fn, args, kwargs))
+
+    def pending(self):
+        """Return the number of tasks queued and not yet finished."""
+        return sum(queue.unfinished_tasks for queue in self._queues)
+
+    def drain(self):
+        """Block until every task submitted so far has run."""
+        for queue in self._queues:
+            queue.join()
+
+    def shutdown(self, wait=True):
+        """Stop the workers once they have run the tasks already submitted.
+
+        Args:
+            wait (bool): Whether to block until the workers have exited.
+        """
+        with self._lock:
+            if self._shutdown:
+                return
+            self._shutdown = True
+        for queue in self._queues:
+            queue.put(_STOP)
+        if wait:
+            for thread in self._threads:
+                thread.join()
@@ -0,0 +1,272 @@
+# -*- coding: utf-8 -*-
+# Copyright 2015 OpenMarket Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import fnmatch
+import hashlib
+import json
+import os
+from copy import deepcopy
+from threading import Lock
+
+# Sections of a filter's "room" object holding room events
+ROOM_SECTIONS = ("state", "timeline", "ephemeral", "account_data")
+# Top-level sections holding non-room events
+GLOBAL_SECTIONS = ("presence", "account_data")
+
+
+def is_filter_id(sync_filter):
+    """Whether ``sync_filter`` is the ID of a filter registered with the
+    homeserver rather than a definition."""
+    if isinstance(sync_filter, (SyncFilter, dict)) or sync_filter is None:
+        return False
+    return not sync_filter.lstrip().startswith("{")
+
+
+def filter_to_dict(sync_filter):
+    """Return a filter definition as a dict.
+
+    Args:
+        sync_filter (str|dict|SyncFilter): A filter definition.
+    """
+    if isinstance(sync_filter, SyncFilter):
+        return sync_filter.to_dict()
+    if isinstance(sync_filter, dict):
+        return sync_filter
+    return json.loads(sync_filter)
+
+
+def canonical_filter(sync_filter):
+    """Return a filter definition as compact JSON with sorted keys."""
+    return json.dumps(filter_to_dict(sync_filter), sort_keys=True,
+                      separators=(",", ":"))
+
+
+def filter_hash(sync_filter):
+    """Return a hash identifying a filter definition, independently of key order."""
+    return hashlib.sha256(canonical_filter(sync_filter).encode("utf-8")).hexdigest()
+
+
+class SyncFilter(object):
+    """Builder for /sync filter definitions.
+
+    Every method returns the builder itself, so calls can be chained.
+
+    Args:
+        definition (dict): Optional. A filter definition to start from.
+
+    Example::
+
+        sync_filter = SyncFilter().timeline_limit(10) \\
+            .event_types(["m.room.message"]) \\
+            .lazy_load_members() \\
+            .event_fields(["type", "content", "sender", "event_id"])
+        client.sync_filter = sync_filter
+    """
+
+    def __init__(self, definition=None):
+        self.definition = deepcopy(definition) if definition else {}
+
+    def _room_section(self, section):
+        if section not in ROOM_SECTIONS:
+            raise ValueError("Unknown room filter section: %s" % section)
+        return self.definition.setdefault("room", {}).setdefault(section, {})
+
+    def _section(self, section):
+        if section in GLOBAL_SECTIONS:
+            return self.definition.setdefault(section, {})
+        raise ValueError("Unknown filter section: %s" % section)
+
+    def timeline_limit(self, limit):
+        """Set the maximum number of timeline events returned per room."""
+        self._room_section("timeline")["limit"] = limit
+        return self
+
+    def event_types(self, types, section="timeline"):
+        """Only return events of the given types.
+
+        Args:
+            types (list): Event types. '*' can be used as a wildcard. An empty list
+                excludes every event of the section.
+            section (str): One of "state", "timeline", "ephemeral" or "account_data"
+                for room events, or "presence" and "global_account_data".
+        """
+        self._filter_for(section)["types"] = list(types)
+        return self
+
+    def not_event_types(self, types, section="timeline"):
+        """Exclude events of the given types. See ``event_types``."""
+        self._filter_for(section)["not_types"] = list(types)
+        return self
+
+    def senders(self, senders, section="timeline"):
+        """Only return events sent by the given users. See ``event_types``."""
+        self._filter_for(section)["senders"] = list(senders)
+        return self
+
+    def rooms(self, room_ids):
+        """Only return events from the given rooms."""
+        self.definition.setdefault("room", {})["rooms"] = list(room_ids)
+        return self
+
+    def lazy_load_members(self, enabled=True):
+        """Only send the membership events of users relevant to the timeline."""
+        self._room_section("state")["lazy_load_members"] = enabled
+        self._room_section("timeline")["lazy_load_members"] = enabled
+        return self
+
+    def event_fields(self, fields):
+        """Only include the given fields in returned events, e.g. "content.body"."""
+        self.definition["event_fields"] = list(fields)
+        return self
+
+    def event_format(self, event_format):
+        """Set the event format, either "client" or "federation"."""
+        self.definition["event_format"] = event_format
+        return self
+
+    def _filter_for(self, section):
+        if section == "global_account_data":
+            return self._section("account_data")
+        if section in ROOM_SECTIONS:
+            return self._room_section(section)
+        return self._section(section)
+
+    def to_dict(self):
+        return deepcopy(self.definition)
+
+    def to_json(self):
+        return canonical_filter(self.definition)
+
+    def __str__(self):
+        return self.to_json()
+
+    def __eq__(self, other):
+        if isinstance(other, SyncFilter):
+            return self.definition == other.definition
+        return NotImplemented
+
+    def __ne__(self, other):
+        return not self == other
+
+
+def filter_includes(sync_filter, event_type, section="state"):
+    """Whether a filter lets the room events of a type through.
+
+    Args:
+        sync_filter (str|dict|SyncFilter): A filter definition, or None.
+        event_type (str): The event type.
+        section (str): One of ``ROOM_SECTIONS``.
+    """
+    # The definition behind a filter ID is unknown
+    if not sync_filter or is_filter_id(sync_filter):
+        return True
+    section_filter = filter_to_dict(sync_filter).get("room", {}).get(section, {})
+    # Types may end with a * wildcard
+    if any(fnmatch.fnmatchcase(event_type, pattern)
+           for pattern in section_filter.get("not_types", ())):
+        return False
+    types = section_filter.get("types")
+    return types is None or any(fnmatch.fnmatchcase(event_type, pattern)
+                                for pattern in types)
+
+
+def filter_for_listeners(base_filter, timeline_types=None, state_types=None,
+                         ephemeral_types=None, presence=True, account_data=False):
+    """Restrict a filter to the events some consumers need.
+
+    Types arguments are collections of event types, or None to keep every event
+    of the section. Sections without consumer should be given an empty collection.
+
+    Args:
+        base_filter (str|dict|SyncFilter): The filter to restrict, e.g. to keep its
+            timeline limit.
+        timeline_types (set): Types of room timeline events.
+        state_types (set): Types of room state events.
+        ephemeral_types (set): Types of room ephemeral events.
+        presence (bool): Whether presence events are needed.
+        account_data (bool): Whether account data events are needed.
+
+    Returns:
+        SyncFilter
+    """
+    sync_filter = SyncFilter(filter_to_dict(base_filter) if base_filter else None)
+    for section, types in (("timeline", timeline_types), ("state", state_types),
+                           ("ephemeral", ephemeral_types)):
+        if types is not None:
+            sync_filter.event_types(sorted(types), section=section)
+    if not presence:
+        sync_filter.event_types([], section="presence")
+    if not account_data:
+        sync_filter.event_types([], section="account_data")
+        sync_filter.event_types([], section="global_account_data")
+    return sync_filter
+
+
+class FilterCache(object):
+    """Maps filter definitions to the IDs the homeserver assigned them.
+
+    Entries are keyed by user ID and filter hash. When given a path, the cache is
+    loaded from and saved to a JSON file, so filters are only uploaded once across
+    restarts.
+
+    Args:
+        path (str): Optional. File to persist the cache to.
+    """
+
+    def __init__(self, path=None):
+        self.path = path
+        self._lock = Lock()
+        self._ids = {}
+        if path and os.path.exists(path):
+            with open(path) as f:
+                self._ids = json.load(f)
+
+    @staticmethod
+    def _key(user_id, sync_filter_hash):
+        return "%s|%s" % (user_id, sync_filter_hash)
+
+    def get(self, user_id, sync_filter_hash):
+        """Return the cached filter ID, or None."""
+        return self._ids.get(self._key(user_id, sync_filter_hash))
+
+    def set(self, user_id, sync_filter_hash, filter_id):
+        with self._lock:
+            self._ids[self._key(user_id, sync_filter_hash)] = filter_id
+            self._save()
+
+    def invalidate(self, user_id, filter_id):
+        """Forget a filter ID, e.g. once the homeserver rejected it.
+
+        Returns:
+            bool: Whether it was cached.
+        """
+        prefix = self._key(user_id, "")
+        with self._lock:
+            keys = [key for key, value in self._ids.items()
+                    if value == filter_id and key.startswith(prefix)]
+            for key in keys:
+                del self._ids[key]
+            if keys:
+                self._save()
+        return bool(keys)
+
+    def _save(self):
+        if self.path:
+            tmp_path = self.path + ".tmp"
+            with open(tmp_path, "w") as f:
+                json.dump(self._ids, f, sort_keys=True)
+            # Atomic replacement, so a crash never leaves a truncated file
+            if os.name == "nt" and os.path.exists(self.path):
+                os.remove(self.path)
+            os.rename(tmp_path, self.path)
@@ -0,0 +1,119 @@
+# -*- coding: utf-8 -*-
+# Copyright 2015 OpenMarket Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+from collections import OrderedDict
+from heapq import merge
+from itertools import count
+from threading import Lock
+from uuid import uuid4
+
+
+class ListenerRegistry(object):
+    """Listeners indexed by the event type they are registered for.
+
+    Listeners are dicts with the keys 'uid', 'callback', 'event_type' and
+    'local_echo', an event_type of None matching every event. Adding and removing a
+    listener is O(1), and finding the listeners of an event only looks at its type
+    and at the wildcard listeners. Iterating over the registry yields every listener
+    in the order they were added.
+    """
+
+    def __init__(self):
+        self._lock = Lock()
+        self._seq = count()
+        # uid: (seq, listener), in insertion order
+        self._by_uid = OrderedDict()
+        # event_type: {uid: (seq, listener)}, None holding the wildcard listeners
+        self._by_type = {}
+
+    def add(self, callback, event_type=None, local_echo=False):
+        """Register a callback.
+
+        Args:
+            callback (func): The callback.
+            event_type (str): Optional. The event type to filter for.
+            local_echo (bool): Optional. Whether to also call it by
+                ``dispatch_local``.
+
+        Returns:
+            uuid.UUID: Unique id of the listener.
+        """
+        uid = uuid4()
+        listener = {'uid': uid, 'callback': callback, 'event_type': event_type,
+                    'local_echo': local_echo}
+        with self._lock:
+            entry = (next(self._seq), listener)
+            self._by_uid[uid] = entry
+            self._by_type.setdefault(event_type, OrderedDict())[uid] = entry
+        return uid
+
+    def remove(self, uid):
+        """Remove the listener with the given uid.
+
+        Returns:
+            bool: Whether a listener was removed.
+        """
+        with self._lock:
+            entry = self._by_uid.pop(uid, None)
+            if entry is None:
+                return False
+            event_type = entry[1]['event_type']
+            bucket = self._by_type[event_type]
+            del bucket[uid]
+            if not bucket:
+                del self._by_type[event_type]
+        return True
+
+    def matching(self, event_type):
+        """Return the listeners for an event type, in the order they were added."""
+        with self._lock:
+            typed = self._by_type.get(event_type)
+            wildcard = self._by_type.get(None)
+            if not typed or event_type is None:
+                entries = list(wildcard.values()) if wildcard else []
+            elif not wildcard:
+                entries = list(typed.values())
+            else:
+                # Sequence numbers are unique, so listener dicts are never compared
+                entries = list(merge(typed.values(), wildcard.values()))
+        return [listener for _, listener in entries]
+
+    def dispatch(self, event, *args):
+        """Call the listeners matching an event with ``args + (event,)``."""
+        for listener in self.matching(event['type']):
+            listener['callback'](*(args + (event,)))
+
+    def dispatch_local(self, event, *args):
+        """Like ``dispatch``, only calling the listeners added with
+        ``local_echo``."""
+        for listener in self.matching(event['type']):
+            if listener['local_echo']:
+                listener['callback'](*(args + (event,)))
+
+    def event_types(self):
+        """Return the set of event types listened for, including None if any
+        listener matches every event."""
+        with self._lock:
+            return set(self._by_type)
+
+    def __iter__(self):
+        with self._lock:
+            entries = list(self._by_uid.values())
+        return iter([listener for _, listener in entries])
+
+    def __len__(self):
+        return len(self._by_uid)
+
+    def __contains__(self, uid):
+        return uid in self._by_uid
@@ -0,0 +1,249 @@
+# -*- coding: utf-8 -*-
+# Copyright 2015 OpenMarket Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import hashlib
+import io
+import os
+import sqlite3
+from collections import OrderedDict
+from threading import Lock
+
+BLOCK_SIZE = 1 << 16
+
+
+class MediaCache(object):
+    """A disk cache of downloaded media, with a memory tier for small files.
+
+    Files are keyed by the mxc:// URL they were downloaded from, or the URL and
+    size of a thumbnail, and stored under the SHA-256 of their content: content
+    reached through several keys is stored once. Once the files exceed
+    ``max_bytes``, the least recently used ones are deleted.
+
+    A sequential download which fails leaves a partial file behind, which the next
+    download of the same key resumes from, even after a restart.
+
+    Args:
+        path (str): Directory of the cache. Created if it does not exist.
+        max_bytes (int): Optional. Maximum size of the files on disk.
+        memory_bytes (int): Optional. Maximum size of the files also kept in
+            memory. 0 disables the memory tier.
+        memory_item_bytes (int): Optional. Maximum size of a file kept in memory.
+
+    Example::
+
+        client = MatrixClient("https://matrix.org", token="foobar",
+                              user_id="@foobar:matrix.org",
+                              media_cache=MediaCache("/var/cache/bot/media"))
+        with open("avatar.png", "wb") as f:
+            client.download("mxc://matrix.org/avatar", f)
+    """
+
+    def __init__(self, path, max_bytes=1 << 30, memory_bytes=16 << 20,
+                 memory_item_bytes=256 << 10):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.memory_bytes = memory_bytes
+        self.memory_item_bytes = memory_item_bytes
+        for directory in ("blobs", "partial"):
+            directory = os.path.join(path, directory)
+            if not os.path.isdir(directory):
+                os.makedirs(directory)
+        self._lock = Lock()
+        # Downloads of the same key are serialized, as they share a partial file
+        self._fetch_locks = [Lock() for _ in range(64)]
+        # key: content, least recently used first
+        self._memory = OrderedDict()
+        self.memory_size = 0
+        self._db = sqlite3.connect(os.path.join(path, "index.sqlite"),
+                                   check_same_thread=False)
+        with self._lock:
+            self._db.executescript("""
+                PRAGMA journal_mode=WAL;
+                PRAGMA synchronous=NORMAL;
+                CREATE TABLE IF NOT EXISTS blobs (
+                    hash TEXT PRIMARY KEY,
+                    size INTEGER,
+                    used INTEGER
+                );
+                CREATE TABLE IF NOT EXISTS keys (
+                    key TEXT PRIMARY KEY,
+                    hash TEXT
+                );
+            """)
+            self._db.commit()
+            self.size, last_used = self._db.execute(
+                "SELECT COALESCE(SUM(size), 0), COALESCE(MAX(used), 0) FROM blobs"
+            ).fetchone()
+        # Incremented on every access, to order the files by last use
+        self._clock = last_used
+
+    def open(self, key):
+        """Return the cached content of a key, as a file object, or None."""
+        with self._lock:
+            data = self._memory.pop(key, None)
+            if data is not None:
+                self._memory[key] = data
+                return io.BytesIO(data)
+            row = self._db.execute(
+                "SELECT blobs.hash, blobs.size FROM keys JOIN blobs USING (hash) "
+                "WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                return None
+            content_hash, size = row
+            try:
+                f = open(self._blob_path(content_hash), "rb")
+            except (IOError, OSError):
+                # Deleted behind our back
+                self._remove_blob(content_hash, size)
+                self._db.commit()
+                return None
+            self._touch(content_hash)
+            self._db.commit()
+            return self._remember(key, f, size)
+
+    def fetch(self, key, download, download_file=None):
+        """Return the content of a key, downloading it if it is not cached.
+
+        Args:
+            key (str): The key.
+            download (func(offset)): Returns an iterable of the content, in chunks,
+                starting ``offset`` bytes in.
+            download_file (func(fileobj)): Optional. Writes the content into a
+                file, e.g. in parallel parts. Used instead of ``download`` unless
+                a partial file is left to resume.
+
+        Returns:
+            file: The content, opened for reading.
+        """
+        f = self.open(key)
+        if f is not None:
+            return f
+        with self._fetch_locks[hash(key) % len(self._fetch_locks)]:
+            # Another thread may have downloaded it meanwhile
+            f = self.open(key)
+            if f is None:
+                f = self._download(key, download, download_file)
+        return f
+
+    def _download(self, key, download, download_file):
+        partial = os.path.join(self.path, "partial", _sha256(key.encode("utf-8")))
+        digest = hashlib.sha256()
+        if download_file is not None and not os.path.exists(partial):
+            try:
+                with open(partial, "w+b") as f:
+                    download_file(f)
+                    f.seek(0)
+                    for block in iter(lambda: f.read(BLOCK_SIZE), b""):
+                        digest.update(block)
+            except BaseException:
+                # Unlike sequential downloads, it cannot be resumed
+                os.remove(partial)
+                raise
+        else:
+            offset = 0
+            if os.path.exists(partial):
+                with open(partial, "rb") as f:
+                    for block in iter(lambda: f.read(BLOCK_SIZE), b""):
+                        digest.update(block)
+                        offset += len(block)
+            with open(partial, "ab") as f:
+                for chunk in download(offset):
+                    f.write(chunk)
+                    digest.update(chunk)
+        content_hash = digest.hexdigest()
+        size = os.path.getsize(partial)
+        blob = self._blob_path(content_hash)
+        with self._lock:
+            if os.path.exists(blob):
+                os.remove(partial)
+            else:
+                if not os.path.isdir(os.path.dirname(blob)):
+                    os.makedirs(os.path.dirname(blob))
+                os.rename(partial, blob)
+            if self._db.execute("INSERT OR IGNORE INTO blobs VALUES (?, ?, ?)",
+                                (content_hash, size, 0)).rowcount:
+                self.size += size
+            self._touch(content_hash)
+            self._db.execute("INSERT OR REPLACE INTO keys VALUES (?, ?)",
+                             (key, content_hash))
+            # Opened before evicting, so that the file outlives its eviction
+            f = open(blob, "rb")
+            self._evict(content_hash)
+            self._db.commit()
+            return self._remember(key, f, size)
+
+    def _blob_path(self, content_hash):
+        return os.path.join(self.path, "blobs", content_hash[:2], content_hash)
+
+    def _touch(self, content_hash):
+        self._clock += 1
+        self._db.execute("UPDATE blobs SET used = ? WHERE hash = ?",
+                         (self._clock, content_hash))
+
+    def _remember(self, key, f, size):
+        """Keep the content of a small file in memory, returning a file object
+        reading it."""
+        if not self.memory_bytes or size > self.memory_item_bytes:
+            return f
+        with f:
+            data = f.read()
+        self._memory[key] = data
+        self.memory_size += len(data)
+        while self.memory_size > self.memory_bytes:
+            self.memory_size -= len(self._memory.popitem(last=False)[1])
+        return io.BytesIO(data)
+
+    def _evict(self, keep):
+        if self.size <= self.max_bytes:
+            return
+        rows = self._db.execute("SELECT hash, size FROM blobs WHERE hash != ? "
+                                "ORDER BY used", (keep,)).fetchall()
+        for content_hash, size in rows:
+            if self.size <= self.max_bytes:
+                break
+            self._remove_blob(content_hash, size)
+
+    def _remove_blob(self, content_hash, size):
+        self._db.execute("DELETE FROM blobs WHERE hash = ?", (content_hash,))
+        self._db.execute("DELETE FROM keys WHERE hash = ?", (content_hash,))
+        self.size -= size
+        try:
+            os.remove(self._blob_path(content_hash))
+        except OSError:
+            pass
+
+    def clear(self):
+        """Remove every file."""
+        with self._lock:
+            for content_hash, size in self._db.execute(
+                    "SELECT hash, size FROM blobs").fetchall():
+                self._remove_blob(content_hash, size)
+            self._db.commit()
+            self._memory.clear()
+            self.memory_size = 0
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+
+def iter_file(fileobj, chunk_size=BLOCK_SIZE):
+    """Yield the content of a file object in chunks, closing it at the end."""
+    with fileobj:
+        for chunk in iter(lambda: fileobj.read(chunk_size), b""):
+            yield chunk
+
+
+def _sha256(data):
+    return hashlib.sha256(data).hexdigest()
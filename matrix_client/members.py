@@ -0,0 +1,115 @@
+# -*- coding: utf-8 -*-
+# Copyright 2015 OpenMarket Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+from collections import OrderedDict
+
+
+class MemberStore(object):
+    """The members of a room, indexed by user ID.
+
+    Joined members are kept as User objects, in the order they joined. The latest
+    membership of every user seen is recorded as well. Every update is O(1).
+
+    Args:
+        track_changes (bool): Optional. Record the changes made, to be retrieved
+            with ``pop_changes``, e.g. to persist them.
+    """
+
+    def __init__(self, track_changes=False):
+        self._joined = OrderedDict()
+        self._memberships = {}
+        # Cached result of joined(), reset on every change
+        self._joined_list = None
+        # user_id: (membership, displayname), since the last pop_changes(), in the
+        # order members joined
+        self._changes = OrderedDict() if track_changes else None
+
+    def add(self, user):
+        """Record that a user joined.
+
+        If the user is already a member, only their display name is updated.
+        """
+        self._memberships[user.user_id] = "join"
+        if user.user_id in self._joined:
+            self.set_display_name(user.user_id, user.displayname)
+        else:
+            self._joined[user.user_id] = user
+            self._joined_list = None
+            if self._changes is not None:
+                # Members who join again move to the end
+                self._changes.pop(user.user_id, None)
+            self._changed(user.user_id)
+
+    def remove(self, user_id, membership="leave"):
+        """Record that a user is no longer joined.
+
+        Args:
+            user_id (str): The user.
+            membership (str): Their new membership, e.g. "leave", "invite" or "ban".
+        """
+        self._memberships[user_id] = membership
+        if self._joined.pop(user_id, None) is not None:
+            self._joined_list = None
+        self._changed(user_id)
+
+    def set_display_name(self, user_id, displayname):
+        """Update the display name of a joined member. None is ignored."""
+        member = self._joined.get(user_id)
+        if member is not None and displayname is not None:
+            member.displayname = displayname
+            self._changed(user_id)
+
+    def _changed(self, user_id):
+        if self._changes is not None:
+            self._changes[user_id] = (self._memberships.get(user_id),
+                                      self.display_name(user_id))
+
+    def pop_changes(self):
+        """Return the changes since the last call, as an OrderedDict mapping user
+        IDs to ``(membership, displayname)`` tuples."""
+        changes = self._changes or OrderedDict()
+        if self._changes is not None:
+            self._changes = OrderedDict()
+        return changes
+
+    def get(self, user_id):
+        """Return the User object of a joined member, or None."""
+        return self._joined.get(user_id)
+
+    def membership(self, user_id):
+        """Return the latest known membership of a user, or None."""
+        return self._memberships.get(user_id)
+
+    def display_name(self, user_id):
+        """Return the cached display name of a joined member, or None."""
+        member = self._joined.get(user_id)
+        return member.displayname if member is not None else None
+
+    def joined(self):
+        """Return the list of joined members, in the order they joined.
+
+        The list is shared until the next change and must not be modified.
+        """
+        if self._joined_list is None:
+            self._joined_list = list(self._joined.values())
+        return self._joined_list
+
+    def __len__(self):
+        return len(self._joined)
+
+    def __contains__(self, user_id):
+        return user_id in self._joined
+
+    def __iter__(self):
+        return iter(self.joined())
@@ -0,0 +1,99 @@
+# -*- coding: utf-8 -*-
+# Copyright 2015 OpenMarket Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import time
+from collections import OrderedDict
+from threading import Lock
+
+
+class ProfileCache(object):
+    """A bounded cache of user profiles, shared by the users of a client.
+
+    Profiles are dicts which may hold a ``displayname`` and an ``avatar_url``. They
+    are fed from the /profile responses, and expire ``ttl`` seconds after their
+    last update. Names set in ``m.room.member`` events only apply to their room,
+    and are kept by its members instead. Once ``max_size`` is reached, the least
+    recently used profile is dropped.
+
+    Args:
+        max_size (int): Maximum number of profiles kept.
+        ttl (float): Seconds a profile is kept after being updated. None keeps it
+            until it is evicted.
+        clock (func()): Optional. Returns the current time, in seconds.
+
+    Example::
+
+        client = MatrixClient("https://matrix.org", token="foobar",
+                              user_id="@foobar:matrix.org",
+                              profile_cache=ProfileCache(max_size=50000, ttl=600))
+    """
+
+    def __init__(self, max_size=10000, ttl=3600, clock=time.time):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._clock = clock
+        self._lock = Lock()
+        # user_id: (expiry, profile), least recently used first
+        self._profiles = OrderedDict()
+
+    def get(self, user_id, field):
+        """Return a field of a cached profile.
+
+        Args:
+            user_id (str): The user.
+            field (str): "displayname" or "avatar_url".
+
+        Raises:
+            KeyError: If the field is not cached, or has expired. A cached None
+                means the user has no such field.
+        """
+        with self._lock:
+            expiry, profile = self._profiles[user_id]
+            if expiry is not None and expiry <= self._clock():
+                del self._profiles[user_id]
+                raise KeyError(user_id)
+            value = profile[field]
+            self._profiles[user_id] = self._profiles.pop(user_id)
+            return value
+
+    def update(self, user_id, **fields):
+        """Merge fields into the profile of a user, resetting its expiry."""
+        if not self.max_size:
+            return
+        with self._lock:
+            now = self._clock()
+            entry = self._profiles.pop(user_id, None)
+            if entry is None or (entry[0] is not None and entry[0] <= now):
+                profile = {}
+            else:
+                profile = entry[1]
+            profile.update(fields)
+            expiry = now + self.ttl if self.ttl is not None else None
+            self._profiles[user_id] = (expiry, profile)
+            while len(self._profiles) > self.max_size:
+                self._profiles.popitem(last=False)
+
+    def invalidate(self, user_id):
+        with self._lock:
+            self._profiles.pop(user_id, None)
+
+    def clear(self):
+        with self._lock:
+            self._profiles.clear()
+
+    def __contains__(self, user_id):
+        return user_id in self._profiles
+
+    def __len__(self):
+        return len(self._profiles)
@@ -0,0 +1,190 @@
+# -*- coding: utf-8 -*-
+# Copyright 2015 OpenMarket Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import re
+from threading import Lock
+from time import time
+
+# Endpoint classes used to key the token buckets
+SEND = "send"
+STATE = "state"
+PROFILE = "profile"
+MEDIA = "media"
+KEYS = "keys"
+OTHER = "other"
+
+ENDPOINT_CLASSES = (SEND, STATE, PROFILE, MEDIA, KEYS, OTHER)
+
+_STATE_RE = re.compile(r"^/rooms/[^/]+/(state|invite|ban|unban|kick|join|leave|forget)")
+_SEND_RE = re.compile(r"^/rooms/[^/]+/(send|redact)/")
+
+
+def classify_endpoint(method, path, api_path=""):
+    """Return the endpoint class a request is rate limited under.
+
+    Args:
+        method (str): The HTTP method.
+        path (str): The path of the request, relative to ``api_path``.
+        api_path (str): The API prefix, e.g. '/_matrix/client/r0'.
+    """
+    if api_path.startswith("/_matrix/media"):
+        return MEDIA
+    if _SEND_RE.match(path):
+        return SEND
+    if path.startswith("/join/") or (method != "GET" and _STATE_RE.match(path)):
+        return STATE
+    if path.startswith("/profile/"):
+        return PROFILE
+    if path.startswith("/keys/") or path.startswith("/sendToDevice/"):
+        return KEYS
+    return OTHER
+
+
+class TokenBucket(object):
+    """A token bucket which hands out reservations in FIFO order.
+
+    Rather than blocking, ``reserve`` books the next free slot and returns how long
+    the caller has to wait for it, so concurrent callers queue up one interval apart
+    instead of all retrying at the same moment.
+
+    Args:
+        rate (float): Optional. Tokens added per second. None means unlimited until
+            the server rate limits us.
+        burst (int): Number of requests which may be sent back to back.
+        min_rate (float): Lower bound for learned rates.
+        max_rate (float): Once a learned rate grows past this, the bucket goes back
+            to its configured rate.
+    """
+
+    def __init__(self, rate=None, burst=1, min_rate=0.05, max_rate=50.0):
+        self.configured_rate = float(rate) if rate else None
+        self.rate = self.configured_rate
+        self.burst = max(1, burst)
+        self.min_rate = min_rate
+        self.max_rate = max_rate
+        self.blocked_until = 0.0
+        # Theoretical arrival time of the next request (GCRA)
+        self._tat = 0.0
+
+    def _delay(self, now):
+        delay = max(0.0, self.blocked_until - now)
+        if self.rate:
+            tolerance = (self.burst - 1) / self.rate
+            delay = max(delay, self._tat - tolerance - now)
+        return delay
+
+    def wait_time(self, now=None):
+        """Seconds a request issued now would have to wait."""
+        return self._delay(time() if now is None else now)
+
+    def reserve(self, now=None):
+        """Book a slot for one request.
+
+        Returns:
+            float: Seconds to wait before sending the request.
+        """
+        now = time() if now is None else now
+        delay = self._delay(now)
+        if self.rate:
+            self._tat = max(self._tat, now + delay) + 1.0 / self.rate
+        return delay
+
+    def rate_limited(self, retry_after, now=None):
+        """Learn from a HTTP 429 response.
+
+        Args:
+            retry_after (float): Seconds the server asked us to wait.
+        """
+        now = time() if now is None else now
+        self.blocked_until = max(self.blocked_until, now + retry_after)
+        self._tat = max(self._tat, self.blocked_until)
+        learned = self.max_rate
+        if retry_after > 0:
+            learned = min(learned, 1.0 / retry_after)
+        if self.rate:
+            learned = min(learned, self.rate / 2)
+        self.rate = max(self.min_rate, learned)
+
+    def success(self):
+        """Slowly grow a learned rate back after a successful request."""
+        if self.rate is None or self.rate == self.configured_rate:
+            return
+        self.rate *= 1.1
+        if self.configured_rate is not None and self.rate >= self.configured_rate:
+            self.rate = self.configured_rate
+        elif self.rate > self.max_rate:
+            self.rate = self.configured_rate
+
+
+class RateLimiter(object):
+    """Client-side rate limiting, with one token bucket per endpoint class.
+
+    Buckets start unlimited unless given a rate, and learn from the
+    ``retry_after_ms`` of HTTP 429 responses.
+
+    Args:
+        rates (dict): Optional. Maps endpoint classes to ``(rate, burst)`` tuples,
+            rate being in requests per second.
+
+    Example::
+
+        limiter = RateLimiter({ratelimit.SEND: (0.2, 10)})
+        api = MatrixHttpApi("https://matrix.org", token="foobar",
+                            rate_limiter=limiter)
+    """
+
+    def __init__(self, rates=None):
+        rates = rates or {}
+        self._lock = Lock()
+        self.buckets = {}
+        for endpoint_class in ENDPOINT_CLASSES:
+            rate, burst = rates.get(endpoint_class, (None, 1))
+            self.buckets[endpoint_class] = TokenBucket(rate, burst)
+
+    def classify(self, method, path, api_path=""):
+        return classify_endpoint(method, path, api_path)
+
+    def reserve(self, endpoint_class):
+        """Book a slot for one request of the given class.
+
+        Returns:
+            float: Seconds to wait before sending the request.
+        """
+        with self._lock:
+            return self.buckets[endpoint_class].reserve()
+
+    def rate_limited(self, endpoint_class, retry_after):
+        """Record a HTTP 429 response.
+
+        Args:
+            endpoint_class (str): The class of the rate limited request.
+            retry_after (float): Seconds the server asked us to wait.
+        """
+        with self._lock:
+            self.buckets[endpoint_class].rate_limited(retry_after)
+
+    def success(self, endpoint_class):
+        with self._lock:
+            self.buckets[endpoint_class].success()
+
+    def wait_time(self, endpoint_class):
+        """Seconds a request of the given class issued now would have to wait."""
+        with self._lock:
+            return self.buckets[endpoint_class].wait_time()
+
+    def wait_times(self):
+        """Return a dict of the current wait time of every endpoint class."""
+        with self._lock:
+            now = time()
+            return {c: b.wait_time(now) for c, b in self.buckets.items()}
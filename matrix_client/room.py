@@ -14,11 +14,27 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 import re
-from uuid import uuid4
+import time
+from collections import OrderedDict, deque
+from functools import partial
+from threading import Lock
 
 from .checks import check_room_id
+from .listeners import ListenerRegistry
+from .members import MemberStore
+from .timeline import Timeline
 from .user import User
-from .errors import MatrixRequestError
+from .errors import MatrixError, MatrixRequestError
+
+
+# State events whose content is cached on Room objects
+TRACKED_STATE_EVENTS = frozenset([
+    "m.room.name", "m.room.canonical_alias", "m.room.topic", "m.room.aliases",
+    "m.room.join_rules", "m.room.guest_access", "m.room.encryption",
+])
+# Room attributes derived from the state events above
+STATE_ATTRIBUTES = ("name", "canonical_alias", "topic", "aliases", "invite_only",
+                    "guest_access", "encrypted", "summary")
 
 
 class Room(object):
@@ -26,18 +42,31 @@ class Room(object):
 
     NOTE: This should ideally be called from within the Client.
     NOTE: This does not verify the room with the Home Server.
+
+    Attributes:
+        members (MemberStore): The members of the room, tracked from state events
+            when the client's cache level is CACHE.ALL.
+        events (Timeline): The most recent events of the room, at most
+            ``event_history_limit``. May be empty if evicted by the client's
+            ``event_cache``, see ``get_events``.
+        pending_events (dict): The local echoes of the events being sent, by
+            transaction ID, when the client's ``local_echo`` is set.
+        summary (dict): The latest room summary received in sync, with the
+            ``m.heroes``, ``m.joined_member_count`` and ``m.invited_member_count``
+            fields.
     """
 
+    _user_class = User
+
     def __init__(self, client, room_id):
         check_room_id(room_id)
 
         self.room_id = room_id
         self.client = client
-        self.listeners = []
-        self.state_listeners = []
-        self.ephemeral_listeners = []
-        self.events = []
-        self.event_history_limit = 20
+        self.listeners = ListenerRegistry()
+        self.state_listeners = ListenerRegistry()
+        self.ephemeral_listeners = ListenerRegistry()
+        self.events = Timeline(20, cache=client.event_cache)
         self.name = None
         self.canonical_alias = None
         self.aliases = []
@@ -45,8 +74,16 @@ class Room(object):
         self.invite_only = None
         self.guest_access = None
         self._prev_batch = None
-        self._members = []
-        self.encrypted = False
+        self.members = MemberStore(track_changes=client.store is not None)
+        # None until known, if it was not reported by sync
+        self._encrypted = False
+        self.summary = {}
+        self.pending_events = OrderedDict()
+        # Local echoes are added from the sending threads, and reconciled from the
+        # sync thread
+        self._echo_lock = Lock()
+        # Name computed from the members, reset when they or the summary change
+        self._members_name = None
 
     def set_user_profile(self,
                          displayname=None,
@@ -76,33 +113,182 @@ class Room(object):
 
     @property
     def display_name(self):
-        """Calculates the display name for a room."""
+        """Calculates the display name for a room.
+
+        Unless the room has a name or an alias, it is built from the heroes of the
+        room summary, or else from the joined members, which are only fetched if
+        not cached. The result is memoized until the members or summary change.
+        """
         if self.name:
             return self.name
         elif self.canonical_alias:
             return self.canonical_alias
+        if self._members_name is None:
+            self._members_name = self._calculate_members_name(self.get_joined_members)
+        return self._members_name
+
+    def _calculate_members_name(self, get_members):
+        """Build a room name from its members, without any profile request.
 
-        # Member display names without me
-        members = [u.get_display_name() for u in self.get_joined_members() if
-                   self.client.user_id != u.user_id]
-        first_two = members[:2]
-        if len(first_two) == 1:
-            return first_two[0]
-        elif len(members) == 2:
-            return "{0} and {1}".format(
-                first_two[0],
-                first_two[1])
-        elif len(members) > 2:
-            return "{0} and {1} others".format(
-                first_two[0],
-                len(members) - 1)
-        else:  # len(members) <= 0 or not an integer
+        Args:
+            get_members (func()): Returns the joined members, used when the summary
+                has no heroes.
+        """
+        heroes = self.summary.get("m.heroes")
+        if heroes:
+            names = [self._member_name(user_id) for user_id in heroes
+                     if user_id != self.client.user_id]
+            if ("m.joined_member_count" in self.summary or
+                    "m.invited_member_count" in self.summary):
+                others = (self.summary.get("m.joined_member_count", 0) +
+                          self.summary.get("m.invited_member_count", 0) - 1)
+            else:
+                others = len(names)
+        else:
+            # Member display names without me
+            names = [u.displayname or self._member_name(u.user_id)
+                     for u in get_members() if self.client.user_id != u.user_id]
+            others = len(names)
+
+        if not names or others <= 0:
             # TODO i18n
             return "Empty room"
+        elif others == 1:
+            return names[0]
+        elif others == 2 and len(names) >= 2:
+            return "{0} and {1}".format(names[0], names[1])
+        else:
+            return "{0} and {1} others".format(names[0], others - 1)
+
+    def _member_name(self, user_id):
+        """Return the cached display name of a user, falling back to their ID."""
+        name = self.members.display_name(user_id)
+        if name is None:
+            try:
+                name = self.client.profile_cache.get(user_id, "displayname")
+            except KeyError:
+                pass
+        return name or user_id
+
+    def _set_summary(self, summary):
+        """Update the room summary from a sync response, which only contains the
+        fields that changed."""
+        if summary:
+            self.summary.update(summary)
+            self._members_name = None
 
     def send_text(self, text):
         """Send a plain text message to the room."""
-        return self.client.api.send_message(self.room_id, text)
+        return self._send_message_event("m.room.message",
+                                        self.client.api.get_text_body(text))
+
+    def _send_message_event(self, event_type, content):
+        txn_id = self._local_echo(event_type, content)
+        try:
+            return self.client.api.send_message_event(self.room_id, event_type,
+                                                      content, txn_id=txn_id)
+        except Exception:
+            self._local_echo_failed(txn_id)
+            raise
+
+    def _local_echo(self, event_type, content):
+        """Add a pending event to the timeline, if the client's ``local_echo`` is
+        set, and call the listeners added with ``local_echo``. If one of them
+        raises, the echo is marked failed.
+
+        Returns:
+            str: The transaction ID to send the event with, or None.
+        """
+        if not self.client.local_echo:
+            return None
+        txn_id = self.client.api._make_txn_id()
+        event = {
+            "type": event_type,
+            "content": content,
+            "sender": self.client.user_id,
+            "room_id": self.room_id,
+            "origin_server_ts": int(time.time() * 1000),
+            "unsigned": {"transaction_id": txn_id},
+        }
+        with self._echo_lock:
+            self.pending_events[txn_id] = event
+            self.events.append(event)
+        try:
+            self.client._dispatch(self.room_id, self._dispatch_local, event)
+        except Exception:
+            # The event is not sent, so its echo will not be reconciled
+            with self._echo_lock:
+                self.pending_events.pop(txn_id, None)
+                event["unsigned"]["failed"] = True
+            raise
+        return txn_id
+
+    def _dispatch_local(self, event):
+        self.client.listeners.dispatch_local(event)
+        self.listeners.dispatch_local(event, self)
+
+    def _local_echo_failed(self, txn_id):
+        """Mark the local echo of an event which could not be sent, and call the
+        ``local_echo`` listeners with it again."""
+        if not txn_id:
+            return
+        with self._echo_lock:
+            event = self.pending_events.pop(txn_id, None)
+            if event is None:
+                return
+            event["unsigned"]["failed"] = True
+        self.client._dispatch(self.room_id, self._dispatch_local, event)
+
+    def _reconcile(self, event):
+        """Merge the remote echo of an event sent from this client into its local
+        echo, which keeps its place in the timeline, or is appended again if it
+        was pushed out of it meanwhile. Called with ``_echo_lock`` held.
+
+        Returns:
+            dict: The local echo, updated, or None if the event had none.
+        """
+        txn_id = event.get("unsigned", {}).get("transaction_id")
+        pending = self.pending_events.pop(txn_id, None) if txn_id else None
+        if pending is None:
+            return None
+        pending.clear()
+        pending.update(event)
+        if (self.events.position(event.get("event_id")) is None and
+                not self.events.reindex(pending)):
+            self.events.append(pending)
+        return pending
+
+    def queue_event(self, event_type, content):
+        """Send a message event in the background, after the events already queued
+        for this room, retrying on failure.
+
+        Args:
+            event_type (str): The event type.
+            content (dict): The event content.
+
+        Returns:
+            concurrent.futures.Future: Resolves to the ID of the event. See
+            :class:`~matrix_client.send_queue.SendQueue`.
+        """
+        txn_id = self._local_echo(event_type, content)
+        future = self.client.send_queue.send(self.room_id, event_type, content,
+                                             txn_id=txn_id)
+        if txn_id:
+            future.add_done_callback(partial(self._queued_event_sent, txn_id))
+        return future
+
+    def _queued_event_sent(self, txn_id, future):
+        if future.exception() is not None:
+            self._local_echo_failed(txn_id)
+
+    def queue_text(self, text):
+        """Send a plain text message in the background. See ``queue_event``."""
+        return self.queue_event("m.room.message", {"msgtype": "m.text", "body": text})
+
+    def queue_html(self, html, body=None, msgtype="m.text"):
+        """Send an html formatted message in the background. See ``queue_event``."""
+        return self.queue_event("m.room.message",
+                                self.get_html_content(html, body, msgtype))
 
     def get_html_content(self, html, body=None, msgtype="m.text"):
         return {
@@ -119,8 +305,8 @@ class Room(object):
             html (str): The html formatted message to be sent.
             body (str): The unformatted body of the message to be sent.
         """
-        return self.client.api.send_message_event(
-            self.room_id, "m.room.message", self.get_html_content(html, body, msgtype))
+        return self._send_message_event("m.room.message",
+                                        self.get_html_content(html, body, msgtype))
 
     def set_account_data(self, type, account_data):
         return self.client.api.set_room_account_data(
@@ -142,7 +328,8 @@ class Room(object):
 
     def send_emote(self, text):
         """Send an emote (/me style) message to the room."""
-        return self.client.api.send_emote(self.room_id, text)
+        return self._send_message_event("m.room.message",
+                                        self.client.api.get_emote_body(text))
 
     def send_file(self, url, name, **fileinfo):
         """Send a pre-uploaded file to the room.
@@ -163,7 +350,8 @@ class Room(object):
 
     def send_notice(self, text):
         """Send a notice (from bot) message to the room."""
-        return self.client.api.send_notice(self.room_id, text)
+        return self._send_message_event("m.room.message",
+                                        {"msgtype": "m.notice", "body": text})
 
     # See http://matrix.org/docs/spec/r0.0.1/client_server.html#m-image for the
     # imageinfo args.
@@ -233,29 +421,25 @@ class Room(object):
         """
         return self.client.api.redact_event(self.room_id, event_id, reason)
 
-    def add_listener(self, callback, event_type=None):
+    def add_listener(self, callback, event_type=None, local_echo=False):
         """Add a callback handler for events going to this room.
 
         Args:
             callback (func(room, event)): Callback called when an event arrives.
             event_type (str): The event_type to filter for.
+            local_echo (bool): Optional. Also call it with the local echoes of the
+                events sent, see ``MatrixClient``.
         Returns:
             uuid.UUID: Unique id of the listener, can be used to identify the listener.
         """
-        listener_id = uuid4()
-        self.listeners.append(
-            {
-                'uid': listener_id,
-                'callback': callback,
-                'event_type': event_type
-            }
-        )
+        listener_id = self.listeners.add(callback, event_type, local_echo)
+        self.client._listeners_changed()
         return listener_id
 
     def remove_listener(self, uid):
         """Remove listener with given uid."""
-        self.listeners[:] = (listener for listener in self.listeners
-                             if listener['uid'] != uid)
+        self.listeners.remove(uid)
+        self.client._listeners_changed()
 
     def add_ephemeral_listener(self, callback, event_type=None):
         """Add a callback handler for ephemeral events going to this room.
@@ -266,20 +450,14 @@ class Room(object):
         Returns:
             uuid.UUID: Unique id of the listener, can be used to identify the listener.
         """
-        listener_id = uuid4()
-        self.ephemeral_listeners.append(
-            {
-                'uid': listener_id,
-                'callback': callback,
-                'event_type': event_type
-            }
-        )
+        listener_id = self.ephemeral_listeners.add(callback, event_type)
+        self.client._listeners_changed()
         return listener_id
 
     def remove_ephemeral_listener(self, uid):
         """Remove ephemeral listener with given uid."""
-        self.ephemeral_listeners[:] = (listener for listener in self.ephemeral_listeners
-                                       if listener['uid'] != uid)
+        self.ephemeral_listeners.remove(uid)
+        self.client._listeners_changed()
 
     def add_state_listener(self, callback, event_type=None):
         """Add a callback handler for state events going to this room.
@@ -287,35 +465,75 @@ class Room(object):
         Args:
             callback (func(roomchunk)): Callback called when an event arrives.
             event_type (str): The event_type to filter for.
+        Returns:
+            uuid.UUID: Unique id of the listener, can be used to identify the listener.
         """
-        self.state_listeners.append(
-            {
-                'callback': callback,
-                'event_type': event_type
-            }
-        )
+        listener_id = self.state_listeners.add(callback, event_type)
+        self.client._listeners_changed()
+        return listener_id
+
+    def remove_state_listener(self, uid):
+        """Remove state listener with given uid."""
+        self.state_listeners.remove(uid)
+        self.client._listeners_changed()
 
     def _put_event(self, event):
-        self.events.append(event)
-        if len(self.events) > self.event_history_limit:
-            self.events.pop(0)
+        """Add an event to the timeline, and call the listeners.
+
+        Returns:
+            dict: The event, or its local echo updated with it, which is what the
+            listeners are called with.
+        """
+        with self._echo_lock:
+            local_echo = self._reconcile(event)
+            if local_echo is not None:
+                event = local_echo
+            # Replayed batches may contain events already in the timeline
+            elif self.events.position(event.get("event_id")) is None:
+                self.events.append(event)
         if 'state_key' in event:
             self._process_state_event(event)
 
         # Dispatch for room-specific listeners
-        for listener in self.listeners:
-            if listener['event_type'] is None or listener['event_type'] == event['type']:
-                listener['callback'](self, event)
+        self.client._dispatch_event(self.room_id, "room timeline", event,
+                                    self.listeners.dispatch, event, self)
+        return event
 
     def _put_ephemeral_event(self, event):
         # Dispatch for room-specific listeners
-        for listener in self.ephemeral_listeners:
-            if listener['event_type'] is None or listener['event_type'] == event['type']:
-                listener['callback'](self, event)
+        self.client._dispatch_event(self.room_id, "room ephemeral", event,
+                                    self.ephemeral_listeners.dispatch, event, self)
 
     def get_events(self):
-        """Get the most recent events for this room."""
-        return self.events
+        """Get the most recent events for this room.
+
+        If they were evicted by the client's ``event_cache``, they are fetched
+        from the homeserver again.
+        """
+        if self.events.evicted and self.client.sync_token:
+            self._restore_events(self.client.api.get_room_messages(
+                self.room_id, self.client.sync_token, direction="b",
+                limit=self.event_history_limit))
+        return list(self.events)
+
+    def _restore_events(self, response):
+        """Replace the events of an evicted timeline with a /messages response."""
+        self.events.clear()
+        for event in reversed(response["chunk"]):
+            self.events.append(event)
+        self.events.evicted = False
+
+    def get_event(self, event_id):
+        """Get an event of the room from its ID, if it is one of the most recent."""
+        return self.events.get(event_id)
+
+    @property
+    def event_history_limit(self):
+        return self.events.limit
+
+    @event_history_limit.setter
+    def event_history_limit(self, limit):
+        self.events.limit = limit
 
     def invite_user(self, user_id):
         """Invite a user to this room.
@@ -374,6 +592,74 @@ class Room(object):
         except MatrixRequestError:
             return False
 
+    def invite_users(self, user_ids, max_concurrency=None):
+        """Invite users to this room, sending the requests concurrently.
+
+        Args:
+            user_ids (list): The matrix user ids of the users.
+            max_concurrency (int): Optional. Maximum number of requests in flight.
+                Defaults to the ``max_workers`` of the client's API.
+
+        Returns:
+            OrderedDict: Maps every user id to the response of its request, or to
+            the ``MatrixError`` it raised.
+        """
+        return self._bulk(self.client.api.invite_user, user_ids,
+                          max_concurrency=max_concurrency)
+
+    def kick_users(self, user_ids, reason="", max_concurrency=None):
+        """Kick users from this room, sending the requests concurrently.
+
+        Takes the same arguments and returns the same as ``invite_users``, plus:
+
+        Args:
+            reason (str): A reason for kicking the users.
+        """
+        return self._bulk(self.client.api.kick_user, user_ids, (reason,),
+                          max_concurrency)
+
+    def ban_users(self, user_ids, reason="", max_concurrency=None):
+        """Ban users from this room, sending the requests concurrently.
+
+        Takes the same arguments and returns the same as ``invite_users``, plus:
+
+        Args:
+            reason (str): A reason for banning the users.
+        """
+        return self._bulk(self.client.api.ban_user, user_ids, (reason,),
+                          max_concurrency)
+
+    def unban_users(self, user_ids, max_concurrency=None):
+        """Unban users from this room, sending the requests concurrently.
+
+        Takes the same arguments and returns the same as ``invite_users``.
+        """
+        return self._bulk(self.client.api.unban_user, user_ids,
+                          max_concurrency=max_concurrency)
+
+    def _bulk(self, method, user_ids, args=(), max_concurrency=None):
+        """Call ``method(room_id, user_id, *args)`` for every user, on the API's
+        thread pool. Requests share its rate limiter, so they back off together
+        when rate limited."""
+        api = self.client.api
+        limit = max(1, max_concurrency or api.max_workers)
+        results = OrderedDict((user_id, None) for user_id in user_ids)
+        pending = deque()
+
+        def collect(user_id, future):
+            try:
+                results[user_id] = future.result()
+            except MatrixError as e:
+                results[user_id] = e
+
+        for user_id in list(results):
+            if len(pending) >= limit:
+                collect(*pending.popleft())
+            pending.append((user_id, api.submit(method, self.room_id, user_id, *args)))
+        while pending:
+            collect(*pending.popleft())
+        return results
+
     def leave(self):
         """Leave the room.
 
@@ -382,7 +668,7 @@ class Room(object):
         """
         try:
             self.client.api.leave_room(self.room_id)
-            del self.client.rooms[self.room_id]
+            self.client._forget_room(self.room_id)
             return True
         except MatrixRequestError:
             return False
@@ -474,26 +760,72 @@ class Room(object):
         except MatrixRequestError:
             return False
 
+    @property
+    def _members(self):
+        return self.members.joined()
+
     def get_joined_members(self):
         """Returns list of joined members (User objects)."""
-        if self._members:
+        if self.members:
             return self._members
         response = self.client.api.get_room_members(self.room_id)
         for event in response["chunk"]:
             if event["content"]["membership"] == "join":
                 self._mkmembers(
-                    User(self.client.api,
-                         event["state_key"],
-                         event["content"].get("displayname"))
+                    self._mkuser(event["state_key"], event["content"].get("displayname"))
                 )
         return self._members
 
+    def _state_snapshot(self):
+        """Return the cached room state, as a dict which can be serialized."""
+        state = {attr: getattr(self, attr) for attr in STATE_ATTRIBUTES
+                 if attr != "encrypted"}
+        # Saved as None when unknown, rather than looked up
+        state["encrypted"] = self._encrypted
+        return state
+
+    @property
+    def encrypted(self):
+        """Whether the room is encrypted.
+
+        When a room first appears in sync without its encryption state, e.g. as
+        the sync filter excludes it, the state is looked up on first access: reading
+        it then blocks on a request to the homeserver. Call
+        ``MatrixClient.resolve_encryption_state`` beforehand to look it up for many
+        rooms at once instead.
+        """
+        if self._encrypted is None:
+            self.client.resolve_encryption_state([self.room_id])
+        return bool(self._encrypted)
+
+    @encrypted.setter
+    def encrypted(self, encrypted):
+        self._encrypted = encrypted
+
+    def _restore(self, prev_batch, state, members):
+        """Restore the room from a ``StateStore``."""
+        self._prev_batch = prev_batch
+        for attr in STATE_ATTRIBUTES:
+            if attr in state:
+                setattr(self, attr, state[attr])
+        for user_id, (membership, displayname) in members.items():
+            if membership == "join":
+                self._mkmembers(self._mkuser(user_id, displayname))
+            else:
+                self._rmmembers(user_id, membership)
+        self.members.pop_changes()
+
+    def _mkuser(self, user_id, displayname=None):
+        return self._user_class(self.client.api, user_id, displayname,
+                                profiles=self.client.profile_cache)
+
     def _mkmembers(self, member):
-        if member.user_id not in [x.user_id for x in self._members]:
-            self._members.append(member)
+        self.members.add(member)
+        self._members_name = None
 
-    def _rmmembers(self, user_id):
-        self._members[:] = [x for x in self._members if x.user_id != user_id]
+    def _rmmembers(self, user_id, membership="leave"):
+        self.members.remove(user_id, membership)
+        self._members_name = None
 
     def backfill_previous_messages(self, reverse=False, limit=10):
         """Backfill handling of previous messages.
@@ -659,21 +991,20 @@ class Room(object):
                     self.encrypted = True
             elif etype == "m.room.member" and clevel == clevel.ALL:
                 # tracking room members can be large e.g. #matrix:matrix.org
-                if econtent["membership"] == "join":
-                    self._mkmembers(
-                        User(self.client.api,
-                             state_event["state_key"],
-                             econtent.get("displayname"))
-                    )
-                elif econtent["membership"] in ("leave", "kick", "invite"):
-                    self._rmmembers(state_event["state_key"])
-
-        for listener in self.state_listeners:
-            if (
-                listener['event_type'] is None or
-                listener['event_type'] == state_event['type']
-            ):
-                listener['callback'](state_event)
+                user_id = state_event["state_key"]
+                membership = econtent["membership"]
+                if membership != "join":
+                    self._rmmembers(user_id, membership)
+                else:
+                    displayname = econtent.get("displayname")
+                    if user_id in self.members:
+                        self.members.set_display_name(user_id, displayname)
+                        self._members_name = None
+                    else:
+                        self._mkmembers(self._mkuser(user_id, displayname))
+
+        self.client._dispatch_event(self.room_id, "room state", state_event,
+                                    self.state_listeners.dispatch, state_event)
 
     @property
     def prev_batch(self):
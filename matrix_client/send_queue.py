@@ -0,0 +1,133 @@
+# -*- coding: utf-8 -*-
+# Copyright 2015 OpenMarket Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import logging
+import random
+import time
+from concurrent.futures import Future
+
+from .errors import MatrixHttpLibError, MatrixRequestError
+from .executor import ShardedExecutor
+
+logger = logging.getLogger(__name__)
+
+
+class SendQueue(object):
+    """Sends room events in the background, keeping their order within each room.
+
+    Events of a room are sent one at a time, in the order they were queued, while
+    rooms are served in parallel by a pool of worker threads. Every event gets its
+    transaction ID when queued, and keeps it across retries, so the homeserver
+    does not create it twice if a request succeeded but its response was lost.
+
+    Network errors and HTTP 5xx responses are retried with exponential backoff and
+    jitter. HTTP 429 responses are already retried by the API. Other errors fail
+    the event, and the next events of the room are sent nonetheless. A worker
+    waiting to retry holds back the rooms sharing it.
+
+    Every worker sends with a ``Session`` of its own, closed by
+    ``MatrixHttpApi.shutdown``.
+
+    Args:
+        api (MatrixHttpApi): The API to send events with.
+        workers (int): Number of rooms served in parallel.
+        max_pending (int): Maximum number of events queued per worker. ``send``
+            blocks while the queue is full.
+        max_retries (int): Number of retries of an event before it fails.
+        backoff (float): Seconds to wait before the first retry. It doubles with
+            each retry, and is randomized by up to half its value.
+        max_backoff (float): Maximum number of seconds between retries.
+
+    Example::
+
+        queue = SendQueue(client.api)
+        handles = [queue.send(room_id, "m.room.message",
+                              {"msgtype": "m.text", "body": "Hello!"})
+                   for room_id in room_ids]
+        event_ids = [handle.result() for handle in handles]
+    """
+
+    def __init__(self, api, workers=4, max_pending=1000, max_retries=5, backoff=0.5,
+                 max_backoff=30):
+        self.api = api
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self._executor = ShardedExecutor(workers, max_pending, name="matrix-sender")
+
+    def send(self, room_id, event_type, content, txn_id=None):
+        """Queue a message event.
+
+        Args:
+            room_id (str): The room to send the event in.
+            event_type (str): The event type.
+            content (dict): The event content.
+            txn_id (str): Optional. The transaction ID of the event.
+
+        Returns:
+            concurrent.futures.Future: Resolves to the ID of the event once sent,
+            or to the ``MatrixError`` which made it fail.
+        """
+        if not txn_id:
+            txn_id = self.api._make_txn_id()
+        future = Future()
+        self._executor.submit(room_id, self._send, future, room_id, event_type,
+                              content, txn_id)
+        return future
+
+    def _send(self, future, room_id, event_type, content, txn_id):
+        if not future.set_running_or_notify_cancel():
+            return
+        attempt = 0
+        while True:
+            try:
+                # Through the API's runner, for a Session of this worker thread
+                response = self.api._run(self.api.send_message_event,
+                                         (room_id, event_type, content),
+                                         {"txn_id": txn_id})
+            except (MatrixHttpLibError, MatrixRequestError) as e:
+                if attempt >= self.max_retries or not self._retryable(e):
+                    future.set_exception(e)
+                    return
+                delay = self._delay(attempt)
+                logger.warning("Failed to send event %s to %s, retrying in %.1fs: %s",
+                               txn_id, room_id, delay, e)
+                time.sleep(delay)
+                attempt += 1
+            except Exception as e:
+                future.set_exception(e)
+                return
+            else:
+                future.set_result(response.get("event_id"))
+                return
+
+    @staticmethod
+    def _retryable(error):
+        return isinstance(error, MatrixHttpLibError) or error.code >= 500
+
+    def _delay(self, attempt):
+        delay = min(self.max_backoff, self.backoff * 2 ** attempt)
+        return delay * random.uniform(0.5, 1)
+
+    def pending(self):
+        """Return the number of events queued and not yet sent."""
+        return self._executor.pending()
+
+    def drain(self):
+        """Block until every event queued so far was sent, or failed."""
+        self._executor.drain()
+
+    def shutdown(self, wait=True):
+        """Stop the workers once the events already queued have been sent."""
+        self._executor.shutdown(wait)
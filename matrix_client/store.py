@@ -0,0 +1,214 @@
+# -*- coding: utf-8 -*-
+# Copyright 2015 OpenMarket Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Persistence of the client state across restarts.
+
+A client given a store saves its sync token and the state it caches about rooms
+after every sync, and loads them back before its first sync. It then resumes with
+an incremental sync instead of a full initial one.
+"""
+import json
+import sqlite3
+from collections import OrderedDict
+from threading import Lock
+
+
+class StateStore(object):
+    """Interface of the stores used by :class:`~matrix_client.client.MatrixClient`.
+
+    Writes may be buffered until ``commit``, which must apply them atomically.
+    """
+
+    def get_meta(self, key):
+        """Return the value stored under ``key``, or None."""
+        raise NotImplementedError()
+
+    def set_meta(self, key, value):
+        """Store a string under ``key``. None deletes the key."""
+        raise NotImplementedError()
+
+    def get_rooms(self):
+        """Return a list of ``(room_id, prev_batch, state, members)`` tuples.
+
+        state is a dict of room attributes, and members an OrderedDict mapping user
+        IDs to ``(membership, displayname)`` tuples, in the order they joined.
+        """
+        raise NotImplementedError()
+
+    def save_room(self, room_id, prev_batch, state, members):
+        """Save a room.
+
+        Args:
+            room_id (str): The room.
+            prev_batch (str): The token to paginate backwards from.
+            state (dict): The room attributes, replacing the stored ones.
+            members (OrderedDict): Maps user IDs to ``(membership, displayname)``
+                tuples, updating the stored members. Members not stored yet or
+                joining again are stored in this order, after the others.
+        """
+        raise NotImplementedError()
+
+    def remove_room(self, room_id):
+        raise NotImplementedError()
+
+    def clear(self):
+        """Remove everything."""
+        raise NotImplementedError()
+
+    def get_processed_events(self):
+        """Return the IDs of the events recorded by ``add_processed_event``,
+        oldest first. Stores which do not support it return an empty list."""
+        return []
+
+    def add_processed_event(self, event_id, max_size=10000):
+        """Record that an event was dispatched. Like other writes, it may be
+        buffered until ``commit``, which the client calls once per sync batch.
+
+        Args:
+            event_id (str): The event.
+            max_size (int): Number of most recent event IDs to keep.
+        """
+        pass
+
+    def commit(self):
+        pass
+
+    def close(self):
+        pass
+
+
+class SQLiteStore(StateStore):
+    """A store backed by an SQLite database.
+
+    Args:
+        path (str): The database file. ':memory:' keeps it in memory.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = Lock()
+        # The store is written to from the sync thread
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        with self._lock:
+            self._db.executescript("""
+                PRAGMA journal_mode=WAL;
+                PRAGMA synchronous=NORMAL;
+                CREATE TABLE IF NOT EXISTS meta (
+                    key TEXT PRIMARY KEY,
+                    value TEXT
+                );
+                CREATE TABLE IF NOT EXISTS rooms (
+                    room_id TEXT PRIMARY KEY,
+                    prev_batch TEXT,
+                    state TEXT
+                );
+                CREATE TABLE IF NOT EXISTS members (
+                    room_id TEXT,
+                    user_id TEXT,
+                    membership TEXT,
+                    displayname TEXT,
+                    PRIMARY KEY (room_id, user_id)
+                );
+                CREATE TABLE IF NOT EXISTS processed_events (
+                    seq INTEGER PRIMARY KEY AUTOINCREMENT,
+                    event_id TEXT UNIQUE
+                );
+            """)
+            self._db.commit()
+
+    def get_meta(self, key):
+        with self._lock:
+            row = self._db.execute("SELECT value FROM meta WHERE key = ?",
+                                   (key,)).fetchone()
+        return row[0] if row else None
+
+    def set_meta(self, key, value):
+        with self._lock:
+            if value is None:
+                self._db.execute("DELETE FROM meta WHERE key = ?", (key,))
+            else:
+                self._db.execute("INSERT OR REPLACE INTO meta VALUES (?, ?)",
+                                 (key, value))
+
+    def get_rooms(self):
+        with self._lock:
+            rooms = self._db.execute(
+                "SELECT room_id, prev_batch, state FROM rooms").fetchall()
+            members = self._db.execute(
+                "SELECT room_id, user_id, membership, displayname FROM members "
+                "ORDER BY rowid").fetchall()
+        room_members = {}
+        for room_id, user_id, membership, displayname in members:
+            room_members.setdefault(room_id, OrderedDict())[user_id] = \
+                (membership, displayname)
+        return [(room_id, prev_batch, json.loads(state),
+                 room_members.get(room_id, OrderedDict()))
+                for room_id, prev_batch, state in rooms]
+
+    def save_room(self, room_id, prev_batch, state, members):
+        with self._lock:
+            self._db.execute("INSERT OR REPLACE INTO rooms VALUES (?, ?, ?)",
+                             (room_id, prev_batch, json.dumps(state)))
+            # Updating in place keeps the rowid, hence the order members joined in.
+            # Members joining again are inserted anew, after the others.
+            self._db.executemany(
+                "DELETE FROM members WHERE room_id = ? AND user_id = ? "
+                "AND membership != 'join'",
+                [(room_id, user_id)
+                 for user_id, (membership, _) in members.items()
+                 if membership == "join"])
+            self._db.executemany(
+                "UPDATE members SET membership = ?, displayname = ? "
+                "WHERE room_id = ? AND user_id = ?",
+                [(membership, displayname, room_id, user_id)
+                 for user_id, (membership, displayname) in members.items()])
+            self._db.executemany(
+                "INSERT OR IGNORE INTO members VALUES (?, ?, ?, ?)",
+                [(room_id, user_id, membership, displayname)
+                 for user_id, (membership, displayname) in members.items()])
+
+    def remove_room(self, room_id):
+        with self._lock:
+            self._db.execute("DELETE FROM rooms WHERE room_id = ?", (room_id,))
+            self._db.execute("DELETE FROM members WHERE room_id = ?", (room_id,))
+
+    def clear(self):
+        with self._lock:
+            for table in ("meta", "rooms", "members", "processed_events"):
+                self._db.execute("DELETE FROM %s" % table)
+            self._db.commit()
+
+    def get_processed_events(self):
+        with self._lock:
+            rows = self._db.execute(
+                "SELECT event_id FROM processed_events ORDER BY seq").fetchall()
+        return [row[0] for row in rows]
+
+    def add_processed_event(self, event_id, max_size=10000):
+        with self._lock:
+            cursor = self._db.execute(
+                "INSERT OR IGNORE INTO processed_events (event_id) VALUES (?)",
+                (event_id,))
+            # Trim from time to time rather than on every insert
+            if cursor.lastrowid and cursor.lastrowid % 1000 == 0:
+                self._db.execute("DELETE FROM processed_events WHERE seq <= ?",
+                                 (cursor.lastrowid - max_size,))
+
+    def commit(self):
+        with self._lock:
+            self._db.commit()
+
+    def close(self):
+        with self._lock:
+            self._db.close()
@@ -0,0 +1,115 @@
+# -*- coding: utf-8 -*-
+# Copyright 2015 OpenMarket Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+from copy import copy
+from threading import Event, Thread
+
+from requests import Session
+
+from .errors import MatrixUnexpectedResponse
+
+try:
+    from queue import Queue, Full
+except ImportError:
+    from Queue import Queue, Full
+
+
+class SyncPipeline(object):
+    """Fetches /sync responses on a background thread, ahead of their processing.
+
+    As soon as a response has been received, the next request is sent with its
+    ``next_batch`` token, on a connection of its own, while the caller processes the
+    response. Responses are handed over in order through a queue of size one, so at
+    most two responses are fetched ahead.
+
+    Args:
+        client (MatrixClient): The client to sync.
+        timeout_ms (int): Long-polling timeout of the requests.
+    """
+
+    def __init__(self, client, timeout_ms=30000):
+        self.client = client
+        self.timeout_ms = timeout_ms
+        self.api = copy(client.api)
+        self.api.session = Session()
+        # The filter of the last request, to tell whether an error is due to it
+        self.sync_filter = None
+        self._responses = Queue(1)
+        self._stopped = Event()
+        self._thread = Thread(target=self._fetch, args=(client.sync_token,),
+                              name="matrix-sync-fetcher")
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _fetch(self, since):
+        try:
+            self._fetch_responses(since)
+        finally:
+            self.api.session.close()
+
+    def _fetch_responses(self, since):
+        while not self._stopped.is_set():
+            try:
+                # Uploaded with the session of this thread
+                self.sync_filter = self.client._get_sync_filter(self.api)
+                response = self.api.sync(since, self.timeout_ms,
+                                         filter=self.sync_filter)
+                if "next_batch" not in response:
+                    raise MatrixUnexpectedResponse("/sync response without next_batch.")
+            except Exception as e:
+                self._put((since, None, e))
+                return
+            if not self._put((since, response, None)):
+                return
+            since = response["next_batch"]
+
+    def _put(self, item):
+        while not self._stopped.is_set():
+            try:
+                self._responses.put(item, timeout=0.1)
+                return True
+            except Full:
+                pass
+        return False
+
+    def get(self):
+        """Return the next response.
+
+        Returns:
+            tuple: ``(since, response)``, since being the token the response was
+                requested with.
+
+        Raises:
+            The exception raised while fetching the response. The pipeline is
+            stopped then.
+        """
+        since, response, error = self._responses.get()
+        if error is not None:
+            self._stopped.set()
+            raise error
+        return since, response
+
+    @property
+    def running(self):
+        return not self._stopped.is_set()
+
+    def stop(self):
+        """Stop fetching. Responses fetched and not yet processed are discarded.
+
+        The idle connections of the pipeline are closed right away. A request in
+        flight completes within ``timeout_ms``, then its connection is closed as
+        the fetcher exits.
+        """
+        self._stopped.set()
+        self.api.session.close()
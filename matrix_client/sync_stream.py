@@ -0,0 +1,182 @@
+# -*- coding: utf-8 -*-
+# Copyright 2015 OpenMarket Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Incremental parsing of /sync responses.
+
+Only the structure of the outer objects is walked in Python. Every other value is
+located by scanning for its end, then handed whole to the JSON codec, so at most
+one room (plus a read chunk) is buffered at any time.
+"""
+import json
+import re
+
+from .codec import get_codec
+from .errors import MatrixUnexpectedResponse
+
+# Objects whose members are yielded one by one rather than as a whole.
+SYNC_STREAM_PATHS = frozenset([
+    (),
+    ("rooms",),
+    ("rooms", "join"),
+    ("rooms", "invite"),
+    ("rooms", "leave"),
+])
+
+_WHITESPACE = re.compile(b"[ \t\n\r]*")
+_STRING = re.compile(b'"[^"\\\\]*(?:\\\\.[^"\\\\]*)*"', re.DOTALL)
+_SCALAR_END = re.compile(b"[,}\\] \t\n\r]")
+# Everything up to the next bracket or brace which is not part of a string. Stops
+# early on an incomplete string.
+_SKIP = re.compile(b'(?:[^"{}\\[\\]]+|"[^"\\\\]*(?:\\\\.[^"\\\\]*)*")*', re.DOTALL)
+
+
+class _Buffer(object):
+    """A read buffer over an iterator of byte chunks."""
+
+    def __init__(self, chunks):
+        self._chunks = iter(chunks)
+        self.data = bytearray()
+        self.pos = 0
+
+    def fill(self):
+        """Read one more chunk, dropping consumed data. Returns False at EOF."""
+        for chunk in self._chunks:
+            if not chunk:
+                continue
+            if self.pos:
+                del self.data[:self.pos]
+                self.pos = 0
+            self.data += chunk
+            return True
+        return False
+
+    def _eof(self):
+        raise MatrixUnexpectedResponse("Truncated JSON in /sync response.")
+
+    def peek(self):
+        while True:
+            self.pos = _WHITESPACE.match(self.data, self.pos).end()
+            if self.pos < len(self.data):
+                return self.data[self.pos:self.pos + 1]
+            if not self.fill():
+                self._eof()
+
+    def expect(self, char):
+        if self.peek() != char:
+            raise MatrixUnexpectedResponse(
+                "Expected %r in /sync response at offset %d." % (char, self.pos))
+        self.pos += 1
+
+    def read_string(self):
+        return json.loads(self._read_raw_string().decode("utf-8"))
+
+    def _read_raw_string(self):
+        self.peek()
+        while True:
+            match = _STRING.match(self.data, self.pos)
+            if match:
+                self.pos = match.end()
+                return bytes(match.group(0))
+            if not self.fill():
+                self._eof()
+
+    def read_raw_value(self):
+        """Return the bytes of the next JSON value and move past it."""
+        start = self.peek()
+        if start not in (b"{", b"[", b'"'):
+            return self._read_scalar()
+        if start == b'"':
+            return self._read_raw_string()
+
+        # Offsets are relative to the start of the value, as fill() may drop the
+        # data consumed before it.
+        offset = self.pos
+        scan = 0
+        depth = 0
+        while True:
+            end = _SKIP.match(self.data, offset + scan).end()
+            scan = end - offset
+            char = self.data[end:end + 1]
+            if char and char != b'"':
+                scan += 1
+                depth += 1 if char in (b"{", b"[") else -1
+                if depth == 0:
+                    self.pos = offset + scan
+                    return bytes(self.data[offset:self.pos])
+                continue
+            # Reached the end of the buffer, or an incomplete string
+            self.pos = offset
+            if not self.fill():
+                self._eof()
+            offset = self.pos
+
+    def _read_scalar(self):
+        while True:
+            match = _SCALAR_END.search(self.data, self.pos)
+            if match:
+                value = bytes(self.data[self.pos:match.start()])
+                self.pos = match.start()
+                return value
+            if not self.fill():
+                self._eof()
+
+
+def iter_sync_response(chunks, codec=None, paths=SYNC_STREAM_PATHS):
+    """Parse a /sync response incrementally.
+
+    Args:
+        chunks (iterable): The body of the response, as bytes chunks.
+        codec (str|JsonCodec): Optional. Codec used to decode the values.
+        paths (set): The paths of the objects whose members are yielded one
+            by one. Defaults to the top level, ``rooms`` and the joined, invited
+            and left rooms.
+
+    Yields:
+        tuple: ``(path, value)``, path being a tuple of keys. For instance
+            ``(("rooms", "join", "!room:example.com"), joined_room)`` or
+            ``(("next_batch",), "s72595_4483_1934")``.
+    """
+    codec = get_codec(codec)
+    buf = _Buffer(chunks)
+    for item in _iter_object(buf, (), codec, paths):
+        yield item
+
+
+def _iter_object(buf, path, codec, paths):
+    buf.expect(b"{")
+    if buf.peek() == b"}":
+        buf.pos += 1
+        return
+    while True:
+        key = buf.read_string()
+        buf.expect(b":")
+        member_path = path + (key,)
+        if member_path in paths and buf.peek() == b"{":
+            for item in _iter_object(buf, member_path, codec, paths):
+                yield item
+        else:
+            raw = buf.read_raw_value()
+            try:
+                value = codec.loads(raw)
+            except ValueError as e:
+                raise MatrixUnexpectedResponse(
+                    "Invalid JSON in /sync response at %s: %s" % (member_path, e))
+            yield member_path, value
+        char = buf.peek()
+        buf.pos += 1
+        if char == b"}":
+            return
+        if char != b",":
+            raise MatrixUnexpectedResponse(
+                "Expected ',' or '}' in /sync response, got %r." % char)
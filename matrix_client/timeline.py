@@ -0,0 +1,280 @@
+# -*- coding: utf-8 -*-
+# Copyright 2015 OpenMarket Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import json
+from collections import OrderedDict
+from threading import RLock
+
+
+def event_size(event):
+    """Return the size of an event in bytes, once encoded as JSON."""
+    return len(json.dumps(event, separators=(",", ":")))
+
+
+class EventCache(object):
+    """A client-wide budget for the events kept in room timelines.
+
+    Once the events of every timeline exceed the budget, the timelines of the least
+    recently active rooms are evicted as a whole. ``Room.get_events`` fetches the
+    events of an evicted room again when called.
+
+    Args:
+        max_events (int): Optional. Maximum number of events kept.
+        max_bytes (int): Optional. Maximum size of the events kept, measured by
+            ``sizeof``.
+        sizeof (func(event)): Optional. Size of an event, in bytes. Defaults to the
+            length of its JSON encoding. Only used if ``max_bytes`` is set.
+
+    Example::
+
+        client = MatrixClient("https://matrix.org", token="foobar",
+                              user_id="@foobar:matrix.org",
+                              event_cache=EventCache(max_events=50000))
+    """
+
+    def __init__(self, max_events=None, max_bytes=None, sizeof=event_size):
+        self.max_events = max_events
+        self.max_bytes = max_bytes
+        self._sizeof = sizeof
+        self.events = 0
+        self.bytes = 0
+        self.evictions = 0
+        self._lock = RLock()
+        # id(timeline): timeline, least recently active first
+        self._timelines = OrderedDict()
+
+    @property
+    def counts_bytes(self):
+        return self.max_bytes is not None
+
+    def sizeof(self, event):
+        return self._sizeof(event)
+
+    def usage(self):
+        """Return a dict with the number of events and bytes used, the number of
+        timelines holding events and the number of evictions so far."""
+        with self._lock:
+            return {
+                "events": self.events,
+                "bytes": self.bytes,
+                "timelines": len(self._timelines),
+                "evictions": self.evictions,
+            }
+
+    def _over_budget(self):
+        return ((self.max_events is not None and self.events > self.max_events) or
+                (self.max_bytes is not None and self.bytes > self.max_bytes))
+
+    def _changed(self, timeline, events, nbytes, active=False):
+        """Called by timelines when their content changes.
+
+        Args:
+            events (int): Change of the number of events of the timeline.
+            nbytes (int): Change of the size of the events of the timeline.
+            active (bool): Whether the room received an event.
+        """
+        with self._lock:
+            self.events += events
+            self.bytes += nbytes
+            key = id(timeline)
+            if not len(timeline):
+                self._timelines.pop(key, None)
+                return
+            if active:
+                # Mark the timeline as the most recently active one
+                self._timelines.pop(key, None)
+                self._timelines[key] = timeline
+            while self._over_budget() and len(self._timelines) > 1:
+                victim = next(iter(self._timelines.values()))
+                if victim is timeline:
+                    break
+                victim.evict()
+                self.evictions += 1
+
+
+class Timeline(object):
+    """A bounded sequence of events, oldest first.
+
+    Events are stored in a ring buffer: appending an event is O(1), evicting the
+    oldest one once ``limit`` is reached included. Events can be looked up by
+    position like in a list, or by event ID.
+
+    Changes are thread-safe: local echoes are appended from the sending thread,
+    and the cache evicts timelines from whichever thread appended to another one.
+
+    Args:
+        limit (int): Maximum number of events kept.
+        cache (EventCache): Optional. Client-wide budget the events count towards.
+
+    Attributes:
+        evicted (bool): Whether the events were dropped by the cache. The timeline
+            may have received newer events since.
+    """
+
+    def __init__(self, limit=20, cache=None):
+        self._limit = max(0, limit)
+        self.cache = cache
+        self.evicted = False
+        # Not held while notifying the cache, which takes its own lock and then
+        # the one of the timeline it evicts
+        self._lock = RLock()
+        self._buf = []
+        # Sizes of the events in _buf, when counting towards a byte budget
+        self._sizes = [] if cache is not None and cache.counts_bytes else None
+        # Index in _buf of the oldest event, once the buffer is full
+        self._head = 0
+        # Every event appended gets a sequence number. This is the one of the
+        # oldest event kept.
+        self._first_seq = 0
+        # event_id: sequence number
+        self._ids = {}
+
+    @property
+    def limit(self):
+        return self._limit
+
+    @limit.setter
+    def limit(self, limit):
+        with self._lock:
+            events = list(self)
+            dropped = max(0, len(events) - max(0, limit))
+            nbytes = 0
+            if self._sizes is not None:
+                sizes = self._sizes[self._head:] + self._sizes[:self._head]
+                nbytes = sum(sizes[:dropped])
+                self._sizes = sizes[dropped:]
+            self._limit = max(0, limit)
+            self._buf = events[dropped:]
+            self._head = 0
+            self._first_seq += dropped
+            self._ids = {}
+            for i, event in enumerate(self._buf):
+                self._index(event, self._first_seq + i)
+            cache = self.cache
+        if dropped and cache is not None:
+            cache._changed(self, -dropped, -nbytes)
+
+    def _index(self, event, seq):
+        event_id = event.get("event_id")
+        if event_id is not None:
+            self._ids[event_id] = seq
+
+    def append(self, event):
+        """Add an event, evicting the oldest one if the timeline is full."""
+        with self._lock:
+            if not self._limit:
+                return
+            cache = self.cache
+            size = cache.sizeof(event) if self._sizes is not None else 0
+            seq = self._first_seq + len(self._buf)
+            if len(self._buf) < self._limit:
+                self._buf.append(event)
+                if self._sizes is not None:
+                    self._sizes.append(size)
+                added, nbytes = 1, size
+            else:
+                evicted = self._buf[self._head]
+                event_id = evicted.get("event_id")
+                if event_id is not None and self._ids.get(event_id) == self._first_seq:
+                    del self._ids[event_id]
+                self._buf[self._head] = event
+                added, nbytes = 0, size
+                if self._sizes is not None:
+                    nbytes -= self._sizes[self._head]
+                    self._sizes[self._head] = size
+                self._head = (self._head + 1) % self._limit
+                self._first_seq += 1
+            self._index(event, seq)
+        if cache is not None:
+            cache._changed(self, added, nbytes, active=True)
+
+    def reindex(self, event):
+        """Index an event by its ID, once it got one after being appended.
+
+        Returns:
+            bool: Whether the event is still in the timeline.
+        """
+        with self._lock:
+            for i, other in enumerate(self):
+                if other is event:
+                    self._index(event, self._first_seq + i)
+                    return True
+        return False
+
+    def clear(self):
+        with self._lock:
+            removed = len(self._buf)
+            nbytes = sum(self._sizes) if self._sizes is not None else 0
+            self._first_seq += len(self._buf)
+            self._buf = []
+            if self._sizes is not None:
+                self._sizes = []
+            self._head = 0
+            self._ids = {}
+            cache = self.cache
+        if removed and cache is not None:
+            cache._changed(self, -removed, -nbytes)
+
+    def evict(self):
+        """Drop every event, to be fetched again later."""
+        self.clear()
+        self.evicted = True
+
+    def detach(self):
+        """Stop counting towards the cache, e.g. once the room was left."""
+        if self.cache is not None:
+            self.clear()
+            with self._lock:
+                self.cache = None
+                self._sizes = None
+
+    def position(self, event_id):
+        """Return the position of an event, or None if it is not in the timeline."""
+        seq = self._ids.get(event_id)
+        return None if seq is None else seq - self._first_seq
+
+    def get(self, event_id, default=None):
+        """Return the event with the given ID, or ``default``."""
+        position = self.position(event_id)
+        return default if position is None else self[position]
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(len(self._buf)))]
+        length = len(self._buf)
+        if index < 0:
+            index += length
+        if not 0 <= index < length:
+            raise IndexError("timeline index out of range")
+        return self._buf[(self._head + index) % length]
+
+    def __len__(self):
+        return len(self._buf)
+
+    def __iter__(self):
+        buf = self._buf
+        for i in range(len(buf)):
+            yield buf[(self._head + i) % len(buf)]
+
+    def __eq__(self, other):
+        if isinstance(other, (Timeline, list)):
+            return list(self) == list(other)
+        return NotImplemented
+
+    def __ne__(self, other):
+        result = self.__eq__(other)
+        return result if result is NotImplemented else not result
+
+    def __repr__(self):
+        return "Timeline(%r)" % list(self)
@@ -0,0 +1,219 @@
+# -*- coding: utf-8 -*-
+# Copyright 2015 OpenMarket Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Request bodies streaming media uploads.
+
+Requests sends a body with a ``read`` method and a length in blocks, with a
+Content-Length header, and a body which is only iterable with chunked transfer
+encoding. Either way, only a block is held in memory at a time.
+"""
+import mmap
+import os
+
+
+BLOCK_SIZE = 1 << 16
+
+
+class FileBody(object):
+    """An upload body read from a file object.
+
+    Args:
+        fileobj (file): Opened in binary mode. Read from its current position.
+        length (int): Optional. Number of bytes to send. Defaults to the rest of
+            the file, which must then be seekable. With a length, files which are
+            not, e.g. pipes, are sent too, but cannot be rewound.
+        progress (func(sent, total)): Optional. Called after every block read.
+    """
+
+    def __init__(self, fileobj, length=None, progress=None):
+        self.fileobj = fileobj
+        if length is not None and not seekable(fileobj):
+            self._start = None
+        else:
+            self._start = fileobj.tell()
+        if length is None:
+            fileobj.seek(0, os.SEEK_END)
+            length = fileobj.tell() - self._start
+            fileobj.seek(self._start)
+        self.length = length
+        self.progress = progress
+        self.sent = 0
+
+    def read(self, size=-1):
+        remaining = self.length - self.sent
+        if size is None or size < 0 or size > remaining:
+            size = remaining
+        data = self.fileobj.read(size)
+        self.sent += len(data)
+        if self.progress is not None:
+            self.progress(self.sent, self.length)
+        return data
+
+    def __len__(self):
+        return self.length
+
+    def rewind(self):
+        """Go back to the start, to send the body again.
+
+        Returns:
+            bool: Whether the body can be sent again, which is not the case of a
+            non-seekable file once read from.
+        """
+        if self._start is None:
+            return not self.sent
+        self.fileobj.seek(self._start)
+        self.sent = 0
+        return True
+
+
+class ChunkedBody(object):
+    """An upload body made of the chunks yielded by an iterable, sent with chunked
+    transfer encoding.
+
+    Args:
+        chunks (iterable): Yields bytes.
+        progress (func(sent, total)): Optional. Called after every chunk, with a
+            total of None.
+    """
+
+    def __init__(self, chunks, progress=None):
+        self.chunks = chunks
+        self.progress = progress
+        self.sent = 0
+        self._started = False
+
+    def __iter__(self):
+        self._started = True
+        for chunk in self.chunks:
+            if not chunk:
+                continue
+            self.sent += len(chunk)
+            yield chunk
+            if self.progress is not None:
+                self.progress(self.sent, None)
+
+    def rewind(self):
+        """Chunks cannot be read twice, unless none was read yet.
+
+        Returns:
+            bool: Whether the body can be sent again.
+        """
+        return not self._started
+
+
+class MappedFile(object):
+    """A file mapped in memory, to be uploaded as a :class:`FileBody`.
+
+    Pages are loaded by the OS as they are read and can be dropped again under
+    memory pressure, so the file does not count towards the memory of the process.
+
+    Args:
+        path (str): The file.
+    """
+
+    def __init__(self, path):
+        self._file = open(path, "rb")
+        size = os.fstat(self._file.fileno()).st_size
+        # Empty files cannot be mapped
+        self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ) \
+            if size else None
+
+    def fileobj(self):
+        return self._map if self._map is not None else self._file
+
+    def close(self):
+        if self._map is not None:
+            self._map.close()
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def encode_text(content):
+    """Return text upload content encoded as UTF-8, and other content unchanged."""
+    if isinstance(content, type(u"")):
+        return content.encode("utf-8")
+    return content
+
+
+def upload_body(content, progress=None):
+    """Wrap upload content so it is streamed.
+
+    Args:
+        content (bytes|str|file|iterable): The data, a file object opened in
+            binary mode, or an iterable yielding bytes. Text is sent as UTF-8, and
+            files which are not seekable, e.g. pipes, like iterables.
+        progress (func(sent, total)): Optional. Called as the body is sent.
+
+    Returns:
+        Bytes without ``progress`` unchanged, or else a :class:`FileBody` or
+        :class:`ChunkedBody`.
+    """
+    content = encode_text(content)
+    if isinstance(content, (bytes, bytearray)):
+        if progress is None:
+            return content
+        return FileBody(_BytesReader(content), progress=progress)
+    if hasattr(content, "read"):
+        if seekable(content):
+            return FileBody(content, progress=progress)
+        return ChunkedBody(iter_blocks(content), progress)
+    return ChunkedBody(content, progress)
+
+
+def seekable(fileobj):
+    """Whether the position of a file object can be read and changed."""
+    try:
+        if not fileobj.seekable():
+            return False
+    except AttributeError:
+        # e.g. Python 2 files, which have no seekable()
+        pass
+    try:
+        fileobj.tell()
+    except (AttributeError, IOError, OSError):
+        return False
+    return True
+
+
+def iter_blocks(fileobj, block_size=BLOCK_SIZE):
+    """Yield the content of a file object in blocks, from its current position."""
+    return iter(lambda: fileobj.read(block_size), b"")
+
+
+class _BytesReader(object):
+    """A file object over bytes, which, unlike ``io.BytesIO``, does not copy them."""
+
+    def __init__(self, data):
+        self._view = memoryview(data)
+        self._pos = 0
+
+    def tell(self):
+        return self._pos
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        if whence == os.SEEK_END:
+            offset += len(self._view)
+        elif whence == os.SEEK_CUR:
+            offset += self._pos
+        self._pos = offset
+
+    def read(self, size):
+        data = self._view[self._pos:self._pos + size].tobytes()
+        self._pos += len(data)
+        return data
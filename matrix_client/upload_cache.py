@@ -0,0 +1,112 @@
+# -*- coding: utf-8 -*-
+# Copyright 2015 OpenMarket Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import hashlib
+import sqlite3
+from threading import Lock
+
+from .upload import encode_text
+
+BLOCK_SIZE = 1 << 16
+
+
+class UploadCache(object):
+    """Maps the SHA-256 of uploaded content to the mxc:// URL it was uploaded to.
+
+    Entries are keyed by the hash and the content type, as the homeserver serves
+    content with the type it was uploaded with.
+
+    Args:
+        path (str): Optional. SQLite database to persist the cache to, so that
+            uploads are deduplicated across restarts. Defaults to memory.
+
+    Example::
+
+        client = MatrixClient("https://matrix.org", token="foobar",
+                              user_id="@foobar:matrix.org",
+                              upload_cache=UploadCache("uploads.sqlite"))
+        # Only uploaded once
+        client.upload_file("logo.png", "image/png")
+        client.upload_file("logo.png", "image/png")
+    """
+
+    def __init__(self, path=None):
+        self.path = path
+        self._lock = Lock()
+        self._db = sqlite3.connect(path or ":memory:", check_same_thread=False)
+        with self._lock:
+            self._db.executescript("""
+                CREATE TABLE IF NOT EXISTS uploads (
+                    hash TEXT,
+                    content_type TEXT,
+                    content_uri TEXT,
+                    PRIMARY KEY (hash, content_type)
+                );
+            """)
+            self._db.commit()
+
+    def get(self, content_hash, content_type):
+        """Return the mxc:// URL of content, or None."""
+        with self._lock:
+            row = self._db.execute(
+                "SELECT content_uri FROM uploads WHERE hash = ? AND content_type = ?",
+                (content_hash, content_type)).fetchone()
+        return row[0] if row else None
+
+    def set(self, content_hash, content_type, content_uri):
+        with self._lock:
+            self._db.execute("INSERT OR REPLACE INTO uploads VALUES (?, ?, ?)",
+                             (content_hash, content_type, content_uri))
+            self._db.commit()
+
+    def clear(self):
+        with self._lock:
+            self._db.execute("DELETE FROM uploads")
+            self._db.commit()
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+
+def content_hash(content):
+    """Return the SHA-256 of upload content, or None if it cannot be read twice.
+
+    Args:
+        content (bytes|str|file|iterable): As for ``MatrixClient.upload``. Text is
+            hashed as the UTF-8 it is sent as. File objects are read from their
+            current position, in blocks, and seeked back.
+    """
+    content = encode_text(content)
+    if isinstance(content, (bytes, bytearray)):
+        return hashlib.sha256(content).hexdigest()
+    if not hasattr(content, "read"):
+        return None
+    try:
+        start = content.tell()
+    except (AttributeError, IOError, OSError):
+        # e.g. a pipe
+        return None
+    digest = hashlib.sha256()
+    for block in iter(lambda: content.read(BLOCK_SIZE), b""):
+        digest.update(block)
+    content.seek(start)
+    return digest.hexdigest()
+
+
+def iter_hashed(chunks, digest):
+    """Yield chunks, updating a hashlib object with them."""
+    for chunk in chunks:
+        digest.update(chunk)
+        yield chunk
@@ -14,16 +14,39 @@
 # limitations under the License.
 from .checks import check_user_id
 
+# Returned by User._cached on a miss, as None is a valid display name
+_MISSING = object()
+
 
 class User(object):
     """ The User class can be used to call user specific functions.
+
+    Args:
+        api (MatrixHttpApi): The API to call.
+        user_id (str): The user.
+        displayname (str): Optional. Their display name, e.g. in a room.
+        profiles (ProfileCache): Optional. Cache to read the profile from before
+            calling /profile, and to store the responses in.
     """
-    def __init__(self, api, user_id, displayname=None):
+    def __init__(self, api, user_id, displayname=None, profiles=None):
         check_user_id(user_id)
 
         self.user_id = user_id
         self.displayname = displayname
         self.api = api
+        self.profiles = profiles
+
+    def _cached(self, field):
+        if self.profiles is None:
+            return _MISSING
+        try:
+            return self.profiles.get(self.user_id, field)
+        except KeyError:
+            return _MISSING
+
+    def _cache(self, field, value):
+        if self.profiles is not None:
+            self.profiles.update(self.user_id, **{field: value})
 
     def get_display_name(self):
         """ Get this users display name.
@@ -33,11 +56,18 @@ class User(object):
             str: Display Name
         """
         if not self.displayname:
-            self.displayname = self.api.get_display_name(self.user_id)
+            self.displayname = self._fetch_display_name()
         return self.displayname
 
+    def _fetch_display_name(self):
+        display_name = self._cached("displayname")
+        if display_name is _MISSING:
+            display_name = self.api.get_display_name(self.user_id)
+            self._cache("displayname", display_name)
+        return display_name
+
     def get_friendly_name(self):
-        display_name = self.api.get_display_name(self.user_id)
+        display_name = self._fetch_display_name()
         return display_name if display_name is not None else self.user_id
 
     def set_display_name(self, display_name):
@@ -47,10 +77,15 @@ class User(object):
             display_name (str): Display Name
         """
         self.displayname = display_name
-        return self.api.set_display_name(self.user_id, display_name)
+        response = self.api.set_display_name(self.user_id, display_name)
+        self._cache("displayname", display_name)
+        return response
 
     def get_avatar_url(self):
-        mxcurl = self.api.get_avatar_url(self.user_id)
+        mxcurl = self._cached("avatar_url")
+        if mxcurl is _MISSING:
+            mxcurl = self.api.get_avatar_url(self.user_id)
+            self._cache("avatar_url", mxcurl)
         url = None
         if mxcurl is not None:
             url = self.api.get_download_url(mxcurl)
@@ -62,4 +97,6 @@ class User(object):
         Args:
             avatar_url (str): mxc url from previously uploaded
         """
-        return self.api.set_avatar_url(self.user_id, avatar_url)
+        response = self.api.set_avatar_url(self.user_id, avatar_url)
+        self._cache("avatar_url", avatar_url)
+        return response
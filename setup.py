@@ -46,6 +46,7 @@ setup(
     keywords='chat sdk matrix matrix.org',
     install_requires=[
         'requests',
+        'futures; python_version < "3.0"',
     ],
     setup_requires=['pytest-runner',],
     tests_require=['pytest', 'responses',],
@@ -53,7 +54,9 @@ setup(
         'test': ['pytest', 'responses'],
         'doc': ['Sphinx==1.4.6', 'sphinx-rtd-theme==0.1.9', 'sphinxcontrib-napoleon==0.5.3'],
         'format': ['flake8'],
-        'e2e': ['python-olm==dev', 'canonicaljson']
+        'e2e': ['python-olm==dev', 'canonicaljson'],
+        'async': ['aiohttp>=3.0'],
+        'fastjson': ['orjson']
     },
     dependency_links=[
         'git+https://github.com/poljar/python-olm.git#egg=python-olm-dev'
@@ -1,6 +1,7 @@
 import responses
 import pytest
 from matrix_client import client
+from matrix_client.api import MatrixHttpApi
 from matrix_client.errors import MatrixRequestError
 
 
@@ -232,3 +233,39 @@ class TestSendToDeviceApi:
         req = responses.calls[0].request
         assert req.url == send_to_device_url
         assert req.method == 'PUT'
+
+
+class TestExecutorApi:
+
+    @responses.activate
+    def test_map_returns_results_in_order(self):
+        api = MatrixHttpApi("http://example.com", token="foobar", max_workers=4)
+        user_ids = ["@user%s:matrix.org" % i for i in range(20)]
+        for user_id in user_ids:
+            responses.add(
+                responses.GET,
+                "http://example.com/_matrix/client/r0/profile/%s/displayname" % user_id,
+                json={"displayname": user_id[1:7]}
+            )
+        names = list(api.map("get_display_name", user_ids))
+        assert names == [user_id[1:7] for user_id in user_ids]
+        # Worker threads do not share the session of the calling thread
+        assert api._worker_sessions
+        assert all(session is not api.session for session in api._worker_sessions)
+        api.shutdown()
+        assert not api._worker_sessions
+
+    @responses.activate
+    def test_submit_failure_and_retry(self):
+        api = MatrixHttpApi("http://example.com", token="foobar")
+        url = "http://example.com/_matrix/client/r0/rooms/!a:matrix.org/invite"
+        responses.add(responses.POST, url, status=429,
+                      json={"errcode": "M_LIMIT_EXCEEDED", "retry_after_ms": 10})
+        responses.add(responses.POST, url, json={})
+        responses.add(responses.POST, url, status=403, json={"errcode": "M_FORBIDDEN"})
+        assert api.submit("invite_user", "!a:matrix.org", "@b:matrix.org") \
+            .result() == {}
+        future = api.submit(api.invite_user, "!a:matrix.org", "@c:matrix.org")
+        with pytest.raises(MatrixRequestError):
+            future.result()
+        api.shutdown()
@@ -0,0 +1,249 @@
+import pytest
+pytest.importorskip("aiohttp")  # noqa
+
+import asyncio
+import json
+from copy import deepcopy
+
+from aiohttp import web
+from aiohttp.test_utils import TestServer
+
+from matrix_client.async_api import AsyncMatrixHttpApi
+from matrix_client.async_client import AsyncMatrixClient, AsyncRoom
+from matrix_client.api import MATRIX_V2_API_PATH
+from matrix_client.errors import MatrixRequestError
+from matrix_client.upload_cache import UploadCache
+from . import response_examples
+
+
+def run(coro):
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(coro)
+    finally:
+        loop.close()
+
+
+class FakeHomeserver(object):
+    """Records requests and answers with canned responses."""
+
+    def __init__(self):
+        self.requests = []
+        self.responses = {}
+        self.app = web.Application()
+        self.app.router.add_route("*", "/{tail:.*}", self.handle)
+
+    def add(self, method, path, body, status=200):
+        self.responses.setdefault((method, path), []).append((status, body))
+
+    async def handle(self, request):
+        body = await request.read()
+        self.requests.append((request.method, request.path, dict(request.query),
+                              body))
+        queue = self.responses.get((request.method, request.path))
+        if not queue:
+            return web.json_response({"errcode": "M_NOT_FOUND"}, status=404)
+        status, payload = queue.pop(0) if len(queue) > 1 else queue[0]
+        return web.json_response(payload, status=status)
+
+
+async def with_server(homeserver, test):
+    server = TestServer(homeserver.app)
+    await server.start_server()
+    try:
+        return await test(str(server.make_url("")).rstrip("/"))
+    finally:
+        await server.close()
+
+
+def test_api_send_message():
+    hs = FakeHomeserver()
+    room_id = "!abc:example.com"
+
+    async def test(url):
+        api = AsyncMatrixHttpApi(url, token="foobar")
+        path = MATRIX_V2_API_PATH + "/rooms/%s/send/m.room.message/42" % room_id
+        hs.add("PUT", path, response_examples.example_event_response)
+        response = await api.send_message_event(room_id, "m.room.message",
+                                                {"body": "hi"}, txn_id=42)
+        await api.close()
+        return response
+
+    response = run(with_server(hs, test))
+    assert response == response_examples.example_event_response
+    method, _, query, body = hs.requests[0]
+    assert method == "PUT"
+    assert query["access_token"] == "foobar"
+    assert json.loads(body.decode()) == {"body": "hi"}
+
+
+def test_api_error_and_429():
+    hs = FakeHomeserver()
+
+    async def test(url):
+        api = AsyncMatrixHttpApi(url, token="foobar")
+        path = MATRIX_V2_API_PATH + "/profile/@alice:example.com/displayname"
+        hs.add("GET", path, {"retry_after_ms": 1}, status=429)
+        hs.add("GET", path, {"displayname": "Alice"})
+        name = await api.get_display_name("@alice:example.com")
+        with pytest.raises(MatrixRequestError) as e:
+            await api.get_devices()
+        await api.close()
+        return name, e.value.code
+
+    name, code = run(with_server(hs, test))
+    assert name == "Alice"
+    assert code == 404
+    assert len(hs.requests) == 3
+
+
+def test_client_sync_dispatch():
+    hs = FakeHomeserver()
+    room_id = "!726s6s6q:example.com"
+    hs.add("GET", MATRIX_V2_API_PATH + "/sync", deepcopy(response_examples.example_sync))
+    hs.add("POST", MATRIX_V2_API_PATH + "/user/@bob:example.com/filter",
+           {"filter_id": "5"})
+    events = []
+    room_events = []
+
+    async def test(url):
+        client = AsyncMatrixClient(url, token="foobar", user_id="@bob:example.com")
+        client.add_listener(events.append, "m.room.message")
+        await client.listen_for_events()
+        room = client.rooms[room_id]
+        room.add_listener(lambda r, e: room_events.append(e))
+        await client.listen_for_events()
+        await client.close()
+        return client, room
+
+    client, room = run(with_server(hs, test))
+    assert isinstance(room, AsyncRoom)
+    assert client.sync_token == response_examples.example_sync["next_batch"]
+    assert [e["type"] for e in events] == ["m.room.message"] * 2
+    assert len(room_events) == 2
+    assert [r[1].rsplit("/", 1)[-1] for r in hs.requests] == ["filter", "sync", "sync"]
+    assert hs.requests[1][2]["filter"] == "5"
+    assert hs.requests[2][2]["filter"] == "5"
+    assert hs.requests[2][2]["since"] == client.sync_token
+
+
+def test_room_bulk_kick():
+    hs = FakeHomeserver()
+    room_id = "!abc:example.com"
+    for user_id in ("@a:example.com", "@b:example.com"):
+        hs.add("PUT", MATRIX_V2_API_PATH +
+               "/rooms/%s/state/m.room.member/%s" % (room_id, user_id), {})
+
+    async def test(url):
+        client = AsyncMatrixClient(url, token="foobar", user_id="@bob:example.com")
+        room = client._mkroom(room_id)
+        results = await room.kick_users(
+            ["@a:example.com", "@b:example.com", "@c:example.com"], reason="spam",
+            max_concurrency=2)
+        await client.close()
+        return results
+
+    results = run(with_server(hs, test))
+    assert list(results) == ["@a:example.com", "@b:example.com", "@c:example.com"]
+    assert results["@a:example.com"] == {}
+    assert results["@c:example.com"].code == 404
+    assert json.loads(hs.requests[0][3].decode())["reason"] == "spam"
+
+
+def test_client_listener_task():
+    hs = FakeHomeserver()
+    hs.add("GET", MATRIX_V2_API_PATH + "/sync", deepcopy(response_examples.example_sync))
+    events = []
+
+    async def test(url):
+        client = AsyncMatrixClient(url, token="foobar", user_id="@bob:example.com")
+        client.add_listener(events.append)
+        client.start_listener_task(timeout_ms=0)
+        while len(hs.requests) < 3:
+            await asyncio.sleep(0.01)
+        await client.stop_listener_task()
+        await client.close()
+        return client
+
+    client = run(with_server(hs, test))
+    assert client.sync_task is None
+    assert len(events) >= 4
+
+
+def test_upload_file_429(tmpdir):
+    hs = FakeHomeserver()
+    path = "/_matrix/media/r0/upload"
+    hs.add("POST", path, {"retry_after_ms": 1}, status=429)
+    hs.add("POST", path, {"content_uri": "mxc://example.com/abc"})
+    upload = tmpdir.join("upload.bin")
+    upload.write_binary(b"x" * 100000)
+
+    async def test(url):
+        client = AsyncMatrixClient(url, token="foobar", user_id="@bob:example.com")
+        content_uri = await client.upload_file(str(upload), "application/octet-stream")
+        await client.close()
+        return content_uri
+
+    assert run(with_server(hs, test)) == "mxc://example.com/abc"
+    assert [r[3] for r in hs.requests] == [b"x" * 100000] * 2
+
+
+def test_blocking_helpers_not_inherited():
+    client = AsyncMatrixClient("http://example.com")
+    for name in ("start_listener_thread", "stop_listener_thread", "send_queue"):
+        assert not hasattr(client, name)
+    room = client._mkroom("!abc:example.com")
+    for name in ("queue_event", "queue_text", "queue_html"):
+        assert not hasattr(room, name)
+
+
+def test_downloads_not_supported():
+    client = AsyncMatrixClient("http://example.com")
+    for name in ("download", "thumbnail"):
+        assert not hasattr(client, name)
+    for name in ("media_download", "media_thumbnail", "media_download_file",
+                 "sync_stream"):
+        assert not hasattr(client.api, name)
+    with pytest.raises(TypeError):
+        AsyncMatrixClient("http://example.com", media_cache=object())
+
+
+def test_client_upload_cache():
+    hs = FakeHomeserver()
+    hs.add("POST", "/_matrix/media/r0/upload", {"content_uri": "mxc://example.com/abc"})
+
+    async def test(url):
+        client = AsyncMatrixClient(url, token="foobar", user_id="@bob:example.com",
+                                   upload_cache=UploadCache())
+        content_uris = [await client.upload(b"hello", "text/plain")
+                        for _ in range(2)]
+        await client.close()
+        return client, content_uris
+
+    client, content_uris = run(with_server(hs, test))
+    assert content_uris == ["mxc://example.com/abc"] * 2
+    assert len(hs.requests) == 1
+
+
+def test_api_submit_and_map():
+    hs = FakeHomeserver()
+    room_id = "!abc:example.com"
+    for user_id in ("@a:example.com", "@b:example.com"):
+        hs.add("POST", MATRIX_V2_API_PATH + "/rooms/%s/invite" % room_id, {})
+    hs.add("GET", MATRIX_V2_API_PATH + "/profile/@a:example.com/displayname",
+           {"displayname": "A"})
+
+    async def test(url):
+        api = AsyncMatrixHttpApi(url, token="foobar")
+        results = await api.map("invite_user", [room_id] * 2,
+                                ["@a:example.com", "@b:example.com"])
+        name = await api.submit("get_display_name", "@a:example.com")
+        await api.close()
+        return results, name
+
+    results, name = run(with_server(hs, test))
+    assert results == [{}, {}]
+    assert name == "A"
+    # Sent concurrently, in any order
+    assert sorted(json.loads(r[3].decode())["user_id"] for r in hs.requests[:2]) == \
+        ["@a:example.com", "@b:example.com"]
@@ -1,9 +1,11 @@
 import pytest
 import responses
 import json
+import re
 from copy import deepcopy
 from matrix_client.client import MatrixClient, Room, User, CACHE
 from matrix_client.api import MATRIX_V2_API_PATH
+from matrix_client.errors import MatrixRequestError
 from . import response_examples
 try:
     from urllib import quote
@@ -194,7 +196,7 @@ class TestClientRegister:
     def test_register_as_guest(self):
         cli = self.cli
 
-        def _sync(self):
+        def _sync(self, timeout_ms=30000):
             self._sync_called = True
         cli.__dict__[_sync.__name__] = _sync.__get__(cli, cli.__class__)
         register_guest_url = HOSTNAME + MATRIX_V2_API_PATH + "/register"
@@ -237,6 +239,36 @@ def test_get_rooms_display_name():
     assert room4.display_name == "ho1 and 28 others"
 
 
+def test_display_name_from_summary():
+    client = MatrixClient("http://example.com")
+    client.user_id = "@frho0:matrix.org"
+    room = client._mkroom("!abc:matrix.org")
+    room._set_summary({
+        "m.heroes": ["@frho1:matrix.org", "@frho2:matrix.org"],
+        "m.joined_member_count": 1500,
+        "m.invited_member_count": 2,
+    })
+    room._process_state_event({
+        "type": "m.room.member", "state_key": "@frho1:matrix.org",
+        "content": {"membership": "join", "displayname": "ho1"}
+    })
+    # No request is made for the members or their profiles
+    assert room.display_name == "ho1 and 1500 others"
+    assert room.display_name is room.display_name
+
+    room._set_summary({"m.joined_member_count": 2, "m.invited_member_count": 0})
+    assert room.display_name == "ho1"
+    room._process_state_event({
+        "type": "m.room.member", "state_key": "@frho1:matrix.org",
+        "content": {"membership": "join", "displayname": "Ho One"}
+    })
+    assert room.display_name == "Ho One"
+    room._process_state_event({
+        "type": "m.room.name", "state_key": "", "content": {"name": "Fish"}
+    })
+    assert room.display_name == "Fish"
+
+
 @responses.activate
 def test_presence_listener():
     client = MatrixClient("http://example.com")
@@ -517,6 +549,124 @@ def test_detect_encryption_state():
     assert not room.encrypted
 
 
+@responses.activate
+def test_bulk_invite():
+    client = MatrixClient(HOSTNAME)
+    room_id = "!UcYsUzyxTGDxLBEvLz:matrix.org"
+    room = client._mkroom(room_id)
+    invite_url = HOSTNAME + MATRIX_V2_API_PATH + "/rooms/" + room_id + "/invite"
+    user_ids = ["@user%s:matrix.org" % i for i in range(10)]
+
+    def callback(request):
+        user_id = json.loads(request.body)["user_id"]
+        if user_id == "@user3:matrix.org":
+            return 403, {}, json.dumps({"errcode": "M_FORBIDDEN"})
+        return 200, {}, "{}"
+
+    responses.add_callback(responses.POST, invite_url, callback=callback)
+    results = room.invite_users(user_ids + ["@user0:matrix.org"], max_concurrency=3)
+    assert list(results) == user_ids
+    assert results["@user0:matrix.org"] == {}
+    assert isinstance(results["@user3:matrix.org"], MatrixRequestError)
+    assert results["@user3:matrix.org"].code == 403
+    assert len(responses.calls) == 10
+    client.api.shutdown()
+
+
+@responses.activate
+def test_encryption_state_from_sync():
+    client = MatrixClient(HOSTNAME)
+    # Avoid depending on olm, only the room state is tested
+    client._encryption = True
+    sync_url = HOSTNAME + MATRIX_V2_API_PATH + "/sync"
+    room_id = "!726s6s6q:example.com"
+    encrypted_id = "!encrypted:example.com"
+    sync_response = deepcopy(response_examples.example_sync)
+    sync_room = deepcopy(sync_response["rooms"]["join"][room_id])
+    sync_room["state"]["events"].append({
+        "type": "m.room.encryption", "state_key": "",
+        "content": {"algorithm": "m.megolm.v1.aes-sha2"}
+    })
+    sync_response["rooms"]["join"][encrypted_id] = sync_room
+    responses.add(responses.GET, sync_url, json=sync_response)
+
+    client._sync()
+    # No request was made for the encryption state
+    assert len(responses.calls) == 1
+    assert not client.rooms[room_id].encrypted
+    assert client.rooms[encrypted_id].encrypted
+
+
+@responses.activate
+def test_encryption_state_deferred():
+    client = MatrixClient(HOSTNAME)
+    client._encryption = True
+    client.sync_filter = {"room": {"state": {"types": ["m.room.member"]}}}
+    sync_url = HOSTNAME + MATRIX_V2_API_PATH + "/sync"
+    room_id = "!726s6s6q:example.com"
+    responses.add(responses.GET, sync_url, json=response_examples.example_sync)
+
+    client._sync()
+    room = client.rooms[room_id]
+    assert room._encrypted is None
+    assert len(responses.calls) == 1
+
+    encryption_state_path = HOSTNAME + MATRIX_V2_API_PATH + \
+        "/rooms/" + quote(room_id) + "/state/m.room.encryption"
+    responses.add(responses.GET, encryption_state_path,
+                  json={"algorithm": "m.megolm.v1.aes-sha2"})
+    assert room.encrypted
+    assert room.encrypted
+    assert len(responses.calls) == 2
+
+
+@responses.activate
+def test_encryption_state_unknown_after_incremental_sync():
+    client = MatrixClient(HOSTNAME)
+    client._encryption = True
+    client.sync_filter = {"room": {"state": {"types": ["m.room.member"]}}}
+    sync_url = HOSTNAME + MATRIX_V2_API_PATH + "/sync"
+    room_id = "!726s6s6q:example.com"
+    responses.add(responses.GET, sync_url, json=response_examples.example_sync)
+
+    client._sync()
+    # The filter no longer excludes the encryption event, but an incremental sync
+    # does not carry the state of the room
+    client.sync_filter = None
+    client._sync()
+    room = client.rooms[room_id]
+    assert room._encrypted is None
+    assert len(responses.calls) == 2
+
+
+@responses.activate
+def test_resolve_encryption_state_many_rooms():
+    client = MatrixClient(HOSTNAME)
+    client._encryption = True
+    room_ids = ["!room%d:example.com" % i for i in range(4)]
+    for room_id in room_ids:
+        client._mkroom(room_id, lookup_encryption=False)
+
+    def callback(request):
+        if "room1" in request.url:
+            return 404, {}, json.dumps({"errcode": "M_NOT_FOUND"})
+        return 200, {}, json.dumps({"algorithm": "m.megolm.v1.aes-sha2"})
+
+    responses.add_callback(
+        responses.GET,
+        re.compile(re.escape(HOSTNAME + MATRIX_V2_API_PATH) +
+                   r"/rooms/[^/]+/state/m\.room\.encryption"),
+        callback=callback)
+    client.resolve_encryption_state()
+    assert len(responses.calls) == 4
+    assert [client.rooms[room_id]._encrypted for room_id in room_ids] == \
+        [True, False, True, True]
+    # Known states are not looked up again
+    client.resolve_encryption_state()
+    assert len(responses.calls) == 4
+    client.api.shutdown()
+
+
 @responses.activate
 def test_one_time_keys_sync():
     client = MatrixClient(HOSTNAME, encryption=True)
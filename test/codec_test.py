@@ -0,0 +1,62 @@
+import json
+
+import pytest
+import responses
+
+from matrix_client import codec
+from matrix_client.api import MatrixHttpApi, MATRIX_V2_API_PATH
+from . import response_examples
+try:
+    from urllib import quote
+except ImportError:
+    from urllib.parse import quote
+
+HOSTNAME = "http://example.com"
+
+
+@pytest.mark.parametrize("name", codec.available_codecs())
+def test_codec_roundtrip(name):
+    c = codec.get_codec(name)
+    assert c.name == name
+    payload = response_examples.example_sync
+    encoded = c.dumps(payload)
+    assert json.loads(encoded) == payload
+    assert c.loads(encoded) == payload
+    assert c.loads(json.dumps(payload).encode("utf-8")) == payload
+
+
+def test_get_codec():
+    assert codec.get_codec().name == codec.available_codecs()[0]
+    assert codec.get_codec("json").name == "json"
+    instance = codec.JsonCodec()
+    assert codec.get_codec(instance) is instance
+    with pytest.raises(ValueError):
+        codec.get_codec("yaml")
+
+
+def test_default_codec_setting(monkeypatch):
+    monkeypatch.setattr(codec, "default_codec", "json")
+    assert MatrixHttpApi(HOSTNAME).json_codec.name == "json"
+
+
+@responses.activate
+def test_api_uses_codec():
+    calls = []
+
+    class RecordingCodec(codec.JsonCodec):
+        def dumps(self, obj):
+            calls.append("dumps")
+            return super(RecordingCodec, self).dumps(obj)
+
+        def loads(self, data):
+            calls.append("loads")
+            return super(RecordingCodec, self).loads(data)
+
+    api = MatrixHttpApi(HOSTNAME, token="foobar", json_codec=RecordingCodec())
+    url = HOSTNAME + MATRIX_V2_API_PATH + \
+        "/rooms/" + quote("!abc:example.com") + "/state/m.room.name"
+    responses.add(responses.PUT, url, json=response_examples.example_event_response)
+    assert api.set_room_name("!abc:example.com", "foo") == \
+        response_examples.example_event_response
+    assert calls == ["dumps", "loads"]
+    assert json.loads(responses.calls[0].request.body) == {"name": "foo"}
@@ -0,0 +1,194 @@
+import json
+
+import pytest
+import responses
+
+from matrix_client.api import MATRIX_V2_API_PATH
+from matrix_client.client import MatrixClient
+from matrix_client.dedup import DedupIndex
+from matrix_client.store import SQLiteStore
+from .helpers import ROOM_ID, USER_ID, sync_response
+
+HOSTNAME = "http://example.com"
+SYNC_URL = HOSTNAME + MATRIX_V2_API_PATH + "/sync"
+
+
+def test_dedup_index_bounded():
+    index = DedupIndex(max_size=2)
+    assert index.add("$1")
+    assert not index.add("$1")
+    index.update(["$2", "$3"])
+    assert "$1" not in index
+    assert list(index) == ["$2", "$3"]
+    assert len(index) == 2
+
+
+@responses.activate
+def test_checkpoint_replays_failed_batch():
+    responses.add(responses.GET, SYNC_URL, json=sync_response("s0", []))
+    client = MatrixClient(HOSTNAME, token="foobar", user_id=USER_ID,
+                          upload_filter=False, checkpoint=True)
+    delivered = []
+
+    def listener(event):
+        if event["event_id"] == "$2" and "$2" not in delivered:
+            delivered.append("$2")
+            raise ValueError("listener crashed")
+        delivered.append(event["event_id"])
+
+    client.add_listener(listener, "m.room.message")
+    responses.replace(responses.GET, SYNC_URL,
+                      json=sync_response("s1", ["$1", "$2", "$3"]))
+    with pytest.raises(ValueError):
+        client._sync()
+    # The token was not advanced, so the same batch is replayed
+    assert client.sync_token == "s0"
+    client._sync()
+    assert client.sync_token == "s1"
+    assert delivered == ["$1", "$2", "$2", "$3"]
+    assert [e["event_id"] for e in client.rooms[ROOM_ID].get_events()] == \
+        ["$1", "$2", "$3"]
+
+
+@responses.activate
+def test_checkpoint_replays_failed_batch_workers():
+    responses.add(responses.GET, SYNC_URL, json=sync_response("s0", []))
+    client = MatrixClient(HOSTNAME, token="foobar", user_id=USER_ID,
+                          upload_filter=False, checkpoint=True, listener_workers=2)
+    failed = []
+
+    def listener(event):
+        if not failed:
+            failed.append(event["event_id"])
+            raise ValueError("listener crashed")
+
+    client.add_listener(listener, "m.room.message")
+    responses.replace(responses.GET, SYNC_URL, json=sync_response("s1", ["$1"]))
+    client._sync()
+    assert client.sync_token == "s0"
+    assert "timeline $1" not in client.processed_events
+    client._sync()
+    assert client.sync_token == "s1"
+    assert "timeline $1" in client.processed_events
+    client.stop_listener_thread()
+
+
+@pytest.mark.parametrize("listener_workers", [0, 2])
+@responses.activate
+def test_checkpoint_replay_skips_listeners_which_returned(listener_workers):
+    responses.add(responses.GET, SYNC_URL, json=sync_response("s0", []))
+    client = MatrixClient(HOSTNAME, token="foobar", user_id=USER_ID,
+                          upload_filter=False, checkpoint=True,
+                          listener_workers=listener_workers)
+    room_events = []
+    client_events = []
+    invites = []
+    ephemeral = []
+
+    def client_listener(event):
+        client_events.append(event["event_id"])
+        if len(client_events) == 1:
+            raise ValueError("listener crashed")
+
+    client.rooms[ROOM_ID].add_listener(
+        lambda room, event: room_events.append(event["event_id"]), "m.room.message")
+    client.add_listener(client_listener, "m.room.message")
+    client.add_invite_listener(lambda room_id, state: invites.append(room_id))
+    client.add_ephemeral_listener(lambda event: ephemeral.append(event["type"]))
+    response = sync_response("s1", ["$new"])
+    response["rooms"]["invite"] = {"!inv:example.com": {"invite_state": {"events": []}}}
+    responses.replace(responses.GET, SYNC_URL, json=response)
+    if listener_workers:
+        client._sync()
+    else:
+        with pytest.raises(ValueError):
+            client._sync()
+    client._sync()
+    client.stop_listener_thread()
+    assert client.sync_token == "s1"
+    assert client_events == ["$new", "$new"]
+    assert room_events == ["$new"]
+    assert invites == ["!inv:example.com"]
+    assert ephemeral == ["m.typing"]
+
+
+@responses.activate
+def test_checkpoint_replays_only_failed_room():
+    responses.add(responses.GET, SYNC_URL, json=sync_response("s0", []))
+    client = MatrixClient(HOSTNAME, token="foobar", user_id=USER_ID,
+                          upload_filter=False, checkpoint=True, listener_workers=1)
+    delivered = []
+
+    def listener(event):
+        delivered.append(event["event_id"])
+        if delivered.count("$a1") == 1 and event["event_id"] == "$a1":
+            raise ValueError("listener crashed")
+
+    client.add_listener(listener, "m.room.message")
+    response = sync_response("s1", ["$a1", "$a2"])
+    rooms = response["rooms"]["join"]
+    rooms["!b:example.com"] = json.loads(json.dumps(rooms[ROOM_ID]))
+    rooms["!b:example.com"]["timeline"]["events"] = \
+        sync_response("s1", ["$b1"])["rooms"]["join"][ROOM_ID]["timeline"]["events"]
+    responses.replace(responses.GET, SYNC_URL, json=response)
+    client._sync()
+    assert client.sync_token == "s0"
+    # The other room was processed, the failed one stopped at the failed event
+    assert delivered == ["$a1", "$b1"]
+    assert "timeline $b1" in client.processed_events
+    assert "timeline $a1" not in client.processed_events
+    client._sync()
+    assert client.sync_token == "s1"
+    assert delivered == ["$a1", "$b1", "$a1", "$a2"]
+    client.stop_listener_thread()
+
+
+@responses.activate
+def test_checkpoint_persists_processed_events(tmpdir):
+    path = str(tmpdir.join("state.db"))
+    responses.add(responses.GET, SYNC_URL, json=sync_response("s1", ["$1", "$2"]))
+    client = MatrixClient(HOSTNAME, token="foobar", user_id=USER_ID,
+                          upload_filter=False, checkpoint=True,
+                          store=SQLiteStore(path))
+    client.store.close()
+
+    # Simulate a crash after the events were processed but before the token was saved
+    store = SQLiteStore(path)
+    store.set_meta("sync_token", None)
+    store.commit()
+    assert {"timeline $1", "timeline $2"} <= set(store.get_processed_events())
+
+    delivered = []
+    client = MatrixClient(HOSTNAME, token="foobar", user_id=USER_ID,
+                          upload_filter=False, checkpoint=True, store=store)
+    client.add_listener(lambda event: delivered.append(event["event_id"]),
+                        "m.room.message")
+    responses.replace(responses.GET, SYNC_URL,
+                      json=sync_response("s2", ["$1", "$2", "$3"]))
+    client._sync()
+    assert delivered == ["$3"]
+    assert client.sync_token == "s2"
+    store.close()
+
+
+@responses.activate
+def test_checkpoint_commits_processed_events_per_batch(tmpdir):
+    path = str(tmpdir.join("state.db"))
+    responses.add(responses.GET, SYNC_URL, json=sync_response("s1", ["$1", "$2"]))
+    store = SQLiteStore(path)
+    committed = []
+    store_commit = store.commit
+
+    def commit():
+        # What another connection saw before this commit
+        committed.append(SQLiteStore(path).get_processed_events())
+        store_commit()
+
+    store.commit = commit
+    client = MatrixClient(HOSTNAME, token="foobar", user_id=USER_ID,
+                          upload_filter=False, checkpoint=True, store=store)
+    # The events were only committed with the sync token
+    assert all("timeline $1" not in events for events in committed)
+    assert {"timeline $1", "timeline $2"} <= \
+        set(SQLiteStore(path).get_processed_events())
+    client.store.close()
@@ -0,0 +1,121 @@
+import threading
+import time
+
+import pytest
+
+from matrix_client.client import MatrixClient
+from matrix_client.executor import ShardedExecutor
+from . import response_examples
+
+
+def test_tasks_of_a_key_run_in_order():
+    executor = ShardedExecutor(4)
+    results = {}
+
+    def record(key, i):
+        results.setdefault(key, []).append(i)
+
+    for i in range(100):
+        for key in ("!a:example.com", "!b:example.com", "!c:example.com"):
+            executor.submit(key, record, key, i)
+    executor.drain()
+    assert all(values == list(range(100)) for values in results.values())
+    assert executor.pending() == 0
+    executor.shutdown()
+    with pytest.raises(RuntimeError):
+        executor.submit("a", record, "a", 0)
+
+
+def test_keys_run_in_parallel():
+    executor = ShardedExecutor(2)
+    # Find two keys handled by different workers
+    keys = ["a"]
+    key = 0
+    while len(keys) < 2:
+        key += 1
+        if executor._queue_for(str(key)) is not executor._queue_for("a"):
+            keys.append(str(key))
+    release = threading.Event()
+    done = []
+    executor.submit(keys[0], release.wait)
+    executor.submit(keys[1], done.append, True)
+    executor.submit(keys[1], release.set)
+    assert release.wait(5)
+    executor.shutdown()
+    assert done == [True]
+
+
+def test_submit_blocks_when_queue_full():
+    executor = ShardedExecutor(1, max_pending=1)
+    release = threading.Event()
+    executor.submit("a", release.wait)
+    # Wait for the worker to pick up the first task
+    while executor._queues[0].qsize():
+        time.sleep(0.01)
+    executor.submit("a", lambda: None)
+
+    submitted = threading.Event()
+
+    def submit():
+        executor.submit("a", lambda: None)
+        submitted.set()
+
+    thread = threading.Thread(target=submit)
+    thread.start()
+    assert not submitted.wait(0.1)
+    release.set()
+    assert submitted.wait(5)
+    thread.join()
+    executor.shutdown()
+
+
+def test_exception_handler():
+    errors = []
+    executor = ShardedExecutor(1, exception_handler=errors.append)
+
+    def fail():
+        raise ValueError("oops")
+
+    executor.submit("a", fail)
+    executor.shutdown()
+    assert len(errors) == 1 and isinstance(errors[0], ValueError)
+
+
+def test_client_listener_workers():
+    client = MatrixClient("http://example.com", listener_workers=2)
+    threads = []
+    events = []
+
+    def listener(event):
+        threads.append(threading.current_thread())
+        events.append(event["event_id"])
+
+    client.add_listener(listener)
+    client._handle_sync(response_examples.example_sync)
+    client.stop_listener_thread()
+    assert events == ["$7365636s6r6432:example.com", "$74686972643033:example.com"]
+    assert threads[0] is not threading.current_thread()
+    assert client._listener_executor is None
+
+
+def test_client_listener_executor_created_once(monkeypatch):
+    created = []
+
+    class SlowExecutor(ShardedExecutor):
+        def __init__(self, *args, **kwargs):
+            created.append(self)
+            # Let other threads race past the check
+            time.sleep(0.01)
+            super(SlowExecutor, self).__init__(*args, **kwargs)
+
+    monkeypatch.setattr("matrix_client.client.ShardedExecutor", SlowExecutor)
+    client = MatrixClient("http://example.com", listener_workers=2)
+    threads = [threading.Thread(target=client._dispatch,
+                                args=("!a:example.com", lambda: None))
+               for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    client.stop_listener_thread()
+    assert len(created) == 1
@@ -0,0 +1,217 @@
+import json
+
+import pytest
+import responses
+
+from matrix_client.api import MATRIX_V2_API_PATH
+from matrix_client.client import CACHE, MatrixClient
+from matrix_client.filter import FilterCache, SyncFilter, filter_hash, filter_includes
+from . import response_examples
+
+HOSTNAME = "http://example.com"
+USER_ID = "@alice:example.com"
+FILTER_URL = HOSTNAME + MATRIX_V2_API_PATH + "/user/" + USER_ID + "/filter"
+SYNC_URL = HOSTNAME + MATRIX_V2_API_PATH + "/sync"
+
+
+def test_sync_filter_builder():
+    sync_filter = SyncFilter().timeline_limit(10) \
+        .event_types(["m.room.message"]) \
+        .event_types([], section="presence") \
+        .not_event_types(["m.typing"], section="ephemeral") \
+        .lazy_load_members() \
+        .event_fields(["type", "content.body"])
+    assert sync_filter.to_dict() == {
+        "room": {
+            "timeline": {"limit": 10, "types": ["m.room.message"],
+                         "lazy_load_members": True},
+            "state": {"lazy_load_members": True},
+            "ephemeral": {"not_types": ["m.typing"]},
+        },
+        "presence": {"types": []},
+        "event_fields": ["type", "content.body"],
+    }
+    assert json.loads(sync_filter.to_json()) == sync_filter.to_dict()
+    with pytest.raises(ValueError):
+        sync_filter.event_types([], section="foo")
+
+
+def test_filter_hash_ignores_formatting():
+    definition = {"room": {"timeline": {"limit": 10}}, "presence": {"types": []}}
+    assert filter_hash(definition) == filter_hash(json.dumps(definition, indent=4))
+    assert filter_hash(definition) == filter_hash(SyncFilter(definition))
+    assert filter_hash(definition) != filter_hash({"room": {}})
+
+
+def test_filter_includes():
+    assert filter_includes(None, "m.room.encryption")
+    sync_filter = SyncFilter().event_types(["m.room.*"], section="state") \
+        .not_event_types(["m.room.member"], section="state")
+    assert filter_includes(sync_filter, "m.room.encryption")
+    assert not filter_includes(sync_filter, "m.room.member")
+    assert not filter_includes(sync_filter, "org.example.custom")
+    assert filter_includes(sync_filter, "org.example.custom", section="timeline")
+
+
+def test_filter_cache_persistence(tmpdir):
+    path = str(tmpdir.join("filters.json"))
+    cache = FilterCache(path)
+    assert cache.get(USER_ID, "abc") is None
+    cache.set(USER_ID, "abc", "12")
+    assert cache.get(USER_ID, "abc") == "12"
+    assert FilterCache(path).get(USER_ID, "abc") == "12"
+    assert FilterCache(path).get("@bob:example.com", "abc") is None
+
+
+def sync_filters():
+    return [call.request.params.get("filter") for call in responses.calls
+            if call.request.url.startswith(SYNC_URL)]
+
+
+@responses.activate
+def test_filter_uploaded_once(tmpdir):
+    path = str(tmpdir.join("filters.json"))
+    responses.add(responses.POST, FILTER_URL, json={"filter_id": "7"})
+    responses.add(responses.GET, SYNC_URL, json=response_examples.example_sync)
+    client = MatrixClient(HOSTNAME, token="foobar", user_id=USER_ID,
+                          filter_cache_path=path)
+    client._sync()
+    assert sync_filters() == ["7", "7"]
+    filter_calls = [c for c in responses.calls if c.request.url.startswith(FILTER_URL)]
+    assert len(filter_calls) == 1
+    assert json.loads(filter_calls[0].request.body) == \
+        {"room": {"timeline": {"limit": 20}}}
+
+    # A restarted client reuses the ID from disk
+    MatrixClient(HOSTNAME, token="foobar", user_id=USER_ID, filter_cache_path=path)
+    assert len(responses.calls) == 4
+
+    # Changing the filter uploads the new definition
+    responses.replace(responses.POST, FILTER_URL, json={"filter_id": "8"})
+    client.sync_filter = SyncFilter().timeline_limit(5)
+    client._sync()
+    assert sync_filters()[-1] == "8"
+
+
+@responses.activate
+def test_rejected_filter_uploaded_again(tmpdir):
+    path = str(tmpdir.join("filters.json"))
+    FilterCache(path).set(USER_ID, filter_hash({"room": {"timeline": {"limit": 20}}}),
+                          "7")
+
+    def sync(request):
+        if request.params.get("filter") == "7":
+            return 400, {}, json.dumps({"errcode": "M_UNKNOWN",
+                                        "error": "No such filter"})
+        return 200, {}, json.dumps(response_examples.example_sync)
+
+    responses.add_callback(responses.GET, SYNC_URL, callback=sync)
+    responses.add(responses.POST, FILTER_URL, json={"filter_id": "8"})
+    MatrixClient(HOSTNAME, token="foobar", user_id=USER_ID, filter_cache_path=path)
+    assert sync_filters() == ["7", "8"]
+    # The new ID is kept across restarts
+    assert FilterCache(path).invalidate(USER_ID, "8")
+
+
+@responses.activate
+def test_filter_inline_fallback():
+    responses.add(responses.POST, FILTER_URL, status=404,
+                  json={"errcode": "M_UNRECOGNIZED"})
+    responses.add(responses.GET, SYNC_URL, json=response_examples.example_sync)
+    client = MatrixClient(HOSTNAME, token="foobar", user_id=USER_ID)
+    client._sync()
+    assert not client.upload_filter
+    assert [json.loads(f) for f in sync_filters()] == \
+        [{"room": {"timeline": {"limit": 20}}}] * 2
+    assert len(responses.calls) == 3
+
+    client = MatrixClient(HOSTNAME, upload_filter=False)
+    client.user_id = USER_ID
+    client._sync()
+    assert len(responses.calls) == 4
+
+
+@responses.activate
+def test_filter_upload_retried_after_error():
+    responses.add(responses.POST, FILTER_URL, status=502, json={})
+    responses.add(responses.POST, FILTER_URL, json={"filter_id": "7"})
+    responses.add(responses.GET, SYNC_URL, json=response_examples.example_sync)
+    client = MatrixClient(HOSTNAME, token="foobar", user_id=USER_ID)
+    # The first sync sends the filter inline, the next one uploads it again
+    assert client.upload_filter
+    client._sync()
+    assert client.upload_filter
+    filters = sync_filters()
+    assert json.loads(filters[0]) == {"room": {"timeline": {"limit": 20}}}
+    assert filters[1] == "7"
+
+
+@responses.activate
+def test_filter_id_passed_through():
+    responses.add(responses.GET, SYNC_URL, json=response_examples.example_sync)
+    for upload_filter in (True, False):
+        client = MatrixClient(HOSTNAME, upload_filter=upload_filter,
+                              auto_filter=True)
+        client.user_id = USER_ID
+        client.sync_filter = "myfilterid"
+        client._sync()
+        assert sync_filters()[-1] == "myfilterid"
+    assert not [c for c in responses.calls if c.request.url.startswith(FILTER_URL)]
+
+
+def test_auto_filter_follows_listeners():
+    client = MatrixClient(HOSTNAME, upload_filter=False, auto_filter=True,
+                          cache_level=CACHE.NONE)
+    room = client._mkroom("!room:example.com")
+
+    def current_filter():
+        return json.loads(client._get_sync_filter())
+
+    assert current_filter() == {
+        "room": {
+            "timeline": {"limit": 20, "types": []},
+            "state": {"types": []},
+            "ephemeral": {"types": []},
+            "account_data": {"types": []},
+        },
+        "presence": {"types": []},
+        "account_data": {"types": []},
+    }
+
+    uid = client.add_listener(lambda e: None, event_type="m.room.message")
+    room.add_state_listener(lambda e: None, event_type="m.room.topic")
+    room.add_ephemeral_listener(lambda e: None, event_type="m.typing")
+    client.add_presence_listener(lambda e: None)
+    definition = current_filter()
+    assert definition["room"]["timeline"]["types"] == ["m.room.message", "m.room.topic"]
+    assert definition["room"]["state"]["types"] == ["m.room.topic"]
+    assert definition["room"]["ephemeral"]["types"] == ["m.typing"]
+    assert "presence" not in definition
+
+    client.remove_listener(uid)
+    assert current_filter()["room"]["timeline"]["types"] == ["m.room.topic"]
+
+    # A listener for every event type lifts the restriction
+    room.add_listener(lambda r, e: None)
+    assert "types" not in current_filter()["room"]["timeline"]
+
+
+def test_auto_filter_keeps_cached_state():
+    client = MatrixClient(HOSTNAME, upload_filter=False, auto_filter=True)
+    definition = json.loads(client._get_sync_filter())
+    assert "m.room.member" in definition["room"]["state"]["types"]
+    assert "m.room.name" in definition["room"]["timeline"]["types"]
+
+
+@responses.activate
+def test_auto_filter_reuploaded_on_change():
+    responses.add(responses.POST, FILTER_URL, json={"filter_id": "1"})
+    responses.add(responses.GET, SYNC_URL, json=response_examples.example_sync)
+    client = MatrixClient(HOSTNAME, token="foobar", user_id=USER_ID, auto_filter=True)
+    client._sync()
+    responses.replace(responses.POST, FILTER_URL, json={"filter_id": "2"})
+    client.add_listener(lambda e: None, event_type="m.room.message")
+    client._sync()
+    assert sync_filters() == ["1", "1", "2"]
+    body = json.loads(responses.calls[-2].request.body)
+    assert "m.room.message" in body["room"]["timeline"]["types"]
@@ -0,0 +1,55 @@
+import json
+
+from . import response_examples
+
+ROOM_ID = "!726s6s6q:example.com"
+USER_ID = "@alice:example.com"
+
+
+def sync_response(next_batch, event_ids=None, state_events=()):
+    """Return a copy of the example /sync response.
+
+    Args:
+        next_batch (str): The token of the response.
+        event_ids (list): Optional. Replace the timeline of the joined room with
+            messages with these IDs.
+        state_events (list): Optional. Added to the state of the joined room.
+    """
+    response = json.loads(json.dumps(response_examples.example_sync))
+    response["next_batch"] = next_batch
+    room = response["rooms"]["join"][ROOM_ID]
+    if event_ids is not None:
+        room["timeline"]["events"] = [
+            {"type": "m.room.message", "event_id": event_id, "sender": USER_ID,
+             "content": {"msgtype": "m.text", "body": "hi"}}
+            for event_id in event_ids
+        ]
+    room["state"]["events"].extend(state_events)
+    return response
+
+
+class FakeUpload(object):
+    """Reads streamed upload bodies, answering 429 first if asked, and every
+    upload after with a new content URI."""
+
+    def __init__(self, rate_limited=0):
+        self.rate_limited = rate_limited
+        self.bodies = []
+        self.headers = []
+        self.uploaded = 0
+
+    def __call__(self, request):
+        body = request.body
+        if hasattr(body, "read"):
+            body = body.read()
+        elif not isinstance(body, bytes):
+            body = b"".join(body)
+        self.bodies.append(body)
+        self.headers.append(request.headers)
+        if self.rate_limited:
+            self.rate_limited -= 1
+            return 429, {}, json.dumps({"errcode": "M_LIMIT_EXCEEDED",
+                                        "retry_after_ms": 1})
+        self.uploaded += 1
+        uri = "mxc://example.com/%d" % self.uploaded
+        return 200, {}, json.dumps({"content_uri": uri})
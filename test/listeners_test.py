@@ -0,0 +1,60 @@
+from matrix_client.client import MatrixClient
+from matrix_client.listeners import ListenerRegistry
+
+
+def test_registry_dispatch_order():
+    registry = ListenerRegistry()
+    calls = []
+    registry.add(lambda e: calls.append("any1"))
+    registry.add(lambda e: calls.append("message"), "m.room.message")
+    registry.add(lambda e: calls.append("topic"), "m.room.topic")
+    registry.add(lambda e: calls.append("any2"))
+
+    registry.dispatch({"type": "m.room.message"})
+    assert calls == ["any1", "message", "any2"]
+    del calls[:]
+    registry.dispatch({"type": "m.room.name"})
+    assert calls == ["any1", "any2"]
+    assert registry.event_types() == {None, "m.room.message", "m.room.topic"}
+    assert [listener["event_type"] for listener in registry] == \
+        [None, "m.room.message", "m.room.topic", None]
+
+
+def test_registry_remove():
+    registry = ListenerRegistry()
+    uid = registry.add(lambda e: None, "m.room.message")
+    assert uid in registry and len(registry) == 1
+    assert registry.remove(uid)
+    assert not registry.remove(uid)
+    assert uid not in registry and len(registry) == 0
+    assert registry.matching("m.room.message") == []
+    assert registry.event_types() == set()
+
+
+def test_listener_removing_itself():
+    registry = ListenerRegistry()
+    calls = []
+
+    def once(event):
+        calls.append(event)
+        registry.remove(uid)
+
+    uid = registry.add(once)
+    registry.add(lambda e: calls.append("other"))
+    registry.dispatch({"type": "m.room.message"})
+    registry.dispatch({"type": "m.room.message"})
+    assert len(calls) == 3
+
+
+def test_room_state_listener():
+    client = MatrixClient("http://example.com")
+    room = client._mkroom("!room:example.com")
+    topics = []
+    uid = room.add_state_listener(topics.append, "m.room.topic")
+    event = {"type": "m.room.topic", "content": {"topic": "foo"}, "state_key": ""}
+    room._process_state_event(event)
+    room._process_state_event({"type": "m.room.name", "content": {"name": "bar"},
+                               "state_key": ""})
+    room.remove_state_listener(uid)
+    room._process_state_event(event)
+    assert topics == [event]
@@ -0,0 +1,151 @@
+import json
+import re
+from copy import deepcopy
+
+import pytest
+import responses
+
+from matrix_client.api import MATRIX_V2_API_PATH
+from matrix_client.client import MatrixClient
+from matrix_client.errors import MatrixRequestError
+from . import response_examples
+
+HOSTNAME = "http://example.com"
+USER_ID = "@alice:example.com"
+ROOM_ID = "!726s6s6q:example.com"
+SYNC_URL = HOSTNAME + MATRIX_V2_API_PATH + "/sync"
+
+
+def echo_sync(txn_id):
+    sync = deepcopy(response_examples.example_sync)
+    sync["rooms"]["join"][ROOM_ID]["timeline"]["events"] = [{
+        "type": "m.room.message", "sender": USER_ID, "event_id": "$sent:example.com",
+        "origin_server_ts": 1, "content": {"msgtype": "m.text", "body": "hi"},
+        "unsigned": {"transaction_id": txn_id},
+    }]
+    return sync
+
+
+@responses.activate
+def test_local_echo_reconciled_by_sync():
+    client = MatrixClient(HOSTNAME, local_echo=True, upload_filter=False)
+    client.user_id = USER_ID
+    room = client._mkroom(ROOM_ID)
+    local = []
+    remote = []
+    room_events = []
+    room.add_listener(lambda r, e: local.append(dict(e)), local_echo=True)
+    room.add_listener(lambda r, e: room_events.append(e), local_echo=True)
+    client.add_listener(remote.append, "m.room.message")
+
+    txn_ids = []
+
+    def send(request):
+        txn_ids.append(request.url.split("?")[0].rsplit("/", 1)[-1])
+        # The echo is visible before the homeserver answered
+        assert len(room.events) == 1
+        return 200, {}, json.dumps({"event_id": "$sent:example.com"})
+
+    responses.add_callback(
+        responses.PUT,
+        re.compile(re.escape(HOSTNAME + MATRIX_V2_API_PATH) + "/rooms/.+/send/"),
+        callback=send)
+    room.send_text("hi")
+
+    pending = room.events[0]
+    assert "event_id" not in pending
+    assert pending["unsigned"]["transaction_id"] == txn_ids[0]
+    assert list(room.pending_events) == txn_ids
+    assert local == [pending]
+    assert remote == []
+
+    responses.add(responses.GET, SYNC_URL, json=echo_sync(txn_ids[0]))
+    client._sync()
+    # The local echo was replaced in place
+    assert len(room.events) == 1
+    assert room.events[0] is pending
+    assert pending["event_id"] == "$sent:example.com"
+    assert room.get_event("$sent:example.com") is pending
+    assert not room.pending_events
+    # Listeners get the local echo itself, so it can be told apart from a new event
+    assert remote == [pending]
+    assert remote[0] is pending
+    assert [e is pending for e in room_events] == [True, True]
+
+
+@responses.activate
+def test_local_echo_marked_failed():
+    client = MatrixClient(HOSTNAME, local_echo=True, upload_filter=False)
+    client.user_id = USER_ID
+    room = client._mkroom(ROOM_ID)
+    local = []
+    room.add_listener(lambda r, e: local.append(dict(e["unsigned"])), local_echo=True)
+    responses.add(
+        responses.PUT,
+        re.compile(re.escape(HOSTNAME + MATRIX_V2_API_PATH) + "/rooms/.+/send/"),
+        status=403, json={"errcode": "M_FORBIDDEN"})
+
+    with pytest.raises(MatrixRequestError):
+        room.send_text("hi")
+    assert room.get_events()[0]["unsigned"]["failed"]
+    assert not room.pending_events
+    assert [unsigned.get("failed") for unsigned in local] == [None, True]
+
+    future = room.queue_text("hi again")
+    assert isinstance(future.exception(), MatrixRequestError)
+    client.send_queue.shutdown()
+    assert [e["unsigned"].get("failed") for e in room.get_events()] == [True, True]
+    assert len(local) == 4
+
+
+@responses.activate
+def test_local_echo_listener_failure():
+    client = MatrixClient(HOSTNAME, local_echo=True, upload_filter=False)
+    client.user_id = USER_ID
+    room = client._mkroom(ROOM_ID)
+
+    def listener(room, event):
+        raise ValueError("listener crashed")
+
+    room.add_listener(listener, local_echo=True)
+    for send in (room.send_text, room.queue_text):
+        with pytest.raises(ValueError):
+            send("hi")
+    # Nothing was sent, and the echoes are not left pending
+    assert not responses.calls
+    assert not room.pending_events
+    assert [e["unsigned"].get("failed") for e in room.get_events()] == [True, True]
+
+
+@responses.activate
+def test_local_echo_pushed_out_of_timeline():
+    client = MatrixClient(HOSTNAME, local_echo=True, upload_filter=False)
+    client.user_id = USER_ID
+    room = client._mkroom(ROOM_ID)
+    room.event_history_limit = 3
+    responses.add(
+        responses.PUT,
+        re.compile(re.escape(HOSTNAME + MATRIX_V2_API_PATH) + "/rooms/.+/send/"),
+        json={"event_id": "$sent:example.com"})
+    room.send_text("hi")
+    txn_id = next(iter(room.pending_events))
+
+    sync = echo_sync(txn_id)
+    timeline = sync["rooms"]["join"][ROOM_ID]["timeline"]["events"]
+    timeline[:0] = [{
+        "type": "m.room.message", "sender": "@bob:example.com",
+        "event_id": "$b%d:example.com" % i, "origin_server_ts": 1,
+        "content": {"msgtype": "m.text", "body": "hello"},
+    } for i in range(3)]
+    responses.add(responses.GET, SYNC_URL, json=sync)
+    client._sync()
+    assert [e["event_id"] for e in room.events] == \
+        ["$b1:example.com", "$b2:example.com", "$sent:example.com"]
+    assert room.get_event("$sent:example.com")["unsigned"]["transaction_id"] == txn_id
+
+
+def test_no_local_echo_by_default():
+    client = MatrixClient(HOSTNAME)
+    room = client._mkroom(ROOM_ID)
+    assert room._local_echo("m.room.message", {"body": "hi"}) is None
+    assert len(room.events) == 0
@@ -0,0 +1,204 @@
+from threading import Lock
+
+import pytest
+import responses
+
+from matrix_client.api import MatrixHttpApi
+from matrix_client.client import MatrixClient
+from matrix_client.errors import (MatrixHttpLibError, MatrixRequestError,
+                                  MatrixUnexpectedResponse)
+from matrix_client.media_cache import MediaCache
+
+HOSTNAME = "http://example.com"
+DOWNLOAD_URL = HOSTNAME + "/_matrix/media/r0/download/example.com/abc"
+THUMBNAIL_URL = HOSTNAME + "/_matrix/media/r0/thumbnail/example.com/abc"
+DATA = bytes(bytearray(range(256))) * 64
+
+
+class FakeMedia(object):
+    """Serves DATA, honouring Range headers. The first responses are cut short if
+    asked."""
+
+    def __init__(self, truncate=0, ranges=True):
+        self.truncate = truncate
+        self.ranges = ranges
+        self.requests = []
+        self.lock = Lock()
+
+    def __call__(self, request):
+        start, stop = 0, len(DATA)
+        range_header = request.headers.get("Range")
+        if self.ranges and range_header:
+            first, last = range_header[len("bytes="):].split("-")
+            start = int(first)
+            if last:
+                stop = min(int(last) + 1, stop)
+        body = DATA[start:stop]
+        headers = {"Content-Length": str(len(body))}
+        status = 200
+        if self.ranges and range_header:
+            status = 206
+            headers["Content-Range"] = "bytes %d-%d/%d" % (start, stop - 1, len(DATA))
+        with self.lock:
+            self.requests.append(request)
+            if self.truncate:
+                self.truncate -= 1
+                body = body[:len(body) // 2]
+        return status, headers, body
+
+
+@responses.activate
+def test_download_resumes_with_range():
+    fake = FakeMedia(truncate=2)
+    responses.add_callback(responses.GET, DOWNLOAD_URL, callback=fake)
+    api = MatrixHttpApi(HOSTNAME)
+
+    assert b"".join(api.media_download("mxc://example.com/abc", chunk_size=1024)) == DATA
+    assert [r.headers.get("Range") for r in fake.requests] == \
+        [None, "bytes=%d-" % (len(DATA) // 2), "bytes=%d-" % (len(DATA) * 3 // 4)]
+
+
+@responses.activate
+def test_download_without_range_support():
+    fake = FakeMedia(truncate=1, ranges=False)
+    responses.add_callback(responses.GET, DOWNLOAD_URL, callback=fake)
+    api = MatrixHttpApi(HOSTNAME)
+
+    assert b"".join(api.media_download("mxc://example.com/abc", max_retries=1)) == DATA
+    assert len(fake.requests) == 2
+
+
+@responses.activate
+def test_download_gives_up():
+    responses.add_callback(responses.GET, DOWNLOAD_URL, callback=FakeMedia(truncate=3))
+    api = MatrixHttpApi(HOSTNAME)
+
+    with pytest.raises(MatrixHttpLibError):
+        b"".join(api.media_download("mxc://example.com/abc", max_retries=2))
+
+    responses.add(responses.GET, HOSTNAME + "/_matrix/media/r0/download/example.com/x",
+                  status=404, json={"errcode": "M_NOT_FOUND"})
+    with pytest.raises(MatrixRequestError):
+        api.media_download("mxc://example.com/x")
+
+
+@responses.activate
+def test_download_file_in_parts(tmpdir):
+    fake = FakeMedia(truncate=2)
+    responses.add_callback(responses.GET, DOWNLOAD_URL, callback=fake)
+    api = MatrixHttpApi(HOSTNAME, max_workers=4)
+    path = tmpdir.join("out.bin")
+
+    with open(str(path), "wb") as f:
+        f.write(b"header")
+        assert api.media_download_file("mxc://example.com/abc", f, part_size=1000,
+                                       max_parallel=4) == len(DATA)
+    assert path.read_binary() == b"header" + DATA
+    ranges = set(r.headers["Range"] for r in fake.requests)
+    assert set("bytes=%d-%d" % (start, min(start + 1000, len(DATA)) - 1)
+               for start in range(0, len(DATA), 1000)) <= ranges
+    # Two parts were resumed
+    assert len(fake.requests) == len(range(0, len(DATA), 1000)) + 2
+    api.shutdown()
+
+
+@responses.activate
+def test_download_file_without_range_support(tmpdir):
+    fake = FakeMedia(ranges=False)
+    responses.add_callback(responses.GET, DOWNLOAD_URL, callback=fake)
+    api = MatrixHttpApi(HOSTNAME)
+    path = tmpdir.join("out.bin")
+    path.write_binary(b"x" * (len(DATA) + 10))
+
+    with open(str(path), "r+b") as f:
+        assert api.media_download_file("mxc://example.com/abc", f,
+                                       part_size=1000) == len(DATA)
+    assert path.read_binary() == DATA
+    assert len(fake.requests) == 1
+
+
+@responses.activate
+def test_download_file_checks_parts(tmpdir):
+    def callback(request):
+        # Always answers with the first bytes
+        return 206, {"Content-Range": "bytes 0-999/%d" % len(DATA)}, DATA[:1000]
+
+    responses.add_callback(responses.GET, DOWNLOAD_URL, callback=callback)
+    api = MatrixHttpApi(HOSTNAME)
+
+    with open(str(tmpdir.join("out.bin")), "wb") as f:
+        with pytest.raises(MatrixUnexpectedResponse):
+            api.media_download_file("mxc://example.com/abc", f, part_size=1000)
+    api.shutdown()
+
+
+@responses.activate
+def test_download_cached(tmpdir):
+    fake = FakeMedia()
+    responses.add_callback(responses.GET, DOWNLOAD_URL, callback=fake)
+    responses.add_callback(responses.GET, THUMBNAIL_URL, callback=fake)
+    cache = MediaCache(str(tmpdir), memory_item_bytes=1024)
+    client = MatrixClient(HOSTNAME, media_cache=cache)
+
+    out = tmpdir.join("out.bin")
+    with open(str(out), "wb") as f:
+        assert client.download("mxc://example.com/abc", f) == len(DATA)
+    assert out.read_binary() == DATA
+    assert b"".join(client.download("mxc://example.com/abc")) == DATA
+    assert len(fake.requests) == 1
+
+    assert b"".join(client.thumbnail("mxc://example.com/abc", 32, 32)) == DATA
+    assert b"".join(client.thumbnail("mxc://example.com/abc", 32, 32)) == DATA
+    assert len(fake.requests) == 2
+    assert "width=32" in fake.requests[1].url
+    # Both keys share the same file
+    assert cache.size == len(DATA)
+
+    # The index survives restarts
+    cache.close()
+    client.media_cache = MediaCache(str(tmpdir))
+    assert b"".join(client.download("mxc://example.com/abc")) == DATA
+    assert len(fake.requests) == 2
+
+
+def test_cache_eviction_and_memory_tier(tmpdir):
+    cache = MediaCache(str(tmpdir), max_bytes=250, memory_bytes=150,
+                       memory_item_bytes=100)
+
+    def content(data):
+        return lambda offset: [data[offset:]]
+
+    cache.fetch("a", content(b"a" * 100)).close()
+    cache.fetch("b", content(b"b" * 100)).close()
+    assert cache.memory_size == 100
+    # Used last, so "b" gets evicted instead
+    assert cache.open("a").read() == b"a" * 100
+    cache.fetch("c", content(b"c" * 100)).close()
+    assert cache.size == 200
+    assert cache.open("b") is None
+    # "c" is served from memory, "a" from disk
+    assert list(cache._memory) == ["c"]
+    assert cache.open("a").read() == b"a" * 100
+    cache.clear()
+    assert cache.open("a") is None
+    assert cache.size == 0
+
+
+def test_cache_resumes_partial_download(tmpdir):
+    cache = MediaCache(str(tmpdir))
+    offsets = []
+
+    def download(offset):
+        offsets.append(offset)
+        yield DATA[offset:offset + 1000]
+        if len(offsets) == 1:
+            raise IOError("connection lost")
+        yield DATA[offset + 1000:]
+
+    with pytest.raises(IOError):
+        cache.fetch("key", download)
+    # As after a restart
+    cache = MediaCache(str(tmpdir))
+    assert cache.fetch("key", download).read() == DATA
+    assert offsets == [0, 1000]
+    assert not tmpdir.join("partial").listdir()
@@ -0,0 +1,61 @@
+from matrix_client.client import MatrixClient
+from matrix_client.members import MemberStore
+from matrix_client.user import User
+
+
+def member_event(user_id, membership, displayname=None):
+    content = {"membership": membership}
+    if displayname:
+        content["displayname"] = displayname
+    return {"type": "m.room.member", "state_key": user_id, "content": content}
+
+
+def test_member_store():
+    store = MemberStore()
+    alice = User(None, "@alice:example.com", "Alice")
+    store.add(alice)
+    store.add(User(None, "@bob:example.com"))
+    joined = store.joined()
+    assert [u.user_id for u in joined] == ["@alice:example.com", "@bob:example.com"]
+    # Cached until the next change
+    assert store.joined() is joined
+
+    store.add(User(None, "@alice:example.com", "Alice 2"))
+    assert store.get("@alice:example.com") is alice
+    assert store.display_name("@alice:example.com") == "Alice 2"
+    assert store.joined() is joined
+
+    store.remove("@bob:example.com", "ban")
+    assert "@bob:example.com" not in store
+    assert store.membership("@bob:example.com") == "ban"
+    assert store.membership("@alice:example.com") == "join"
+    assert [u.user_id for u in store] == ["@alice:example.com"]
+    assert len(store) == 1
+
+
+def test_member_store_changes_in_join_order():
+    store = MemberStore(track_changes=True)
+    user_ids = ["@user%d:example.com" % i for i in reversed(range(20))]
+    for user_id in user_ids:
+        store.add(User(None, user_id))
+    store.remove(user_ids[0])
+    store.add(User(None, user_ids[0]))
+    assert list(store.pop_changes()) == user_ids[1:] + user_ids[:1]
+    assert not store.pop_changes()
+
+
+def test_room_member_events():
+    client = MatrixClient("http://example.com")
+    room = client._mkroom("!room:example.com")
+    for i in range(1000):
+        room._process_state_event(member_event("@u%d:example.com" % i, "join"))
+    room._process_state_event(member_event("@u1:example.com", "join", "One"))
+    room._process_state_event(member_event("@u2:example.com", "invite"))
+    room._process_state_event(member_event("@u3:example.com", "ban"))
+
+    members = room.get_joined_members()
+    assert len(members) == 998
+    assert members[0].user_id == "@u0:example.com"
+    assert room.members.display_name("@u1:example.com") == "One"
+    assert room.members.membership("@u2:example.com") == "invite"
+    assert "@u3:example.com" not in room.members
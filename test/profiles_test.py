@@ -0,0 +1,84 @@
+import json
+
+import responses
+
+from matrix_client.api import MATRIX_V2_API_PATH
+from matrix_client.client import MatrixClient
+from matrix_client.profiles import ProfileCache
+from . import response_examples
+
+HOSTNAME = "http://example.com"
+USER_ID = "@alice:example.com"
+BOB = "@bob:example.com"
+SYNC_URL = HOSTNAME + MATRIX_V2_API_PATH + "/sync"
+PROFILE_URL = HOSTNAME + MATRIX_V2_API_PATH + "/profile/%s/displayname"
+ROOM_ID = "!726s6s6q:example.com"
+
+
+class Clock(object):
+
+    def __init__(self):
+        self.now = 0
+
+    def __call__(self):
+        return self.now
+
+
+def test_profile_cache_ttl_and_size():
+    clock = Clock()
+    cache = ProfileCache(max_size=2, ttl=10, clock=clock)
+    cache.update("@a:x", displayname="A")
+    cache.update("@b:x", displayname=None)
+    assert cache.get("@a:x", "displayname") == "A"
+    assert cache.get("@b:x", "displayname") is None
+    try:
+        cache.get("@a:x", "avatar_url")
+        assert False
+    except KeyError:
+        pass
+    # @b:x is now the least recently used profile
+    cache.get("@a:x", "displayname")
+    cache.update("@c:x", displayname="C")
+    assert "@b:x" not in cache
+    assert len(cache) == 2
+
+    clock.now = 10
+    try:
+        cache.get("@a:x", "displayname")
+        assert False
+    except KeyError:
+        pass
+    assert "@a:x" not in cache
+
+
+@responses.activate
+def test_get_user_shares_profile():
+    client = MatrixClient(HOSTNAME)
+    responses.add(responses.GET, PROFILE_URL % BOB, json={"displayname": "Bob"})
+    user = client.get_user(BOB)
+    assert client.get_user(BOB) is user
+    assert user.get_friendly_name() == "Bob"
+    assert user.get_friendly_name() == "Bob"
+    assert len(responses.calls) == 1
+
+
+@responses.activate
+def test_room_names_not_cached_as_profiles():
+    sync = json.loads(json.dumps(response_examples.example_sync))
+    timeline = sync["rooms"]["join"][ROOM_ID]["timeline"]["events"]
+    timeline[0]["content"]["displayname"] = "Bob in the room"
+    responses.add(responses.GET, SYNC_URL, json=sync)
+    responses.add(responses.GET, PROFILE_URL % BOB, json={"displayname": "Bob"})
+    client = MatrixClient(HOSTNAME, token="foobar", user_id=USER_ID,
+                          upload_filter=False)
+
+    room = client.rooms[ROOM_ID]
+    assert room.display_name == "Bob in the room"
+    assert room.members.display_name(BOB) == "Bob in the room"
+    assert BOB not in client.profile_cache
+    # The global name comes from the profile, once
+    user = client.get_user(BOB)
+    assert user.get_friendly_name() == "Bob"
+    assert user.get_friendly_name() == "Bob"
+    assert len([c for c in responses.calls if c.request.url.startswith(
+        PROFILE_URL % BOB)]) == 1
@@ -0,0 +1,89 @@
+import json
+
+import responses
+
+from matrix_client import ratelimit
+from matrix_client.api import MatrixHttpApi, MATRIX_V2_API_PATH
+from matrix_client.ratelimit import RateLimiter, TokenBucket, classify_endpoint
+
+HOSTNAME = "http://example.com"
+
+
+def test_classify_endpoint():
+    assert classify_endpoint("PUT", "/rooms/!a:b/send/m.room.message/1") == \
+        ratelimit.SEND
+    assert classify_endpoint("PUT", "/rooms/!a:b/state/m.room.name") == ratelimit.STATE
+    assert classify_endpoint("GET", "/rooms/!a:b/state/m.room.name") == ratelimit.OTHER
+    assert classify_endpoint("POST", "/rooms/!a:b/invite") == ratelimit.STATE
+    assert classify_endpoint("POST", "/join/%23a%3Ab") == ratelimit.STATE
+    assert classify_endpoint("GET", "/profile/@a:b/displayname") == ratelimit.PROFILE
+    assert classify_endpoint("POST", "/keys/upload") == ratelimit.KEYS
+    assert classify_endpoint("POST", "", "/_matrix/media/r0/upload") == ratelimit.MEDIA
+    assert classify_endpoint("GET", "/sync") == ratelimit.OTHER
+
+
+def test_token_bucket_burst_and_rate():
+    bucket = TokenBucket(rate=1, burst=3)
+    delays = [bucket.reserve(now=100) for _ in range(5)]
+    assert delays == [0, 0, 0, 1, 2]
+    assert bucket.wait_time(now=100) == 3
+    # Tokens refill over time
+    assert bucket.reserve(now=110) == 0
+
+
+def test_token_bucket_unlimited_learns_from_429():
+    bucket = TokenBucket()
+    assert bucket.reserve(now=0) == 0
+    assert bucket.reserve(now=0) == 0
+
+    bucket.rate_limited(2, now=10)
+    assert bucket.rate == 0.5
+    assert bucket.wait_time(now=10) == 2
+    # Queued requests are spread out instead of all firing when unblocked
+    assert bucket.reserve(now=10) == 2
+    assert bucket.reserve(now=10) == 4
+
+    # Learned rate is halved on repeated 429s and recovers on success
+    bucket.rate_limited(1, now=20)
+    assert bucket.rate == 0.25
+    for _ in range(100):
+        bucket.success()
+    assert bucket.rate is None
+
+
+def test_rate_limiter_wait_times():
+    limiter = RateLimiter({ratelimit.SEND: (1, 1)})
+    assert limiter.reserve(ratelimit.SEND) == 0
+    assert limiter.wait_time(ratelimit.SEND) > 0
+    waits = limiter.wait_times()
+    assert waits[ratelimit.STATE] == 0
+    assert waits[ratelimit.SEND] > 0
+
+
+@responses.activate
+def test_send_429_backs_off_endpoint_class():
+    api = MatrixHttpApi(HOSTNAME, token="foobar")
+    url = HOSTNAME + MATRIX_V2_API_PATH + "/profile/@alice:example.com/displayname"
+    responses.add(responses.GET, url, status=429,
+                  body=json.dumps({"errcode": "M_LIMIT_EXCEEDED",
+                                   "retry_after_ms": 100}))
+    responses.add(responses.GET, url, body='{"displayname": "Alice"}')
+
+    assert api.get_display_name("@alice:example.com") == "Alice"
+    assert len(responses.calls) == 2
+    assert api.rate_limiter.buckets[ratelimit.PROFILE].rate is not None
+    assert api.rate_limiter.buckets[ratelimit.SEND].rate is None
+
+
+@responses.activate
+def test_send_429_retry_after_in_error():
+    api = MatrixHttpApi(HOSTNAME, token="foobar", default_429_wait_ms=5000)
+    url = HOSTNAME + MATRIX_V2_API_PATH + "/devices"
+    error = json.dumps({"retry_after_ms": 10})
+    responses.add(responses.GET, url, status=429, body=json.dumps({"error": error}))
+    responses.add(responses.GET, url, body='{}')
+
+    api.get_devices()
+    assert len(responses.calls) == 2
+    assert api._get_retry_after(json.dumps({"error": error})) == 0.01
+    assert api._get_retry_after("not json") == 5
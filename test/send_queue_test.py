@@ -0,0 +1,118 @@
+import json
+import re
+from threading import Thread
+
+import pytest
+import responses
+
+from matrix_client.api import MATRIX_V2_API_PATH, MatrixHttpApi
+from matrix_client.client import MatrixClient
+from matrix_client.errors import MatrixRequestError
+from matrix_client.send_queue import SendQueue
+try:
+    from urllib import unquote
+except ImportError:
+    from urllib.parse import unquote
+
+HOSTNAME = "http://example.com"
+SEND_RE = re.compile(re.escape(HOSTNAME + MATRIX_V2_API_PATH) +
+                     r"/rooms/([^/]+)/send/m\.room\.message/([^/?]+)")
+
+
+class FakeSend(object):
+    """Answers send requests, failing them as asked."""
+
+    def __init__(self, statuses=()):
+        self.statuses = list(statuses)
+        self.requests = []
+
+    def __call__(self, request):
+        room_id, txn_id = SEND_RE.match(request.url).groups()
+        room_id = unquote(room_id)
+        body = json.loads(request.body)["body"]
+        self.requests.append((room_id, txn_id, body))
+        status = self.statuses.pop(0) if self.statuses else 200
+        if status != 200:
+            return status, {}, json.dumps({"errcode": "M_UNKNOWN"})
+        return 200, {}, json.dumps({"event_id": "$%s" % body})
+
+
+def message(body):
+    return {"msgtype": "m.text", "body": body}
+
+
+@responses.activate
+def test_send_queue_order_per_room():
+    fake = FakeSend()
+    responses.add_callback(responses.PUT, SEND_RE, callback=fake)
+    queue = SendQueue(MatrixHttpApi(HOSTNAME, token="foobar"), workers=3)
+    handles = [queue.send("!room%d:example.com" % (i % 4), "m.room.message",
+                          message(str(i)))
+               for i in range(40)]
+    assert [handle.result() for handle in handles] == ["$%d" % i for i in range(40)]
+    for room in range(4):
+        bodies = [int(body) for room_id, _, body in fake.requests
+                  if room_id == "!room%d:example.com" % room]
+        assert bodies == list(range(room, 40, 4))
+    queue.shutdown()
+
+
+@responses.activate
+def test_send_queue_retries_with_same_txn_id():
+    fake = FakeSend([500, 502, 200, 403])
+    responses.add_callback(responses.PUT, SEND_RE, callback=fake)
+    queue = SendQueue(MatrixHttpApi(HOSTNAME, token="foobar"), workers=1,
+                      backoff=0.001)
+    first = queue.send("!a:example.com", "m.room.message", message("hi"))
+    second = queue.send("!a:example.com", "m.room.message", message("ho"))
+    assert first.result() == "$hi"
+    with pytest.raises(MatrixRequestError):
+        second.result()
+    assert [txn_id for _, txn_id, _ in fake.requests[:3]] == [fake.requests[0][1]] * 3
+    assert fake.requests[3][1] != fake.requests[0][1]
+    queue.shutdown()
+
+
+@responses.activate
+def test_room_queue_text():
+    fake = FakeSend()
+    responses.add_callback(responses.PUT, SEND_RE, callback=fake)
+    client = MatrixClient(HOSTNAME)
+    room = client._mkroom("!a:example.com")
+    assert room.queue_text("hello").result() == "$hello"
+    client.send_queue.shutdown()
+
+
+@responses.activate
+def test_send_queue_sessions_and_logout():
+    fake = FakeSend()
+    responses.add_callback(responses.PUT, SEND_RE, callback=fake)
+    logout_url = HOSTNAME + MATRIX_V2_API_PATH + "/logout"
+    responses.add(responses.POST, logout_url, json={})
+    client = MatrixClient(HOSTNAME)
+    room = client._mkroom("!a:example.com")
+    handles = [room.queue_text(str(i)) for i in range(20)]
+    client.logout()
+    # Every queued event was sent before logging out
+    assert all(handle.done() for handle in handles)
+    assert responses.calls[-1].request.url.startswith(logout_url)
+    assert len(fake.requests) == 20
+    # The workers did not use the session of the calling thread
+    assert client.api._worker_sessions
+    client.api.shutdown()
+
+
+def test_make_txn_id_thread_safe():
+    api = MatrixHttpApi(HOSTNAME)
+    txn_ids = []
+
+    def make():
+        for _ in range(1000):
+            txn_ids.append(api._make_txn_id())
+
+    threads = [Thread(target=make) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert api.txn_id == 4000
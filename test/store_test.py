@@ -0,0 +1,94 @@
+from collections import OrderedDict
+
+import responses
+
+from matrix_client.api import MATRIX_V2_API_PATH
+from matrix_client.client import MatrixClient
+from matrix_client.store import SQLiteStore
+from .helpers import ROOM_ID, USER_ID, sync_response
+
+HOSTNAME = "http://example.com"
+SYNC_URL = HOSTNAME + MATRIX_V2_API_PATH + "/sync"
+
+
+@responses.activate
+def test_sqlite_store_warm_restart(tmpdir):
+    path = str(tmpdir.join("state.db"))
+    name_event = {"type": "m.room.name", "state_key": "", "content": {"name": "Fish"}}
+    responses.add(responses.GET, SYNC_URL,
+                  json=sync_response("s1", state_events=[name_event]))
+    client = MatrixClient(HOSTNAME, token="foobar", user_id=USER_ID,
+                          upload_filter=False, store=SQLiteStore(path))
+    assert client.sync_token == "s1"
+    client.store.close()
+
+    responses.replace(responses.GET, SYNC_URL, json={
+        "next_batch": "s2", "presence": {"events": []},
+        "rooms": {"join": {}, "invite": {}, "leave": {}}})
+    client = MatrixClient(HOSTNAME, token="foobar", user_id=USER_ID,
+                          upload_filter=False, store=SQLiteStore(path))
+    # The second client resumed from the saved token, without long-polling
+    assert "since=s1" in responses.calls[-1].request.url
+    assert responses.calls[-1].request.params["timeout"] == "0"
+    assert client.sync_token == "s2"
+    room = client.rooms[ROOM_ID]
+    assert room.name == "Fish"
+    assert room.prev_batch == "t34-23535_0_0"
+    assert [m.user_id for m in room.get_joined_members()] == \
+        ["@alice:example.com", "@bob:example.com"]
+    client.store.close()
+
+
+@responses.activate
+def test_sqlite_store_left_room(tmpdir):
+    path = str(tmpdir.join("state.db"))
+    responses.add(responses.GET, SYNC_URL, json=sync_response("s1"))
+    client = MatrixClient(HOSTNAME, token="foobar", user_id=USER_ID,
+                          upload_filter=False, store=SQLiteStore(path))
+    leave = {"next_batch": "s2", "presence": {"events": []},
+             "rooms": {"join": {}, "invite": {}, "leave": {ROOM_ID: {}}}}
+    responses.replace(responses.GET, SYNC_URL, json=leave)
+    client._sync()
+    assert client.store.get_rooms() == []
+    assert client.store.get_meta("sync_token") == "s2"
+
+
+def test_sqlite_store_other_user():
+    store = SQLiteStore(":memory:")
+    store.set_meta("user_id", "@bob:example.com")
+    store.set_meta("sync_token", "s1")
+    store.save_room(ROOM_ID, "p1", {"name": "Fish"}, {USER_ID: ("join", "Alice")})
+    store.commit()
+    client = MatrixClient(HOSTNAME, upload_filter=False, store=store)
+    client.user_id = USER_ID
+    client._load_store()
+    assert client.sync_token is None
+    assert client.rooms == {}
+    assert store.get_rooms() == []
+    assert store.get_meta("user_id") == USER_ID
+
+
+def test_sqlite_store_members():
+    store = SQLiteStore(":memory:")
+    store.save_room(ROOM_ID, None, {}, {USER_ID: ("join", "Alice"),
+                                        "@bob:example.com": ("invite", None)})
+    store.save_room(ROOM_ID, "p1", {"topic": "fish"},
+                    {USER_ID: ("join", "Alice 2"), "@bob:example.com": ("join", None)})
+    assert store.get_rooms() == [(ROOM_ID, "p1", {"topic": "fish"}, {
+        USER_ID: ("join", "Alice 2"), "@bob:example.com": ("join", None)})]
+    store.remove_room(ROOM_ID)
+    assert store.get_rooms() == []
+
+
+def test_sqlite_store_members_order():
+    store = SQLiteStore(":memory:")
+    user_ids = ["@user%d:example.com" % i for i in reversed(range(20))]
+    store.save_room(ROOM_ID, None, {}, OrderedDict(
+        (user_id, ("join", None)) for user_id in user_ids))
+    # Members leaving keep their place, and joining again move to the end
+    store.save_room(ROOM_ID, None, {}, {user_ids[0]: ("leave", None)})
+    store.save_room(ROOM_ID, None, {}, {user_ids[1]: ("leave", None)})
+    store.save_room(ROOM_ID, None, {}, {user_ids[0]: ("join", None)})
+    members = store.get_rooms()[0][3]
+    assert list(members) == user_ids[1:] + user_ids[:1]
+    assert members[user_ids[1]] == ("leave", None)
@@ -0,0 +1,178 @@
+import json
+import threading
+
+import responses
+
+from matrix_client import sync_pipeline
+from matrix_client.api import MATRIX_V2_API_PATH
+from matrix_client.client import MatrixClient
+from .helpers import sync_response
+
+try:
+    from urlparse import urlparse, parse_qs
+except ImportError:
+    from urllib.parse import urlparse, parse_qs
+
+HOSTNAME = "http://example.com"
+SYNC_URL = HOSTNAME + MATRIX_V2_API_PATH + "/sync"
+
+
+def batch_response(since):
+    batch = int(since or 0)
+    return sync_response(str(batch + 1), ["$%d" % batch])
+
+
+def join_fetchers():
+    # A stopped fetcher may still have a request in flight
+    for thread in threading.enumerate():
+        if thread.name == "matrix-sync-fetcher":
+            thread.join(5)
+
+
+class FakeSync(object):
+
+    def __init__(self, fail_once=None):
+        self.fail_once = fail_once
+        self.requested = []
+        self.second_request = threading.Event()
+
+    def __call__(self, request):
+        since = parse_qs(urlparse(request.url).query).get("since", [None])[0]
+        self.requested.append(since)
+        if len(self.requested) == 2:
+            self.second_request.set()
+        if self.fail_once and since == self.fail_once and \
+                self.requested.count(since) == 1:
+            return 400, {}, json.dumps({"errcode": "M_UNKNOWN"})
+        return 200, {}, json.dumps(batch_response(since))
+
+
+@responses.activate
+def test_pipelined_sync():
+    fake_sync = FakeSync()
+    responses.add_callback(responses.GET, SYNC_URL, callback=fake_sync)
+    client = MatrixClient(HOSTNAME, pipelined_sync=True, upload_filter=False)
+    received = []
+
+    def listener(event):
+        if not received:
+            # The next request is sent while the first batch is processed
+            assert fake_sync.second_request.wait(5)
+        received.append(event["event_id"])
+        if len(received) == 5:
+            client.should_listen = False
+
+    client.add_listener(listener)
+    client.listen_forever(timeout_ms=0)
+    join_fetchers()
+    assert received == ["$0", "$1", "$2", "$3", "$4"]
+    assert client.sync_token == "5"
+    assert fake_sync.requested[:5] == [None, "1", "2", "3", "4"]
+    assert client._sync_pipeline is None
+
+
+@responses.activate
+def test_pipelined_sync_token_change():
+    responses.add_callback(responses.GET, SYNC_URL, callback=FakeSync())
+    client = MatrixClient(HOSTNAME, pipelined_sync=True, upload_filter=False)
+    received = []
+
+    def listener(event):
+        received.append(event["event_id"])
+        if len(received) == 1:
+            client.sync_token = "10"
+        elif len(received) == 2:
+            client.should_listen = False
+
+    client.add_listener(listener)
+    client.listen_forever(timeout_ms=0)
+    join_fetchers()
+    # Batches fetched ahead with the old token are dropped
+    assert received == ["$0", "$10"]
+    assert client.sync_token == "11"
+
+
+@responses.activate
+def test_pipelined_sync_closes_sessions(monkeypatch):
+    sessions = []
+
+    class Session(sync_pipeline.Session):
+        def __init__(self):
+            super(Session, self).__init__()
+            self.closed = False
+            sessions.append(self)
+
+        def close(self):
+            self.closed = True
+            super(Session, self).close()
+
+    monkeypatch.setattr(sync_pipeline, "Session", Session)
+    responses.add_callback(responses.GET, SYNC_URL, callback=FakeSync())
+    client = MatrixClient(HOSTNAME, pipelined_sync=True, upload_filter=False)
+    received = []
+
+    def listener(event):
+        received.append(event["event_id"])
+        if len(received) == 1:
+            # Restarts the pipeline
+            client.sync_token = "10"
+        elif len(received) == 2:
+            client.should_listen = False
+
+    client.add_listener(listener)
+    client.listen_forever(timeout_ms=0)
+    join_fetchers()
+    assert len(sessions) == 2
+    assert all(session.closed for session in sessions)
+
+
+@responses.activate
+def test_pipelined_sync_error():
+    fake_sync = FakeSync(fail_once="2")
+    responses.add_callback(responses.GET, SYNC_URL, callback=fake_sync)
+    client = MatrixClient(HOSTNAME, pipelined_sync=True, upload_filter=False)
+    received = []
+    errors = []
+
+    def listener(event):
+        received.append(event["event_id"])
+        if len(received) == 3:
+            client.should_listen = False
+
+    client.add_listener(listener)
+    client.listen_forever(timeout_ms=0, exception_handler=errors.append)
+    join_fetchers()
+    # The failed request is retried with the same token
+    assert received == ["$0", "$1", "$2"]
+    assert len(errors) == 1 and errors[0].code == 400
+    assert fake_sync.requested[:4] == [None, "1", "2", "2"]
+
+
+@responses.activate
+def test_pipelined_sync_uploads_filter_on_own_session(monkeypatch):
+    urls = []
+
+    class Session(sync_pipeline.Session):
+        def request(self, method, url, *args, **kwargs):
+            urls.append(url)
+            return super(Session, self).request(method, url, *args, **kwargs)
+
+    monkeypatch.setattr(sync_pipeline, "Session", Session)
+    user_id = "@alice:example.com"
+    filter_url = HOSTNAME + MATRIX_V2_API_PATH + "/user/" + user_id + "/filter"
+    responses.add(responses.POST, filter_url, json={"filter_id": "7"})
+    fake_sync = FakeSync()
+    responses.add_callback(responses.GET, SYNC_URL, callback=fake_sync)
+    client = MatrixClient(HOSTNAME, pipelined_sync=True)
+    client.user_id = user_id
+
+    def listener(event):
+        client.should_listen = False
+
+    client.add_listener(listener)
+    client.listen_forever(timeout_ms=0)
+    join_fetchers()
+    # The filter was uploaded by the fetcher, not with the client's session
+    assert [url.split("?")[0] for url in urls[:2]] == [filter_url, SYNC_URL]
+    assert all(c.request.url.split("?")[0] != filter_url
+               for c in responses.calls if c.request.url not in urls)
@@ -0,0 +1,98 @@
+# -*- coding: utf-8 -*-
+import json
+from copy import deepcopy
+
+import pytest
+import responses
+
+from matrix_client.api import MATRIX_V2_API_PATH
+from matrix_client.client import MatrixClient
+from matrix_client.errors import MatrixUnexpectedResponse
+from matrix_client.sync_stream import iter_sync_response
+from . import response_examples
+
+HOSTNAME = "http://example.com"
+
+
+def chunked(data, size):
+    return [data[i:i + size] for i in range(0, len(data), size)]
+
+
+def rebuild(items):
+    """Rebuild the full response from the streamed items."""
+    response = {}
+    for path, value in items:
+        target = response
+        for key in path[:-1]:
+            target = target.setdefault(key, {})
+        target[path[-1]] = value
+    return response
+
+
+def tricky_sync():
+    sync = deepcopy(response_examples.example_sync)
+    room = sync["rooms"]["join"]["!726s6s6q:example.com"]
+    room["timeline"]["events"][1]["content"]["body"] = u'{"[ \\"}] é☃ \\'
+    sync["rooms"]["join"]["!empty:example.com"] = {}
+    sync["rooms"]["invite"] = {"!invited:example.com": {"invite_state": {"events": []}}}
+    sync["rooms"]["leave"] = {"!left:example.com": {}}
+    sync["device_one_time_keys_count"] = {"curve25519": 10, "signed": -1.5e3}
+    sync["flag"] = [True, False, None]
+    return sync
+
+
+@pytest.mark.parametrize("chunk_size", [1, 3, 7, 64, 1 << 20])
+def test_iter_sync_response_chunk_boundaries(chunk_size):
+    sync = tricky_sync()
+    data = json.dumps(sync, indent=2).encode("utf-8")
+    items = list(iter_sync_response(chunked(data, chunk_size), "json"))
+    assert rebuild(items) == sync
+
+    paths = [path for path, _ in items]
+    assert ("rooms", "join", "!726s6s6q:example.com") in paths
+    assert ("rooms", "join", "!empty:example.com") in paths
+    assert ("next_batch",) in paths
+
+
+def test_iter_sync_response_is_incremental():
+    sync = deepcopy(response_examples.example_sync)
+    room = sync["rooms"]["join"].pop("!726s6s6q:example.com")
+    for i in range(20):
+        sync["rooms"]["join"]["!room%d:example.com" % i] = room
+    data = json.dumps(sync).encode("utf-8")
+    chunks = chunked(data, 256)
+    consumed = []
+
+    def reader():
+        for chunk in chunks:
+            consumed.append(chunk)
+            yield chunk
+
+    for path, _ in iter_sync_response(reader()):
+        if path[:2] == ("rooms", "join"):
+            break
+    assert len(consumed) < len(chunks) / 4
+
+
+def test_iter_sync_response_truncated():
+    data = json.dumps(response_examples.example_sync).encode("utf-8")
+    with pytest.raises(MatrixUnexpectedResponse):
+        list(iter_sync_response(chunked(data[:-10], 16)))
+
+
+@responses.activate
+def test_streaming_sync_client():
+    client = MatrixClient(HOSTNAME, streaming_sync=True)
+    sync_url = HOSTNAME + MATRIX_V2_API_PATH + "/sync"
+    room_id = "!726s6s6q:example.com"
+    responses.add(responses.GET, sync_url, json=response_examples.example_sync)
+    events = []
+    client.add_listener(events.append)
+
+    client._sync()
+
+    assert client.sync_token == response_examples.example_sync["next_batch"]
+    assert room_id in client.rooms
+    assert len(client.rooms[room_id].events) == 2
+    assert [e["room_id"] for e in events] == [room_id, room_id]
+    assert len(client.rooms[room_id]._members) == 2
@@ -0,0 +1,117 @@
+import pytest
+import responses
+
+from matrix_client.client import MatrixClient
+from matrix_client.timeline import EventCache, Timeline
+
+
+def event(i):
+    return {"type": "m.room.message", "event_id": "$%d" % i}
+
+
+def test_timeline_ring_buffer():
+    timeline = Timeline(3)
+    for i in range(5):
+        timeline.append(event(i))
+    assert timeline == [event(2), event(3), event(4)]
+    assert len(timeline) == 3
+    assert timeline[0] == event(2)
+    assert timeline[-1] == event(4)
+    assert timeline[1:] == [event(3), event(4)]
+    with pytest.raises(IndexError):
+        timeline[3]
+
+    assert timeline.get("$1") is None
+    assert timeline.get("$3") == event(3)
+    assert timeline.position("$4") == 2
+
+
+def test_timeline_resize():
+    timeline = Timeline(5)
+    for i in range(5):
+        timeline.append(event(i))
+    timeline.limit = 2
+    assert timeline == [event(3), event(4)]
+    assert timeline.position("$3") == 0
+    assert timeline.get("$0") is None
+    timeline.limit = 4
+    timeline.append(event(5))
+    assert timeline == [event(3), event(4), event(5)]
+    timeline.limit = 0
+    timeline.append(event(6))
+    assert len(timeline) == 0
+
+
+def test_room_events():
+    client = MatrixClient("http://example.com")
+    room = client._mkroom("!room:example.com")
+    room.event_history_limit = 1000
+    for i in range(1500):
+        room._put_event(event(i))
+    events = room.get_events()
+    assert isinstance(events, list)
+    assert len(events) == 1000
+    assert events[0] == event(500)
+    assert room.get_event("$1499") == event(1499)
+    assert room.get_event("$10") is None
+
+
+def test_event_cache_evicts_least_recently_active():
+    cache = EventCache(max_events=10)
+    timelines = [Timeline(10, cache=cache) for _ in range(3)]
+    for i in range(4):
+        timelines[0].append(event(i))
+        timelines[1].append(event(i))
+    assert cache.usage()["events"] == 8
+    # Room 0 gets active again, so room 1 is the least recently active one
+    timelines[0].append(event(4))
+    timelines[2].append(event(0))
+    timelines[2].append(event(1))
+    assert len(timelines[1]) == 0 and timelines[1].evicted
+    assert not timelines[0].evicted
+    assert cache.usage() == {"events": 7, "bytes": 0, "timelines": 2, "evictions": 1}
+
+    # A full timeline still counts as active
+    for i in range(5, 20):
+        timelines[0].append(event(i))
+    assert len(timelines[0]) == 10 and len(timelines[2]) == 0
+    assert cache.usage()["events"] == 10
+
+
+def test_event_cache_bytes():
+    cache = EventCache(max_bytes=100, sizeof=lambda e: 30)
+    first = Timeline(2, cache=cache)
+    second = Timeline(2, cache=cache)
+    for i in range(3):
+        first.append(event(i))
+    assert cache.usage()["bytes"] == 60
+    second.append(event(0))
+    second.append(event(1))
+    assert first.evicted
+    assert cache.usage()["bytes"] == 60
+    second.limit = 1
+    assert cache.usage()["bytes"] == 30
+    second.detach()
+    assert cache.usage() == {"events": 0, "bytes": 0, "timelines": 0, "evictions": 1}
+
+
+@responses.activate
+def test_room_refetches_evicted_events():
+    client = MatrixClient("http://example.com", event_cache=EventCache(max_events=2))
+    client.sync_token = "s1"
+    room = client._mkroom("!room:example.com")
+    other = client._mkroom("!other:example.com")
+    room._put_event(event(0))
+    room._put_event(event(1))
+    other._put_event(event(2))
+    assert room.events.evicted
+
+    messages_url = "http://example.com/_matrix/client/r0/rooms/" \
+        "%21room%3Aexample.com/messages"
+    responses.add(responses.GET, messages_url,
+                  json={"chunk": [event(1), event(0)], "start": "s1", "end": "t0"})
+    assert room.get_events() == [event(0), event(1)]
+    assert not room.events.evicted
+    assert "from=s1" in responses.calls[0].request.url
+    assert "dir=b" in responses.calls[0].request.url
+    assert other.events.evicted
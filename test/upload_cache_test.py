@@ -0,0 +1,57 @@
+import responses
+
+from matrix_client.client import MatrixClient
+from matrix_client.upload_cache import UploadCache
+from .helpers import FakeUpload
+
+HOSTNAME = "http://example.com"
+UPLOAD_URL = HOSTNAME + "/_matrix/media/r0/upload"
+
+
+@responses.activate
+def test_upload_deduplicated_across_restarts(tmpdir):
+    fake = FakeUpload()
+    responses.add_callback(responses.POST, UPLOAD_URL, callback=fake)
+    path = tmpdir.join("logo.png")
+    path.write_binary(b"logo" * 1000)
+    index = str(tmpdir.join("uploads.sqlite"))
+
+    client = MatrixClient(HOSTNAME, upload_cache=UploadCache(index))
+    assert client.upload_file(str(path), "image/png") == "mxc://example.com/1"
+    assert client.upload(b"logo" * 1000, "image/png") == "mxc://example.com/1"
+    # The content type is part of the key
+    assert client.upload(b"logo" * 1000, "image/gif") == "mxc://example.com/2"
+    client.upload_cache.close()
+
+    client = MatrixClient(HOSTNAME, upload_cache=UploadCache(index))
+    with open(str(path), "rb") as f:
+        assert client.upload(f, "image/png") == "mxc://example.com/1"
+        # Hashing does not move the file
+        assert f.tell() == 0
+    assert len(fake.bodies) == 2
+
+
+@responses.activate
+def test_iterator_hashed_while_streaming():
+    fake = FakeUpload()
+    responses.add_callback(responses.POST, UPLOAD_URL, callback=fake)
+    client = MatrixClient(HOSTNAME, upload_cache=UploadCache())
+
+    assert client.upload(iter([b"chart", b"data"]), "image/png") == \
+        "mxc://example.com/1"
+    assert client.upload(b"chartdata", "image/png") == "mxc://example.com/1"
+    # Iterators are read once, so they are always sent
+    assert client.upload(iter([b"chartdata"]), "image/png") == "mxc://example.com/2"
+    assert fake.bodies == [b"chartdata", b"chartdata"]
+
+
+@responses.activate
+def test_text_hashed_as_sent():
+    fake = FakeUpload()
+    responses.add_callback(responses.POST, UPLOAD_URL, callback=fake)
+    client = MatrixClient(HOSTNAME, upload_cache=UploadCache())
+
+    assert client.upload(u"caf\u00e9", "text/plain") == "mxc://example.com/1"
+    assert client.upload(u"caf\u00e9".encode("utf-8"), "text/plain") == \
+        "mxc://example.com/1"
+    assert fake.bodies == [u"caf\u00e9".encode("utf-8")]
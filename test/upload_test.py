@@ -0,0 +1,105 @@
+import os
+
+import pytest
+import responses
+
+from matrix_client.client import MatrixClient
+from matrix_client.errors import MatrixRequestError
+from matrix_client.upload import FileBody
+from .helpers import FakeUpload
+
+HOSTNAME = "http://example.com"
+UPLOAD_URL = HOSTNAME + "/_matrix/media/r0/upload"
+
+
+@responses.activate
+def test_upload_file_streamed(tmpdir):
+    path = tmpdir.join("data.bin")
+    data = b"0123456789" * 10000
+    path.write_binary(data)
+    fake = FakeUpload(rate_limited=1)
+    responses.add_callback(responses.POST, UPLOAD_URL, callback=fake)
+    progress = []
+    client = MatrixClient(HOSTNAME)
+
+    url = client.upload_file(str(path), "application/octet-stream",
+                             progress=lambda sent, total: progress.append((sent, total)))
+    assert url == "mxc://example.com/1"
+    # The body was sent again from the start after the 429
+    assert fake.bodies == [data, data]
+    assert fake.headers[-1]["Content-Length"] == str(len(data))
+    assert progress[-1] == (len(data), len(data))
+
+
+@responses.activate
+def test_upload_file_object_and_bytes(tmpdir):
+    path = tmpdir.join("data.bin")
+    path.write_binary(b"abc")
+    fake = FakeUpload()
+    responses.add_callback(responses.POST, UPLOAD_URL, callback=fake)
+    client = MatrixClient(HOSTNAME)
+    with open(str(path), "rb") as f:
+        f.read(1)
+        client.upload(f, "text/plain")
+    client.upload(b"xyz", "text/plain")
+    assert fake.bodies == [b"bc", b"xyz"]
+
+
+@responses.activate
+def test_upload_iterator_chunked():
+    fake = FakeUpload()
+    responses.add_callback(responses.POST, UPLOAD_URL, callback=fake)
+    client = MatrixClient(HOSTNAME)
+    progress = []
+    client.upload(iter([b"ab", b"", b"cd"]), "text/plain",
+                  progress=lambda sent, total: progress.append((sent, total)))
+    assert fake.bodies == [b"abcd"]
+    assert fake.headers[0]["Transfer-Encoding"] == "chunked"
+    assert progress == [(2, None), (4, None)]
+
+    # Iterators cannot be sent twice
+    fake.rate_limited = 1
+    with pytest.raises(MatrixRequestError):
+        client.upload(iter([b"ab"]), "text/plain")
+
+
+@responses.activate
+def test_upload_text_not_chunked():
+    fake = FakeUpload()
+    responses.add_callback(responses.POST, UPLOAD_URL, callback=fake)
+    client = MatrixClient(HOSTNAME)
+    client.upload(u"hello t\u00ebxt", "text/plain")
+    assert fake.bodies == [u"hello t\u00ebxt".encode("utf-8")]
+    assert fake.headers[0]["Content-Length"] == str(len(fake.bodies[0]))
+    assert "Transfer-Encoding" not in fake.headers[0]
+
+
+def pipe(data):
+    read_fd, write_fd = os.pipe()
+    os.write(write_fd, data)
+    os.close(write_fd)
+    return os.fdopen(read_fd, "rb")
+
+
+@responses.activate
+def test_upload_pipe_chunked():
+    fake = FakeUpload()
+    responses.add_callback(responses.POST, UPLOAD_URL, callback=fake)
+    client = MatrixClient(HOSTNAME)
+    with pipe(b"piped") as f:
+        client.upload(f, "text/plain")
+    assert fake.bodies == [b"piped"]
+    assert fake.headers[0]["Transfer-Encoding"] == "chunked"
+
+    # A pipe cannot be sent twice
+    fake.rate_limited = 1
+    with pipe(b"piped") as f:
+        with pytest.raises(MatrixRequestError):
+            client.upload(f, "text/plain")
+
+    # With a length, it is sent with a Content-Length
+    with pipe(b"piped") as f:
+        body = FileBody(f, length=5)
+        assert body.rewind()
+        assert body.read() == b"piped"
+        assert not body.rewind()